@@ -0,0 +1,55 @@
+import logging
+import os
+import sys
+from time import time
+
+logging.getLogger("cassandra").setLevel(logging.INFO)
+logging.getLogger("kafka").setLevel(logging.INFO)
+
+CQL_ALLOW_MNG = "CQLENG_ALLOW_SCHEMA_MANAGEMENT"
+DELETER_KEY = "DINO_DELETER"
+
+# the tables are created by the servers
+os.environ[CQL_ALLOW_MNG] = "0"
+
+# same modules as the deleter service
+os.environ[DELETER_KEY] = "1"
+
+from dinofw.utils import environ
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+# copies the keys of every message and attachment to messages_by_id and
+# attachments_by_file, and, if storage.buckets is 'dual' or 'on', the rows to the
+# bucketed tables; run it after every server has been upgraded (and writes to
+# both), then storage.buckets can be set to 'on' to read from the bucketed tables.
+# Until it has finished, older messages and attachments are found with a filtered
+# scan of their group the first time they're edited or deleted by id:
+#
+#     python backfill.py [id of the last group copied, to resume]
+
+if not environ.env.storage.write_buckets:
+    logger.info("storage.buckets is 'off', only copying the keys to the lookup tables")
+
+# rows written by the servers from now on are newer than the copies
+write_time = int(time() * 1_000_000)
+after_id = int(sys.argv[1]) if len(sys.argv) > 1 else 0
+
+session = environ.env.SessionLocal()
+n_groups, n_messages = 0, 0
+
+while True:
+    groups = environ.env.db.get_group_ids_after(after_id, BATCH_SIZE, session)
+    if not len(groups):
+        break
+
+    for group_pk, group_id in groups:
+        n_messages += environ.env.storage.backfill_group(group_id, write_time)
+        after_id = group_pk
+
+    n_groups += len(groups)
+    logger.info(f"copied {n_messages} messages in {n_groups} groups, last group id {after_id}")
+
+logger.info(f"finished backfilling {n_messages} messages in {n_groups} groups")
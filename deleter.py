@@ -22,3 +22,4 @@ from dinofw.cron import app  # noqa
 environ.env.node = "deleter"
 
 app.run_deletions()
+app.reconcile_group_type_counts()
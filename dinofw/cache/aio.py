@@ -0,0 +1,40 @@
+import logging
+
+from dinofw.utils.config import ConfigKeys
+from dinofw.utils.executor import ExecutorProxy
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncCache(ExecutorProxy):
+    """
+    Awaitable version of the cache; every method of the wrapped cache (CacheRedis,
+    CacheAllMiss, etc.) can be awaited through this class, e.g.:
+
+        unread = await self.env.async_cache.get_unread_in_group(group_id, user_id)
+
+    The calls run in a small thread pool sharing the wrapped cache's single redis
+    client, so a slow redis call doesn't stall the event loop for other requests.
+    """
+
+    wait_stat = "cache.pool.wait"
+
+    def __init__(self, env, cache):
+        self.cache = cache
+
+        cache_conf = env.config.get(ConfigKeys.CACHE_SERVICE, default=dict()) or dict()
+        super().__init__(
+            env, max_workers=int(cache_conf.get(ConfigKeys.POOL_SIZE, 50)), thread_name_prefix="cache"
+        )
+
+    def _wrapped(self):
+        return self.cache
+
+    def _report_gauges(self) -> None:
+        pool_stats = getattr(self.cache, "pool_stats", None)
+
+        if not callable(pool_stats):
+            return
+
+        for key, value in (pool_stats() or dict()).items():
+            self.env.stats.gauge(f"cache.pool.{key}", value)
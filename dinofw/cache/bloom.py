@@ -0,0 +1,37 @@
+from hashlib import sha1
+from typing import List
+
+
+class BloomFilter:
+    """
+    bloom filter stored as a redis bitmap; it never gives false negatives, so if
+    any of the bits for an item is unset, the item has definitely not been added
+    """
+    def __init__(self, key: str, n_bits: int, n_hashes: int = 7):
+        self.key = key
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+
+    def positions(self, item: str) -> List[int]:
+        # double hashing; the k positions are derived from two 64 bit hashes
+        digest = sha1(item.encode()).digest()
+        h1 = int.from_bytes(digest[0:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def add(self, p, item: str) -> None:
+        for position in self.positions(item):
+            p.setbit(self.key, position, 1)
+
+    def check(self, p, item: str) -> None:
+        """
+        queues the lookups on the pipeline; pass the n_hashes results from it
+        to might_contain()
+        """
+        for position in self.positions(item):
+            p.getbit(self.key, position)
+
+    @staticmethod
+    def might_contain(bits: List[int]) -> bool:
+        return all(bits)
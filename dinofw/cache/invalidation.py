@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from typing import Optional
+
+from dinofw.utils.config import RedisKeys
+
+logger = logging.getLogger(__name__)
+
+# bump the version and publish in one atomic step, so the order of
+# messages on the channel is always the same as the order of versions
+INVALIDATE_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', ARGV[1], version .. '|' .. ARGV[2])
+return version
+"""
+
+
+class CacheInvalidationListener:
+    """
+    Each worker keeps an in-process copy of some redis keys (see MemoryCache); when
+    any worker changes one of those keys it publishes the key name on a channel,
+    and this listener evicts the local copy in every other worker.
+
+    Every published message carries a version from a global counter. If a version
+    is skipped (e.g. the subscription connection dropped for a moment), we can't
+    know which keys we missed, so the whole local tier is flushed instead.
+    """
+
+    def __init__(self, cache, check_interval: float = 5.0):
+        self.cache = cache
+        self.check_interval = check_interval
+
+        self.last_version: Optional[int] = None
+        self.pending_version: Optional[int] = None
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+
+        self.thread = threading.Thread(
+            target=self.run, name="cache-invalidation", daemon=True
+        )
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                logger.error(f"cache invalidation listener failed, flushing local cache: {str(e)}")
+                self.cache.flush_local()
+                self.last_version = None
+                time.sleep(1)
+
+    def listen(self) -> None:
+        pubsub = self.cache.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(RedisKeys.invalidation_channel())
+
+        # anything cached before we subscribed could already be stale
+        self.cache.flush_local()
+        self.last_version = self.current_version()
+        self.pending_version = None
+
+        last_check = time.monotonic()
+
+        while True:
+            message = pubsub.get_message(timeout=1.0)
+            if message is not None:
+                self.on_message(message["data"])
+
+            if time.monotonic() - last_check > self.check_interval:
+                self.check_version()
+                last_check = time.monotonic()
+
+    def on_message(self, data: bytes) -> None:
+        version, keys = str(data, "utf-8").split("|", maxsplit=1)
+        version = int(version)
+
+        if self.last_version is not None and version > self.last_version + 1:
+            logger.warning(
+                f"missed cache invalidations between version {self.last_version} and {version}, flushing"
+            )
+            self.cache.flush_local()
+        else:
+            for key in keys.split(","):
+                self.cache._del(key)
+
+        if self.last_version is None or version > self.last_version:
+            self.last_version = version
+
+    def check_version(self) -> None:
+        """
+        compares our last seen version with the global one; messages can still be in
+        flight when we read the counter, so only flush if we're still behind the
+        version we saw on the previous check
+        """
+        if self.pending_version is not None and (
+            self.last_version is None or self.last_version < self.pending_version
+        ):
+            logger.warning(
+                f"cache invalidation version {self.last_version} behind {self.pending_version}, flushing"
+            )
+            self.cache.flush_local()
+            self.last_version = self.pending_version
+
+        self.pending_version = self.current_version()
+
+    def current_version(self) -> int:
+        version = self.cache.redis.get(RedisKeys.invalidation_version())
+        if version is None:
+            return 0
+
+        return int(str(version, "utf-8"))
@@ -0,0 +1,123 @@
+import threading
+import time
+from functools import wraps
+from typing import Callable
+from typing import Dict
+from typing import Optional
+
+
+def is_cached(result) -> bool:
+    # some getters return a tuple of Nones on a miss, e.g. (None, None)
+    if isinstance(result, tuple):
+        return any(value is not None for value in result)
+
+    return result is not None
+
+
+def instrumented(family: str, hit: Callable = None):
+    """
+    records calls and round-trip time of a CacheRedis method for a key family
+    (named after the RedisKeys method for the key); getters (name starting with
+    "get_") also record hits and misses, using `hit(result)` if specified
+
+    :param family: the key family, e.g. "user_in_group"
+    :param hit: decides if the returned value was a hit, default is any value not None
+    """
+    def factory(func):
+        is_getter = func.__name__.startswith("get_")
+        was_hit = hit or is_cached
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            before = time.perf_counter()
+            result = func(self, *args, **kwargs)
+            elapsed = time.perf_counter() - before
+
+            self.metrics.record(family, elapsed, was_hit(result) if is_getter else None)
+            return result
+
+        return wrapper
+    return factory
+
+
+class FamilyStats:
+    __slots__ = ("calls", "hits", "misses", "seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+
+    def to_dict(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {
+            "calls": self.calls,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else None,
+            "avg_ms": self.seconds * 1000 / self.calls if self.calls else None,
+        }
+
+
+class CacheMetrics:
+    """
+    Counts calls, hits, misses and time per key family. Totals are kept for the
+    debug endpoint, and the changes since the last report are sent to statsd at
+    most every STATS_INTERVAL seconds, so a request doing a lot of cache calls
+    doesn't also send one udp packet per call.
+    """
+
+    STATS_INTERVAL = 10
+
+    def __init__(self, env):
+        self.env = env
+        self.lock = threading.Lock()
+
+        self.totals: Dict[str, FamilyStats] = dict()
+        self.interval: Dict[str, FamilyStats] = dict()
+        self.last_report = time.monotonic()
+
+    def record(self, family: str, seconds: float, hit: Optional[bool] = None) -> None:
+        with self.lock:
+            for stats in [self.totals, self.interval]:
+                if family not in stats:
+                    stats[family] = FamilyStats()
+
+                family_stats = stats[family]
+                family_stats.calls += 1
+                family_stats.seconds += seconds
+
+                if hit is True:
+                    family_stats.hits += 1
+                elif hit is False:
+                    family_stats.misses += 1
+
+            if time.monotonic() - self.last_report < CacheMetrics.STATS_INTERVAL:
+                return
+
+            interval = self.interval
+            self.interval = dict()
+            self.last_report = time.monotonic()
+
+        self._report(interval)
+
+    def to_dict(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                family: stats.to_dict()
+                for family, stats in sorted(self.totals.items())
+            }
+
+    def _report(self, interval: Dict[str, FamilyStats]) -> None:
+        if self.env.stats is None:
+            return
+
+        # counters instead of gauges, so the counts of all workers add up
+        for family, stats in interval.items():
+            for name, count in [("calls", stats.calls), ("hits", stats.hits), ("misses", stats.misses)]:
+                if count > 0:
+                    self.env.stats.incr(f"cache.{family}.{name}", count)
+
+            self.env.stats.timing(f"cache.{family}.time", stats.seconds * 1000 / stats.calls)
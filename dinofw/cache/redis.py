@@ -1,8 +1,11 @@
+import json
 import logging
 import socket
 import sys
-from datetime import datetime as dt
-from datetime import timedelta
+import threading
+import time
+from array import array
+from collections import OrderedDict
 from typing import Dict
 from typing import List
 from typing import Optional
@@ -11,6 +14,13 @@ from typing import Tuple
 import redis
 
 from dinofw.cache import ICache
+from dinofw.cache.bloom import BloomFilter
+from dinofw.cache.invalidation import CacheInvalidationListener
+from dinofw.cache.invalidation import INVALIDATE_SCRIPT
+from dinofw.cache.metrics import CacheMetrics
+from dinofw.cache.metrics import instrumented
+from dinofw.db.rdbms.schemas import GroupBase
+from dinofw.rest.models import UserStats
 from dinofw.utils.config import ConfigKeys
 from dinofw.utils.config import RedisKeys
 
@@ -21,51 +31,223 @@ ONE_HOUR = 60 * 60
 ONE_DAY = 24 * ONE_HOUR
 ONE_WEEK = 7 * ONE_DAY
 
+# everything that changes in the cache when a user sends a message, in one round trip:
+#
+# KEYS: last message time, last read, last sent for user, hide, unread, invalidation version, group version
+# ARGV: sent time, ttl for last message time and group version, sender id, last sent value, invalidation channel,
+#       receiver ids...
+MESSAGE_SENT_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('HSET', KEYS[2], ARGV[3], ARGV[1])
+redis.call('SET', KEYS[3], ARGV[4])
+
+for _, user_id in ipairs(redis.call('HKEYS', KEYS[4])) do
+    redis.call('HSET', KEYS[4], user_id, 'f')
+end
+
+redis.call('HSET', KEYS[5], ARGV[3], 0)
+for i = 6, #ARGV do
+    redis.call('HINCRBY', KEYS[5], ARGV[i], 1)
+end
+
+redis.call('INCR', KEYS[7])
+redis.call('EXPIRE', KEYS[7], ARGV[2])
+
+local version = redis.call('INCR', KEYS[6])
+redis.call('PUBLISH', ARGV[5], version .. '|' .. KEYS[1])
+"""
+
+
+# counters only make sense relative to a full count, so don't create
+# the hash if it has expired, the next read will count from scratch
+#
+# KEYS: group type counts, invalidation version
+# ARGV: invalidation channel, field, delta, field, delta...
+INCREASE_GROUP_TYPES_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    for i = 2, #ARGV, 2 do
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+
+local version = redis.call('INCR', KEYS[2])
+redis.call('PUBLISH', ARGV[1], version .. '|' .. KEYS[1])
+"""
+
+GROUP_TYPES_INITIALIZED = "_"
+
+MEMBERSHIP_FORMAT_VERSION = 1
+JOIN_TIME_PAIR_SIZE = 16
+
+
+def pack_join_times(users: Dict[int, float]) -> bytes:
+    """
+    encodes a group's members as one value: a format version byte, followed by
+    little-endian (user_id uint64, join time in millis uint64) pairs sorted by
+    user id
+    """
+    values = array("Q")
+
+    for user_id in sorted(users.keys()):
+        values.append(user_id)
+        values.append(round(users[user_id] * 1000))
+
+    if sys.byteorder != "little":
+        values.byteswap()
+
+    return bytes([MEMBERSHIP_FORMAT_VERSION]) + values.tobytes()
+
+
+def unpack_join_times(packed: Optional[bytes]) -> Optional[Dict[int, float]]:
+    # unknown versions are treated as a miss and will be refilled
+    if packed is None or len(packed) == 0 or packed[0] != MEMBERSHIP_FORMAT_VERSION:
+        return None
+
+    values = array("Q")
+    values.frombytes(packed[1:])
+
+    if sys.byteorder != "little":
+        values.byteswap()
+
+    return dict(zip(values[0::2], [join_ms / 1000 for join_ms in values[1::2]]))
+
+
+class CacheEntry:
+    __slots__ = ("expires_at", "value")
+
+    def __init__(self, expires_at: float, value):
+        self.expires_at = expires_at
+        self.value = value
+
 
 class MemoryCache:
-    def __init__(self):
-        self.vals = dict()
+    """
+    in-process LRU cache with a ttl per entry, used as a first tier in front
+    of redis; expiry uses the monotonic clock so wall-clock adjustments on the
+    host can't make entries live forever (or expire immediately)
+    """
+    def __init__(self, max_size: int = 10_000, stale_ttl: float = 0):
+        self.vals: OrderedDict = OrderedDict()
+        self.max_size = max_size
+
+        # expired entries are kept this much longer and can still be read with
+        # get_stale(), e.g. to serve something while the value is being refilled
+        self.stale_ttl = stale_ttl
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
 
     def set(self, key, value, ttl=30):
-        try:
-            expires_at = (dt.utcnow() + timedelta(seconds=ttl)).timestamp()
-            self.vals[key] = (expires_at, value)
-        except:
-            pass
+        expires_at = time.monotonic() + ttl
+
+        with self.lock:
+            self.vals[key] = CacheEntry(expires_at, value)
+            self.vals.move_to_end(key)
+
+            while len(self.vals) > self.max_size:
+                self.vals.popitem(last=False)
 
     def get(self, key):
-        try:
-            if key not in self.vals:
+        with self.lock:
+            entry = self.vals.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            now = time.monotonic()
+
+            if now > entry.expires_at:
+                if now > entry.expires_at + self.stale_ttl:
+                    del self.vals[key]
+
+                self.misses += 1
                 return None
-            expires_at, value = self.vals[key]
-            now = dt.utcnow().timestamp()
-            if now > expires_at:
-                del self.vals[key]
+
+            self.vals.move_to_end(key)
+            self.hits += 1
+
+            return entry.value
+
+    def get_stale(self, key):
+        with self.lock:
+            entry = self.vals.get(key)
+
+            if entry is None or time.monotonic() > entry.expires_at + self.stale_ttl:
                 return None
-            return value
-        except:
-            return None
+
+            return entry.value
 
     def delete(self, key):
-        if key in self.vals:
-            del self.vals[key]
+        with self.lock:
+            self.vals.pop(key, None)
 
     def flushall(self):
-        self.vals = dict()
+        with self.lock:
+            self.vals = OrderedDict()
+
+    def size(self) -> int:
+        return len(self.vals)
 
 
 class CacheRedis(ICache):
     def __init__(self, env, host: str, port: int = 6379, db: int = 0):
+        self.metrics = CacheMetrics(env)
+        cache_conf = env.config.get(ConfigKeys.CACHE_SERVICE, default=dict()) or dict()
+
         if env.config.get(ConfigKeys.TESTING, default=False) or host == "mock":
             from fakeredis import FakeStrictRedis
 
             self.redis_pool = None
             self.redis_instance = FakeStrictRedis(host=host, port=port, db=db)
         else:
-            self.redis_pool = redis.ConnectionPool(host=host, port=port, db=db)
-            self.redis_instance = None
+            # one client and pool per worker; requests wait for a free
+            # connection instead of opening new ones without limit
+            self.redis_pool = redis.BlockingConnectionPool(
+                host=host,
+                port=port,
+                db=db,
+                max_connections=int(cache_conf.get(ConfigKeys.POOL_SIZE, 50)),
+                timeout=int(cache_conf.get(ConfigKeys.POOL_TIMEOUT, 5)),
+            )
+            self.redis_instance = redis.Redis(connection_pool=self.redis_pool)
+
+        self.local_ttl = int(cache_conf.get(ConfigKeys.LOCAL_CACHE_TTL, 30))
+
+        packed_membership = cache_conf.get(ConfigKeys.PACKED_MEMBERSHIP, False)
+        self.packed_membership = str(packed_membership).strip().lower() in ["yes", "1", "true"]
+
+        # twemproxy doesn't support pub/sub, so other workers can't be notified
+        self.invalidation_enabled = cache_conf.get(ConfigKeys.TYPE) != "nutcracker"
+
+        # without invalidations each worker would keep serving its own outdated
+        # copy until the ttl runs out, so the local tier is turned off (size 0)
+        if self.invalidation_enabled:
+            local_size = int(cache_conf.get(ConfigKeys.LOCAL_CACHE_SIZE, 10_000))
+        else:
+            logger.warning("cache invalidation not supported by nutcracker, disabling the local cache")
+            local_size = 0
+
+        self.cache = MemoryCache(
+            max_size=local_size,
+            stale_ttl=int(cache_conf.get(ConfigKeys.LOCAL_CACHE_STALE_TTL, 30)),
+        )
+
+        # groups are never deleted, so only "doesn't exist" can become outdated
+        self.negative_ttl = int(cache_conf.get(ConfigKeys.NEGATIVE_TTL, 10))
+        self.one_to_one_filter = BloomFilter(
+            RedisKeys.one_to_one_filter(),
+            n_bits=int(cache_conf.get(ConfigKeys.ONE_TO_ONE_FILTER_BITS, 2 ** 27)),
+        )
+
+        self.invalidation_listener = CacheInvalidationListener(self)
+        self.invalidate_script = self.redis.register_script(INVALIDATE_SCRIPT)
+        self.message_sent_script = self.redis.register_script(MESSAGE_SENT_SCRIPT)
+        self.increase_group_types_script = self.redis.register_script(INCREASE_GROUP_TYPES_SCRIPT)
 
-        self.cache = MemoryCache()
+        # fakeredis can't run lua, and twemproxy can't run scripts across keys on different shards
+        self.scripts_enabled = self.redis_pool is not None and self.invalidation_enabled
 
         args = sys.argv
         for a in ["--bind", "-b"]:
@@ -80,6 +262,7 @@ class CacheRedis(ICache):
 
         self.listen_host = socket.gethostname().split(".")[0]
 
+    @instrumented("last_read_time", hit=lambda result: not len(result[1]))
     def get_last_read_in_group_for_users(
         self, group_id: str, user_ids: List[int]
     ) -> Tuple[dict, list]:
@@ -100,6 +283,7 @@ class CacheRedis(ICache):
 
         return last_reads, not_cached
 
+    @instrumented("last_read_time")
     def get_last_read_in_group_for_user(
         self, group_id: str, user_id: int
     ) -> Optional[float]:
@@ -111,6 +295,7 @@ class CacheRedis(ICache):
 
         return float(str(last_read, "utf-8"))
 
+    @instrumented("last_read_time")
     def set_last_read_in_group_for_users(
         self, group_id: str, users: Dict[int, float]
     ) -> None:
@@ -122,16 +307,19 @@ class CacheRedis(ICache):
 
         p.execute()
 
+    @instrumented("last_read_time")
     def set_last_read_in_group_for_user(
         self, group_id: str, user_id: int, last_read: float
     ) -> None:
         key = RedisKeys.last_read_time(group_id)
         self.redis.hset(key, user_id, last_read)
 
+    @instrumented("last_read_time")
     def remove_last_read_in_group_for_user(self, group_id: str, user_id: int) -> None:
         key = RedisKeys.last_read_time(group_id)
         self.redis.hdel(key, user_id)
 
+    @instrumented("unread_in_group")
     def increase_unread_in_group_for(self, group_id: str, user_ids: List[int]) -> None:
         key = RedisKeys.unread_in_group(group_id)
         p = self.redis.pipeline()
@@ -141,10 +329,12 @@ class CacheRedis(ICache):
 
         p.execute()
 
+    @instrumented("user_message_status")
     def set_user_message_status(self, user_id: int, status: int) -> None:
         key = RedisKeys.user_message_status(user_id)
         self.redis.set(key, status)
 
+    @instrumented("user_message_status")
     def get_user_message_status(self, user_id: int):
         key = RedisKeys.user_message_status(user_id)
         value = self.redis.get(key)
@@ -154,6 +344,7 @@ class CacheRedis(ICache):
 
         return int(str(value, "utf-8"))
 
+    @instrumented("unread_in_group")
     def reset_unread_in_groups(self, user_id: int, group_ids: List[str]):
         p = self.redis.pipeline()
 
@@ -163,6 +354,7 @@ class CacheRedis(ICache):
 
         p.execute()
 
+    @instrumented("unread_in_group")
     def get_unread_in_group(self, group_id: str, user_id: int) -> Optional[int]:
         key = RedisKeys.unread_in_group(group_id)
 
@@ -175,11 +367,19 @@ class CacheRedis(ICache):
         except (TypeError, ValueError):
             return None
 
+    @instrumented("unread_in_group")
     def set_unread_in_group(self, group_id: str, user_id: int, unread: int) -> None:
         key = RedisKeys.unread_in_group(group_id)
         self.redis.hset(key, user_id, unread)
 
+    @instrumented("user_in_group", hit=bool)
     def get_user_count_in_group(self, group_id: str) -> Optional[int]:
+        if self.packed_membership:
+            n_bytes = self.redis.strlen(RedisKeys.user_in_group_packed(group_id))
+
+            if n_bytes > 0:
+                return (n_bytes - 1) // JOIN_TIME_PAIR_SIZE
+
         key = RedisKeys.user_in_group(group_id)
         n_users = self.redis.hlen(key)
 
@@ -188,6 +388,7 @@ class CacheRedis(ICache):
 
         return n_users
 
+    @instrumented("messages_in_group")
     def get_messages_in_group(self, group_id: str) -> (Optional[int], Optional[float]):
         key = RedisKeys.messages_in_group(group_id)
         messages_until = self.redis.get(key)
@@ -198,31 +399,211 @@ class CacheRedis(ICache):
         messages, until = str(messages_until, "utf-8").split("|")
         return int(messages), float(until)
 
+    @instrumented("last_message_time")
     def set_last_message_time_in_group(self, group_id: str, last_message_time: float):
         key = RedisKeys.last_message_time(group_id)
-        self.redis.set(key, last_message_time)
-        self.redis.expire(key, ONE_WEEK)
+        self.redis.set(key, last_message_time, ex=ONE_WEEK)
+
+        self._invalidate(key)
+        self._set(key, last_message_time)
+
+    @instrumented("message_sent")
+    def set_message_sent_in_group(
+        self, group_id: str, user_id: int, sent_time: float, receiver_ids: List[int]
+    ) -> None:
+        """
+        same as calling set_last_message_time_in_group(), set_last_read_in_group_for_user(),
+        set_last_sent_for_user(), set_hide_group(False), set_unread_in_group(0) for the sender,
+        increase_unread_in_group_for() for the receivers and increase_group_version(), but in
+        one round trip
+        """
+        last_message_time_key = RedisKeys.last_message_time(group_id)
+        last_sent = f"{group_id}:{sent_time}"
+
+        if self.scripts_enabled:
+            self.message_sent_script(
+                keys=[
+                    last_message_time_key,
+                    RedisKeys.last_read_time(group_id),
+                    RedisKeys.last_sent_time_user(user_id),
+                    RedisKeys.hide_group(group_id),
+                    RedisKeys.unread_in_group(group_id),
+                    RedisKeys.invalidation_version(),
+                    RedisKeys.group_version(group_id),
+                ],
+                args=[
+                    sent_time,
+                    ONE_WEEK,
+                    user_id,
+                    last_sent,
+                    RedisKeys.invalidation_channel(),
+                    *receiver_ids,
+                ],
+            )
+
+            self._del(last_message_time_key)
+        else:
+            self._set_message_sent_in_group_pipeline(
+                group_id, user_id, sent_time, receiver_ids, last_sent
+            )
+
+        self._set(last_message_time_key, sent_time)
+
+    def _set_message_sent_in_group_pipeline(
+        self, group_id: str, user_id: int, sent_time: float, receiver_ids: List[int], last_sent: str
+    ) -> None:
+        hide_key = RedisKeys.hide_group(group_id)
+        unread_key = RedisKeys.unread_in_group(group_id)
+        last_message_time_key = RedisKeys.last_message_time(group_id)
+
+        users_with_hide = self.redis.hkeys(hide_key)
+        p = self.redis.pipeline()
+
+        p.set(last_message_time_key, sent_time, ex=ONE_WEEK)
+        p.hset(RedisKeys.last_read_time(group_id), user_id, sent_time)
+        p.set(RedisKeys.last_sent_time_user(user_id), last_sent)
+
+        for user in users_with_hide:
+            p.hset(hide_key, user, "f")
+
+        p.hset(unread_key, user_id, 0)
+        for receiver_id in receiver_ids:
+            p.hincrby(unread_key, receiver_id, 1)
 
+        p.incr(RedisKeys.group_version(group_id))
+        p.expire(RedisKeys.group_version(group_id), ONE_WEEK)
+
+        p.execute()
+        self._invalidate(last_message_time_key)
+
+    @instrumented("group")
+    def get_group(self, group_id: str) -> Optional[GroupBase]:
+        group = self.redis.get(RedisKeys.group(group_id))
+        if group is None:
+            return None
+
+        return GroupBase.parse_raw(group)
+
+    @instrumented("group")
+    def set_group(self, group: GroupBase) -> None:
+        # not kept in the local tier, it changes on every message
+        self.redis.set(
+            RedisKeys.group(group.group_id),
+            group.json(exclude_none=True),
+            ex=ONE_HOUR
+        )
+
+    @instrumented("group")
+    def remove_group(self, group_id: str) -> None:
+        self.redis.delete(RedisKeys.group(group_id))
+
+    @instrumented("group_exists")
+    def get_1to1_group_exists(self, group_id: str) -> Optional[bool]:
+        """
+        :return: True or False if known, None if the database has to be checked
+        """
+        key = RedisKeys.group_exists(group_id)
+
+        if self._get(key) is not None:
+            return True
+
+        p = self.redis.pipeline()
+        p.get(key)
+        p.exists(RedisKeys.one_to_one_filter_loaded())
+        self.one_to_one_filter.check(p, group_id)
+        exists, filter_loaded, *bits = p.execute()
+
+        if exists is not None:
+            if exists == b"1":
+                self._set(key, True, ttl=ONE_HOUR)
+                return True
+
+            return False
+
+        # the filter can only be trusted once every existing group has been added
+        if filter_loaded and not BloomFilter.might_contain(bits):
+            return False
+
+        return None
+
+    @instrumented("group_exists")
+    def set_1to1_group_exists(self, group_id: str, exists: bool) -> None:
+        key = RedisKeys.group_exists(group_id)
+
+        if exists:
+            self.redis.set(key, "1", ex=ONE_WEEK)
+            self._set(key, True, ttl=ONE_HOUR)
+        else:
+            self.redis.set(key, "0", ex=self.negative_ttl)
+
+    @instrumented("group_exists")
+    def add_1to1_group(self, group_id: str) -> None:
+        key = RedisKeys.group_exists(group_id)
+
+        p = self.redis.pipeline()
+        self.one_to_one_filter.add(p, group_id)
+        p.set(key, "1", ex=ONE_WEEK)
+        p.execute()
+
+        self._set(key, True, ttl=ONE_HOUR)
+
+    @instrumented("one_to_one_filter")
+    def add_1to1_groups_to_filter(self, group_ids: List[str]) -> None:
+        p = self.redis.pipeline()
+
+        for group_id in group_ids:
+            self.one_to_one_filter.add(p, group_id)
+
+        p.execute()
+
+    @instrumented("one_to_one_filter")
+    def claim_1to1_group_filter_load(self) -> bool:
+        """
+        only one worker needs to load the filter; returns True if it's this one
+        """
+        if self.redis.exists(RedisKeys.one_to_one_filter_loaded()):
+            return False
+
+        return bool(self.redis.set(RedisKeys.one_to_one_filter_loading(), "1", nx=True, ex=ONE_HOUR))
+
+    @instrumented("one_to_one_filter")
+    def set_1to1_group_filter_loaded(self) -> None:
+        self.redis.set(RedisKeys.one_to_one_filter_loaded(), "1")
+        self.redis.delete(RedisKeys.one_to_one_filter_loading())
+
+    def get_stale_last_message_time_in_group(self, group_id: str) -> Optional[float]:
+        return self.cache.get_stale(RedisKeys.last_message_time(group_id))
+
+    @instrumented("last_message_time")
     def get_last_message_time_in_group(self, group_id: str):
         key = RedisKeys.last_message_time(group_id)
-        last_message_time = self.redis.get(key)
 
+        last_message_time = self._get(key)
+        if last_message_time is not None:
+            return last_message_time
+
+        last_message_time = self.redis.get(key)
         if last_message_time is None:
             return None
 
-        return float(str(last_message_time, "utf-8"))
+        last_message_time = float(str(last_message_time, "utf-8"))
+        self._set(key, last_message_time)
+
+        return last_message_time
 
+    @instrumented("count_group_types")
     def reset_count_group_types_for_user(self, user_id: int) -> None:
-        key = RedisKeys.count_group_types_including_hidden(user_id)
-        self.redis.delete(key)
+        key = RedisKeys.count_group_types(user_id)
 
-        key = RedisKeys.count_group_types_not_including_hidden(user_id)
         self.redis.delete(key)
+        self._invalidate(key)
 
+    @instrumented("last_sent_time_user")
     def set_last_sent_for_user(self, user_id: int, group_id: str, last_time: float) -> None:
         key = RedisKeys.last_sent_time_user(user_id)
         self.redis.set(key, f"{group_id}:{last_time}")
 
+    @instrumented("last_sent_time_user")
     def get_last_sent_for_user(self, user_id: int) -> (str, float):
         key = RedisKeys.last_sent_time_user(user_id)
         values = self.redis.get(key)
@@ -232,139 +613,389 @@ class CacheRedis(ICache):
         group_id, last_time = str(values, "utf-8").split(":", maxsplit=1)
         return group_id, float(last_time)
 
-    def set_count_group_types_for_user(self, user_id: int, counts: List[Tuple[int, int]], hidden: bool) -> None:
-        if hidden:
-            key = RedisKeys.count_group_types_including_hidden(user_id)
-        else:
-            key = RedisKeys.count_group_types_not_including_hidden(user_id)
+    @instrumented("count_group_types")
+    def set_count_group_types_for_user(self, user_id: int, counts: List[Tuple[bool, int, int]]) -> None:
+        """
+        :param counts: a list of (hidden, group_type, count)
+        """
+        key = RedisKeys.count_group_types(user_id)
 
-        types = ",".join([":".join(map(str, values)) for values in counts])
+        p = self.redis.pipeline()
+        p.delete(key)
+        p.hset(key, GROUP_TYPES_INITIALIZED, 1)
 
-        self.redis.set(key, types)
-        self.redis.expire(key, ONE_DAY)
+        for hidden, group_type, count in counts:
+            p.hset(key, f"{int(hidden)}:{group_type}", count)
 
-    def get_count_group_types_for_user(self, user_id: int, hidden: bool) -> Optional[List[Tuple[int, int]]]:
-        if hidden is None:
-            return None
+        p.expire(key, ONE_WEEK)
+        p.execute()
+
+        self._invalidate(key)
+
+    @instrumented("count_group_types")
+    def increase_count_group_types_for_user(self, user_id: int, deltas: Dict[Tuple[bool, int], int]) -> None:
+        """
+        :param deltas: change in count for each (hidden, group_type)
+        """
+        deltas = {
+            f"{int(hidden)}:{group_type}": delta
+            for (hidden, group_type), delta in deltas.items()
+            if delta != 0
+        }
+
+        if not len(deltas):
+            return
+
+        key = RedisKeys.count_group_types(user_id)
+
+        if self.scripts_enabled:
+            args = [RedisKeys.invalidation_channel()]
+            for field, delta in deltas.items():
+                args.extend([field, delta])
+
+            self.increase_group_types_script(
+                keys=[key, RedisKeys.invalidation_version()], args=args
+            )
+            self._del(key)
 
-        if hidden:
-            key = RedisKeys.count_group_types_including_hidden(user_id)
         else:
-            key = RedisKeys.count_group_types_not_including_hidden(user_id)
+            if self.redis.exists(key):
+                p = self.redis.pipeline()
+                for field, delta in deltas.items():
+                    p.hincrby(key, field, delta)
+                p.execute()
 
-        count = self.redis.get(key)
-        if count is None:
-            return None
+            self._invalidate(key)
 
-        types = str(count, "utf-8")
+        # the reconciliation job recounts users with changes, in case of drift
+        self.redis.sadd(RedisKeys.count_group_types_changed(), user_id)
 
-        # TODO: log and check this, was blank in redis once
-        if len(types) == 0 or "," not in types:
-            logger.warning(f"group types was none in cache for key {key}")
-            return None
+    @instrumented("count_group_types_changed", hit=bool)
+    def get_users_with_changed_group_type_counts(self, max_users: int) -> List[int]:
+        key = RedisKeys.count_group_types_changed()
+        user_ids = list()
 
-        types = types.split(",")
-        types = [
-            group_type.split(":", maxsplit=1)
-            for group_type in types
-        ]
+        for user_id in self.redis.sscan_iter(key, count=1_000):
+            user_ids.append(user_id)
+
+            if len(user_ids) >= max_users:
+                break
+
+        if len(user_ids):
+            self.redis.srem(key, *user_ids)
+
+        return [int(user_id) for user_id in user_ids]
+
+    @instrumented("count_group_types")
+    def get_count_group_types_for_user(self, user_id: int, hidden: Optional[bool]) -> Optional[List[Tuple[int, int]]]:
+        """
+        :param hidden: only count hidden groups if True, only visible if False, or all if None
+        :return: a list of (group_type, count), or None if not cached
+        """
+        key = RedisKeys.count_group_types(user_id)
 
-        return [(int(a), int(b)) for a, b in types]
+        # every change to the counters evicts the local copy in all workers
+        counts = self._get(key)
 
+        if counts is None:
+            counts = self.redis.hgetall(key)
+            if not len(counts):
+                return None
+
+            counts = {
+                str(field, "utf-8"): int(count)
+                for field, count in counts.items()
+            }
+            self._set(key, counts)
+
+        types = dict()
+
+        for field, count in counts.items():
+            if field == GROUP_TYPES_INITIALIZED:
+                continue
+
+            is_hidden, group_type = field.split(":", maxsplit=1)
+            if hidden is not None and bool(int(is_hidden)) != hidden:
+                continue
+
+            group_type = int(group_type)
+            types[group_type] = types.get(group_type, 0) + count
+
+        return [
+            (group_type, count)
+            for group_type, count in sorted(types.items())
+            if count > 0
+        ]
+
+    @instrumented("messages_in_group")
     def set_messages_in_group(self, group_id: str, n_messages: int, until: float) -> None:
         key = RedisKeys.messages_in_group(group_id)
         messages_until = f"{n_messages}|{until}"
 
         self.redis.set(key, messages_until)
 
+    @instrumented("user_in_group", hit=lambda result: len(result) > 0)
     def get_user_ids_and_join_time_in_groups(self, group_ids: List[str]):
         join_times = dict()
+        not_cached = list()
 
-        p = self.redis.pipeline()
         for group_id in group_ids:
-            p.hgetall(RedisKeys.user_in_group(group_id))
+            users = self._get(RedisKeys.user_in_group(group_id))
 
-        for group_id, users in zip(group_ids, p.execute()):
-            if not len(users):
-                continue
+            if users is None:
+                not_cached.append(group_id)
+            else:
+                join_times[group_id] = dict(users)
 
-            join_times[group_id] = {
-                int(user_id): float(join_time)
-                for user_id, join_time in users.items()
-            }
+        if not len(not_cached):
+            return join_times
+
+        for group_id, users in self._get_join_times_from_redis(not_cached).items():
+            self._set(RedisKeys.user_in_group(group_id), users)
+            join_times[group_id] = dict(users)
 
         return join_times
 
+    @instrumented("user_in_group")
     def set_user_ids_and_join_time_in_groups(
         self, group_users: Dict[str, Dict[int, float]]
     ):
         p = self.redis.pipeline()
 
         for group_id, users in group_users.items():
-            key = RedisKeys.user_in_group(group_id)
-            self.redis.delete(key)
-
-            if len(users):
-                for user_id, join_time in users.items():
-                    p.hset(key, str(user_id), str(join_time))
-                p.expire(key, ONE_DAY)
+            self._set_join_times_in_pipeline(p, group_id, users, ONE_DAY)
 
         p.execute()
 
+    @instrumented("user_in_group")
     def get_user_ids_and_join_time_in_group(
         self, group_id: str
     ) -> Optional[Dict[int, float]]:
-        users = self.redis.hgetall(RedisKeys.user_in_group(group_id))
+        key = RedisKeys.user_in_group(group_id)
 
-        if not len(users):
+        # callers modify the returned dict, so never hand out the cached instance
+        users = self._get(key)
+        if users is not None:
+            return dict(users)
+
+        users = self._get_join_times_from_redis([group_id]).get(group_id)
+        if users is None:
+            return None
+
+        self._set(key, users)
+
+        return dict(users)
+
+    def get_stale_user_ids_and_join_time_in_group(
+        self, group_id: str
+    ) -> Optional[Dict[int, float]]:
+        users = self.cache.get_stale(RedisKeys.user_in_group(group_id))
+        if users is None:
             return None
 
-        return {int(user_id): float(join_time) for user_id, join_time in users.items()}
+        return dict(users)
 
+    @instrumented("user_in_group")
     def set_user_ids_and_join_time_in_group(
         self, group_id: str, users: Dict[int, float]
     ):
-        key = RedisKeys.user_in_group(group_id)
-        self.redis.delete(key)
-
-        if len(users):
-            self.add_user_ids_and_join_time_in_group(group_id, users)
-            self.redis.expire(key, ONE_HOUR)
+        p = self.redis.pipeline()
+        self._set_join_times_in_pipeline(p, group_id, users, ONE_HOUR)
+        p.execute()
 
+    @instrumented("user_in_group")
     def add_user_ids_and_join_time_in_group(
-        self, group_id: str, users: Dict[int, float]
+        self, group_id: str, users: Dict[int, float], last_reads: Dict[int, float] = None
     ) -> None:
+        """
+        :param last_reads: optionally also set the last read time of the users
+        """
         key = RedisKeys.user_in_group(group_id)
         p = self.redis.pipeline()
 
-        for user_id, join_time in users.items():
-            p.hset(key, str(user_id), str(join_time))
+        if self.packed_membership:
+            # merging into the packed value would need a read-modify-write that
+            # could drop a concurrent join, so just let the next read refill it
+            p.delete(RedisKeys.user_in_group_packed(group_id), key)
+        else:
+            for user_id, join_time in users.items():
+                p.hset(key, str(user_id), str(join_time))
+
+            p.expire(key, ONE_DAY)
+
+        if last_reads is not None:
+            last_read_key = RedisKeys.last_read_time(group_id)
+
+            for user_id, last_read in last_reads.items():
+                p.hset(last_read_key, user_id, last_read)
 
-        p.expire(key, ONE_DAY)
         p.execute()
 
+        # we don't know if the local copy was complete, let the next read refill it
+        self._invalidate(key)
+
+    @instrumented("user_in_group")
     def clear_user_ids_and_join_time_in_group(self, group_id: str) -> None:
         key = RedisKeys.user_in_group(group_id)
-        self.redis.delete(key)
+        self.redis.delete(key, RedisKeys.user_in_group_packed(group_id))
+        self._invalidate(key)
+
+    def _set_join_times_in_pipeline(self, p, group_id: str, users: Dict[int, float], ttl: int) -> None:
+        key = RedisKeys.user_in_group(group_id)
+        packed_key = RedisKeys.user_in_group_packed(group_id)
+
+        p.delete(key, packed_key)
+        self._del(key)
+
+        if not len(users):
+            return
+
+        if self.packed_membership:
+            p.set(packed_key, pack_join_times(users), ex=ttl)
+        else:
+            for user_id, join_time in users.items():
+                p.hset(key, str(user_id), str(join_time))
+            p.expire(key, ttl)
+
+        self._set(key, dict(users))
+
+    def _get_join_times_from_redis(self, group_ids: List[str]) -> Dict[str, Dict[int, float]]:
+        join_times = dict()
+
+        if self.packed_membership:
+            p = self.redis.pipeline()
+            for group_id in group_ids:
+                p.get(RedisKeys.user_in_group_packed(group_id))
+
+            not_packed = list()
 
+            for group_id, packed in zip(group_ids, p.execute()):
+                users = unpack_join_times(packed)
+
+                if users is None:
+                    not_packed.append(group_id)
+                else:
+                    join_times[group_id] = users
+
+            # a value still in the old hash layout isn't converted, a join or leave
+            # between reading and converting it would be overwritten; it's removed
+            # and refilled from the database like any other miss instead
+            if len(not_packed):
+                self.redis.delete(*[RedisKeys.user_in_group(group_id) for group_id in not_packed])
+
+            return join_times
+
+        p = self.redis.pipeline()
+        for group_id in group_ids:
+            p.hgetall(RedisKeys.user_in_group(group_id))
+
+        for group_id, users in zip(group_ids, p.execute()):
+            if not len(users):
+                continue
+
+            join_times[group_id] = {
+                int(user_id): float(join_time)
+                for user_id, join_time in users.items()
+            }
+
+        return join_times
+
+    @instrumented("hide_group")
     def set_hide_group(
         self, group_id: str, hide: bool, user_ids: List[int] = None
     ) -> None:
         key = RedisKeys.hide_group(group_id)
 
         if user_ids is None:
-            users = [str(user, "utf-8") for user in self.redis.hgetall(key)]
+            users = self.redis.hkeys(key)
         else:
             users = user_ids
 
+        if not len(users):
+            return
+
+        p = self.redis.pipeline()
         for user in users:
-            self.redis.hset(key, user, "t" if hide else "f")
+            p.hset(key, user, "t" if hide else "f")
+
+        p.execute()
+
+    @instrumented("primary_pin")
+    def pin_users_to_primary(self, user_ids: List[int], ttl: int) -> None:
+        """
+        reads for these users go to the primary database for `ttl` seconds, so
+        they see their own writes even if the read replicas are lagging behind
+        """
+        p = self.redis.pipeline()
+        for user_id in user_ids:
+            p.set(RedisKeys.primary_pin(user_id), "1", ex=ttl)
+
+        p.execute()
+
+    @instrumented("primary_pin")
+    def is_user_pinned_to_primary(self, user_id: int) -> bool:
+        return self.redis.exists(RedisKeys.primary_pin(user_id)) > 0
 
     @property
     def redis(self):
+        return self.redis_instance
+
+    def pool_stats(self) -> Dict[str, int]:
+        if self.redis_pool is None:
+            return dict()
+
+        created = len(self.redis_pool._connections)  # noqa
+        available = len([c for c in self.redis_pool.pool.queue if c is not None])
+
+        return {
+            "size": self.redis_pool.max_connections,
+            "created": created,
+            "in_use": created - available,
+            "available": available,
+        }
+
+    def debug_stats(self) -> dict:
+        return {
+            "families": self.metrics.to_dict(),
+            "local": {
+                "size": self.cache.size(),
+                "max_size": self.cache.max_size,
+                "hits": self.cache.hits,
+                "misses": self.cache.misses,
+            },
+            "pool": self.pool_stats(),
+            "invalidation_version": self.invalidation_listener.last_version,
+        }
+
+    def start_invalidation_listener(self) -> None:
+        if self.invalidation_enabled and self.redis_pool is not None:
+            self.invalidation_listener.start()
+
+    def flush_local(self) -> None:
+        self.cache.flushall()
+
+    def _invalidate(self, *keys: str) -> None:
+        """
+        evict keys from the local tier in this worker, and tell all other
+        workers to do the same
+        """
+        for key in keys:
+            self._del(key)
+
+        if not self.invalidation_enabled:
+            return
+
+        keys = ",".join(keys)
+
+        # fakeredis can't run lua scripts
         if self.redis_pool is None:
-            return self.redis_instance
-        return redis.Redis(connection_pool=self.redis_pool)
+            version = self.redis.incr(RedisKeys.invalidation_version())
+            self.redis.publish(RedisKeys.invalidation_channel(), f"{version}|{keys}")
+        else:
+            self.invalidate_script(
+                keys=[RedisKeys.invalidation_version()],
+                args=[RedisKeys.invalidation_channel(), keys],
+            )
 
     def _flushall(self) -> None:
         self.redis.flushdb()
@@ -372,7 +1003,7 @@ class CacheRedis(ICache):
 
     def _set(self, key, val, ttl=None) -> None:
         if ttl is None:
-            self.cache.set(key, val)
+            self.cache.set(key, val, ttl=self.local_ttl)
         else:
             self.cache.set(key, val, ttl=ttl)
 
@@ -381,3 +1012,69 @@ class CacheRedis(ICache):
 
     def _del(self, key) -> None:
         self.cache.delete(key)
+
+    @instrumented("user_stats")
+    def get_user_stats(self, user_id: int, query_key: str) -> Optional[UserStats]:
+        """
+        the stats are only used if none of the user's groups has changed since they
+        were counted, i.e. all group versions are the same as when they were cached
+
+        :param query_key: the variant of the stats, they depend on the query
+        """
+        cached = self.redis.hget(RedisKeys.user_stats(user_id), query_key)
+        if cached is None:
+            return None
+
+        cached = json.loads(cached)
+        versions = cached["versions"]
+
+        if len(versions) and self.get_group_versions(list(versions.keys())) != list(versions.values()):
+            return None
+
+        return UserStats.parse_obj(cached["stats"])
+
+    @instrumented("user_stats")
+    def set_user_stats(self, user_id: int, query_key: str, stats: UserStats, versions: Dict[str, int]) -> None:
+        """
+        :param versions: the versions of all the user's groups, from get_group_versions()
+                         before the stats were counted
+        """
+        key = RedisKeys.user_stats(user_id)
+        cached = json.dumps({"versions": versions, "stats": stats.dict()})
+
+        # the ttl limits how long the stats can be wrong if a change doesn't reset them
+        p = self.redis.pipeline()
+        p.hset(key, query_key, cached)
+        p.expire(key, FIVE_MINUTES)
+        p.execute()
+
+    def get_group_versions(self, group_ids: List[str]) -> List[int]:
+        if not len(group_ids):
+            return list()
+
+        versions = self.redis.mget([RedisKeys.group_version(group_id) for group_id in group_ids])
+        return [0 if version is None else int(version) for version in versions]
+
+    def increase_group_version(self, group_id: str) -> None:
+        """
+        called when something changes in a group that the cached /userstats of its
+        members depend on; the same for every group size, instead of resetting the
+        stats of each member
+        """
+        key = RedisKeys.group_version(group_id)
+
+        p = self.redis.pipeline()
+        p.incr(key)
+        p.expire(key, ONE_WEEK)
+        p.execute()
+
+    @instrumented("user_stats")
+    def reset_user_stats(self, user_ids: List[int]) -> None:
+        """
+        called for users whose stats changed without a change to one of their groups,
+        e.g. when they read a group, or when they join one
+        """
+        if not len(user_ids):
+            return
+
+        self.redis.delete(*[RedisKeys.user_stats(user_id) for user_id in user_ids])
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import Optional
+from typing import TypeVar
+from uuid import uuid4 as uuid
+
+from dinofw.cache import ICache
+from dinofw.utils.config import ConfigKeys
+from dinofw.utils.config import RedisKeys
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[Exception] = None
+
+
+class SingleFlight:
+    """
+    Makes sure only one caller at a time fills a cache key from the database. When
+    a popular key expires, every concurrent request would otherwise miss at once and
+    run the same query; instead the first caller (the leader) runs it, and the
+    others wait for and share its result.
+
+    If the caller has a stale copy of the value (e.g. from the local cache tier) it
+    is returned immediately when a fill is already running, instead of waiting.
+
+    Across processes an optional redis lock (SET NX PX) is used; a worker that
+    doesn't get the lock polls the cache until the lock holder has filled it, and
+    runs the fill itself if that takes longer than `fill_lock_wait` millis.
+    """
+
+    POLL_INTERVAL = 0.02
+
+    def __init__(self, env):
+        self.env = env
+        self.flights: Dict[str, Flight] = dict()
+        self.lock = threading.Lock()
+
+        cache_conf = env.config.get(ConfigKeys.CACHE_SERVICE, default=dict()) or dict()
+
+        fill_lock = cache_conf.get(ConfigKeys.FILL_LOCK, False)
+        self.lock_enabled = str(fill_lock).strip().lower() in ["yes", "1", "true"]
+        self.lock_ttl = int(cache_conf.get(ConfigKeys.FILL_LOCK_TTL, 5_000))
+        self.lock_wait = int(cache_conf.get(ConfigKeys.FILL_LOCK_WAIT, 500)) / 1000
+
+    def do(
+        self,
+        key: str,
+        fill: Callable[[], T],
+        stale: Optional[T] = None,
+        check: Optional[Callable[[], Optional[T]]] = None,
+    ) -> T:
+        """
+        :param key: identifies the value being filled, e.g. the redis key
+        :param fill: queries the database, updates the cache and returns the value
+        :param stale: expired value to serve while another caller is filling
+        :param check: reads the value from the cache; used while waiting for a fill
+                      running in another process
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            is_leader = flight is None
+
+            if is_leader:
+                flight = Flight()
+                self.flights[key] = flight
+
+        if not is_leader:
+            if stale is not None:
+                return stale
+
+            return self._wait(key, flight, fill)
+
+        try:
+            flight.result = self._fill(key, fill, stale, check)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+        return flight.result
+
+    def _wait(self, key: str, flight: Flight, fill: Callable[[], T]) -> T:
+        if not flight.done.wait(timeout=self.lock_ttl / 1000):
+            logger.warning(f"fill for {key} is taking too long, filling it again")
+            return fill()
+
+        if flight.error is not None:
+            raise flight.error
+
+        return flight.result
+
+    def _fill(
+        self,
+        key: str,
+        fill: Callable[[], T],
+        stale: Optional[T],
+        check: Optional[Callable[[], Optional[T]]],
+    ) -> T:
+        if not self.lock_enabled or not isinstance(self.env.cache, ICache):
+            return fill()
+
+        lock_key = RedisKeys.fill_lock(key)
+        token = str(uuid())
+
+        if self.env.cache.redis.set(lock_key, token, nx=True, px=self.lock_ttl):
+            try:
+                return fill()
+            finally:
+                self._release(lock_key, token)
+
+        # another process is filling it
+        if stale is not None:
+            return stale
+
+        if check is not None:
+            give_up_at = time.monotonic() + self.lock_wait
+
+            while time.monotonic() < give_up_at:
+                time.sleep(SingleFlight.POLL_INTERVAL)
+
+                value = check()
+                if value is not None:
+                    return value
+
+        return fill()
+
+    def _release(self, lock_key: str, token: str) -> None:
+        # only release our own lock; if the fill took longer than the lock ttl
+        # another process might hold it by now
+        current = self.env.cache.redis.get(lock_key)
+
+        if current is not None and str(current, "utf-8") == token:
+            self.env.cache.redis.delete(lock_key)
@@ -31,5 +31,12 @@ class Deleter:
 
             self.env.db.update_first_message_time(group_id, delete_before, session)
 
+    def reconcile_group_type_counts(self):
+        logger.info("recounting group types for users with changed counters...")
+        session = environ.env.SessionLocal()
+
+        n_users = self.env.db.reconcile_group_type_counts(session)
+        logger.info(f"recounted group types for {n_users} users")
+
 
 app = Deleter(environ.env)
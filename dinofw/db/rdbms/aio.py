@@ -0,0 +1,41 @@
+import logging
+
+from dinofw.utils.config import ConfigKeys
+from dinofw.utils.executor import ExecutorProxy
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRelationalHandler(ExecutorProxy):
+    """
+    Awaitable version of the RelationalHandler; every method of the wrapped
+    handler can be awaited through this class, with the same arguments, e.g.:
+
+        user_stats = await self.env.async_db.get_user_stats_in_group(group_id, user_id, db)
+
+    The queries run in a thread pool the size of the connection pool (including
+    overflow connections, see database.py), so a slow query only blocks its own
+    request instead of the event loop. A session is only used by one request,
+    and the request awaits each call before making the next one, so a session
+    is never used by two threads at the same time.
+    The sync handler (env.db) is still used by the cron jobs and background tasks.
+    """
+
+    wait_stat = "db.executor.wait"
+
+    def __init__(self, env, db):
+        self.db = db
+
+        db_conf = env.config.get(ConfigKeys.DB, default=dict()) or dict()
+        max_workers = (
+            int(db_conf.get(ConfigKeys.POOL_SIZE, 5)) +
+            int(db_conf.get(ConfigKeys.MAX_OVERFLOW, 10))
+        )
+
+        super().__init__(env, max_workers=max_workers, thread_name_prefix="db")
+
+    def _wrapped(self):
+        return self.db
+
+    def _report_gauges(self) -> None:
+        self.env.stats.gauge("db.executor.in_flight", self.n_in_flight)
@@ -1,26 +1,159 @@
+import logging
+import random
+import time
+from typing import List
+
 from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
+from dinofw.db.rdbms.migrations import check_schema
+from dinofw.utils import environ
 from dinofw.utils.config import ConfigKeys
 
+logger = logging.getLogger(__name__)
 
-def init_db(env, engine=None):
-    if engine is None:
-        database_uri = env.config.get(ConfigKeys.URI, domain=ConfigKeys.DB)
 
-        if database_uri.startswith("sqlite"):
-            connection_args = {"check_same_thread": False}
-        else:
-            connection_args = {"options": "-c timezone=utc"}
+class InstrumentedQueuePool(QueuePool):
+    """
+    reports how long requests wait for a connection to be checked out from the
+    pool, and how often they time out waiting; sqlalchemy has no event for it
+    """
+
+    STATS_PREFIX = "db.pool"
+
+    def _do_get(self):
+        before = time.monotonic()
+
+        try:
+            return super()._do_get()
+        except Exception:
+            if environ.env.stats is not None:
+                environ.env.stats.incr(f"{self.STATS_PREFIX}.timeout")
+            raise
+        finally:
+            if environ.env.stats is not None:
+                environ.env.stats.timing(f"{self.STATS_PREFIX}.wait", (time.monotonic() - before) * 1000)
+
+
+class InstrumentedReplicaPool(InstrumentedQueuePool):
+    STATS_PREFIX = "db.replica.pool"
+
+
+class PoolStats:
+    """
+    reports the number of checked out and overflow connections to statsd, at
+    most every STATS_INTERVAL seconds since it's triggered on every checkout
+    """
+
+    STATS_INTERVAL = 10
+
+    def __init__(self, env, pool):
+        self.env = env
+        self.pool = pool
+        self.last_stats = 0.0
+
+        event.listen(pool, "checkout", self.on_checkout)
+        event.listen(pool, "connect", self.on_connect)
+
+    def on_checkout(self, *_):
+        if self.env.stats is None:
+            return
+
+        now = time.monotonic()
+        if now - self.last_stats < PoolStats.STATS_INTERVAL:
+            return
+
+        self.last_stats = now
+        prefix = self.pool.STATS_PREFIX
+
+        self.env.stats.gauge(f"{prefix}.size", self.pool.size())
+        self.env.stats.gauge(f"{prefix}.checked_out", self.pool.checkedout())
+        self.env.stats.gauge(f"{prefix}.overflow", max(0, self.pool.overflow()))
+
+    def on_connect(self, *_):
+        # new connections after startup are either overflow or replacing recycled ones
+        if self.env.stats is not None:
+            self.env.stats.incr(f"{self.pool.STATS_PREFIX}.connect")
+
 
-        engine = create_engine(
+def create_engine_from_config(env, database_uri: str, poolclass=InstrumentedQueuePool):
+    db_conf = env.config.get(ConfigKeys.DB, default=dict()) or dict()
+
+    if database_uri.startswith("sqlite"):
+        return create_engine(
             database_uri,
-            connect_args=connection_args,
+            connect_args={"check_same_thread": False},
             echo=False,
         )
 
+    # pgbouncer doesn't accept startup parameters such as `options`, so the timezone
+    # has to be set on the database instead (ALTER DATABASE ... SET timezone TO 'UTC')
+    pgbouncer = db_conf.get(ConfigKeys.PGBOUNCER, False)
+
+    if str(pgbouncer).strip().lower() in ["yes", "1", "true"]:
+        connection_args = dict()
+    else:
+        connection_args = {"options": "-c timezone=utc"}
+
+    pre_ping = db_conf.get(ConfigKeys.POOL_PRE_PING, False)
+
+    engine = create_engine(
+        database_uri,
+        connect_args=connection_args,
+        echo=False,
+        poolclass=poolclass,
+        pool_size=int(db_conf.get(ConfigKeys.POOL_SIZE, 5)),
+        max_overflow=int(db_conf.get(ConfigKeys.MAX_OVERFLOW, 10)),
+        pool_timeout=int(db_conf.get(ConfigKeys.POOL_TIMEOUT, 30)),
+        pool_recycle=int(db_conf.get(ConfigKeys.POOL_RECYCLE, -1)),
+        pool_pre_ping=str(pre_ping).strip().lower() in ["yes", "1", "true"],
+    )
+
+    PoolStats(env, engine.pool)
+    logger.info(f"database pool: {engine.pool.status()}")
+
+    return engine
+
+
+def replica_uris(env) -> List[str]:
+    db_conf = env.config.get(ConfigKeys.DB, default=dict()) or dict()
+    replicas = db_conf.get(ConfigKeys.REPLICAS) or list()
+
+    # a comma separated string if set from an environment variable
+    if isinstance(replicas, str):
+        replicas = replicas.split(",")
+
+    return [uri.strip() for uri in replicas if uri.strip()]
+
+
+def init_db(env, engine=None):
+    if engine is None:
+        engine = create_engine_from_config(
+            env, env.config.get(ConfigKeys.URI, domain=ConfigKeys.DB)
+        )
+
     env.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    # methods in RelationalHandler decorated with @read_replica use these if set
+    replica_makers = [
+        sessionmaker(
+            autocommit=False,
+            autoflush=False,
+            bind=create_engine_from_config(env, uri, poolclass=InstrumentedReplicaPool),
+        )
+        for uri in replica_uris(env)
+    ]
+
+    if len(replica_makers):
+        env.ReplicaSessionLocal = lambda: random.choice(replica_makers)()
+    else:
+        env.ReplicaSessionLocal = None
     env.Base = declarative_base()
 
+    # tables and indexes are created by migrate.py; create_all() never changes
+    # existing tables, so refuse to start if the schema is older than the code
+    check_schema(engine)
     env.Base.metadata.create_all(bind=engine)
@@ -1,5 +1,7 @@
 import logging
+import threading
 from datetime import datetime as dt
+from hashlib import sha1
 from typing import Dict
 from typing import List
 from typing import Optional
@@ -7,13 +9,23 @@ from typing import Tuple
 from uuid import uuid4 as uuid
 
 import arrow
+from sqlalchemy import and_
 from sqlalchemy import case
 from sqlalchemy import func
 from sqlalchemy import literal
 from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import tuple_
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
+from dinofw.cache.singleflight import SingleFlight
 from dinofw.db.rdbms import models
+from dinofw.db.rdbms.routing import pins_to_primary
+from dinofw.db.rdbms.routing import read_replica
+from dinofw.db.rdbms.routing import reading_from_replica
 from dinofw.db.rdbms.schemas import GroupBase
 from dinofw.db.rdbms.schemas import UserGroupBase
 from dinofw.db.rdbms.schemas import UserGroupStatsBase
@@ -25,11 +37,12 @@ from dinofw.rest.models import GroupUpdatesQuery
 from dinofw.rest.models import UpdateGroupQuery
 from dinofw.rest.models import UpdateUserGroupStats
 from dinofw.utils import group_id_to_users
-from dinofw.utils import split_into_chunks
 from dinofw.utils import trim_micros
+from dinofw.utils import unread_from_seq
 from dinofw.utils import users_to_group_id
 from dinofw.utils import utcnow_dt
 from dinofw.utils import utcnow_ts
+from dinofw.utils.config import ConfigKeys
 from dinofw.utils.config import GroupTypes
 from dinofw.utils.decorators import time_method
 from dinofw.utils.exceptions import NoSuchGroupException
@@ -37,6 +50,15 @@ from dinofw.utils.exceptions import UserNotInGroupException
 
 logger = logging.getLogger(__name__)
 
+# the columns of the base schemas in the same order as their fields; hot paths
+# select these instead of the entities, so no ORM objects are loaded, see _to_base()
+GROUP_BASE_COLUMNS = [
+    getattr(models.GroupEntity, field) for field in GroupBase.__fields__
+]
+USER_STATS_BASE_COLUMNS = [
+    getattr(models.UserGroupStatsEntity, field) for field in UserGroupStatsBase.__fields__
+]
+
 
 class RelationalHandler:
     def __init__(self, env):
@@ -46,19 +68,21 @@ class RelationalHandler:
         beginning_of_1995 = 789_000_000
         self.long_ago = dt.utcfromtimestamp(beginning_of_1995)
 
+        # concurrent cache misses for the same key share one query
+        self.single_flight = SingleFlight(env)
+
+        # groups with more users than this only update the group row when a message
+        # is sent, instead of the stats of every user, see update_group_new_message()
+        db_conf = env.config.get(ConfigKeys.DB, default=dict()) or dict()
+        self.fanout_max_users = int(db_conf.get(ConfigKeys.FANOUT_MAX_USERS, 100))
+
+        # seconds a user reads from the primary after writing, see routing.py
+        self.replica_pin_ttl = int(db_conf.get(ConfigKeys.REPLICA_PIN_TTL, 5))
+
     def get_users_in_group(
         self, group_id: str, db: Session
     ) -> (Optional[GroupBase], Optional[Dict[int, float]], Optional[int]):
-        group_entity = (
-            db.query(models.GroupEntity)
-            .filter(models.GroupEntity.group_id == group_id)
-            .first()
-        )
-
-        if group_entity is None:
-            raise NoSuchGroupException(group_id)
-
-        group = GroupBase(**group_entity.__dict__)
+        group = self.get_group_from_id(group_id, db)
         users_and_join_time = self.get_user_ids_and_join_time_in_group(group_id, db)
         user_count = len(users_and_join_time)
 
@@ -75,7 +99,7 @@ class RelationalHandler:
                 models.UserGroupStatsEntity.last_sent
             )
             .filter(models.UserGroupStatsEntity.user_id == user_id)
-            .order_by(models.UserGroupStatsEntity.last_sent)
+            .order_by(models.UserGroupStatsEntity.last_sent.desc())
             .limit(1)
             .first()
         )
@@ -108,6 +132,7 @@ class RelationalHandler:
 
         return groups
 
+    @read_replica()
     def get_groups_for_user(
         self,
         user_id: int,
@@ -131,36 +156,87 @@ class RelationalHandler:
             g.group_id = '9be68f8c-6610-454f-815c-de8a92fc75e2'
         order by
             u.pin desc,
-            greatest(u.highlight_time, g.last_message_time) desc
+            u.sort_time desc,
+            u.group_id desc
         limit 10;
+
+        sort_time is greatest(u.highlight_time, g.last_message_time), and if
+        `query.cursor` is specified, the rows after (pin, sort_time, group_id) of
+        the cursor are returned instead of filtering on `until`, so the index on
+        (user_id, pin, sort_time, group_id) can be used for paging (a partial
+        index where hide = false if hidden groups aren't included)
+
+        stats inserted by servers from before sort_time existed don't have one
+        until the next message (or migration) sets it; the sort key falls back to
+        the value it would have had, in both the cursor filter and the ordering,
+        since postgres sorts nulls first for `desc` and the tuple comparison
+        would skip those rows
+
+        the stats of groups with a watermark aren't updated for each message, so
+        those are queried separately using the derived values, and the two pages
+        are merged; a user is usually only in a few large groups
         """
         @time_method(logger, "get_groups_for_user(): query groups")
-        def query_groups():
-            until = GroupQuery.to_dt(query.until)
+        def query_groups(watermark: bool):
+            if watermark:
+                stats = self._watermarked_stats()
+            else:
+                stats = {
+                    "hide": models.UserGroupStatsEntity.hide,
+                    "delete_before": models.UserGroupStatsEntity.delete_before,
+                    "sort_time": func.coalesce(
+                        models.UserGroupStatsEntity.sort_time,
+                        func.greatest(
+                            models.UserGroupStatsEntity.highlight_time,
+                            models.GroupEntity.last_message_time,
+                        ),
+                    ),
+                }
 
             statement = (
                 db.query(
-                    models.GroupEntity,
-                    models.UserGroupStatsEntity
+                    *GROUP_BASE_COLUMNS,
+                    *USER_STATS_BASE_COLUMNS,
+                    models.UserGroupStatsEntity.watermark,
+                    stats["sort_time"],
                 )
+                .select_from(models.GroupEntity)
                 .join(
                     models.UserGroupStatsEntity,
                     models.UserGroupStatsEntity.group_id == models.GroupEntity.group_id
                 )
                 .filter(
-                    models.GroupEntity.last_message_time < until,
-                    models.UserGroupStatsEntity.delete_before <= models.GroupEntity.updated_at,
+                    stats["delete_before"] <= models.GroupEntity.updated_at,
                     # TODO: when joining a "group", the last message was before you joined; if we create
                     #  an action log when a user joins it will update `last_message_time` and we can use
                     #  that instead of `updated_at`, which would make more sense
                     # models.UserGroupStatsEntity.delete_before < models.GroupEntity.last_message_time,
                     models.UserGroupStatsEntity.user_id == user_id,
+                    models.UserGroupStatsEntity.watermark.is_(watermark),
                 )
             )
 
+            if query.cursor is not None:
+                statement = statement.filter(
+                    tuple_(
+                        models.UserGroupStatsEntity.pin,
+                        stats["sort_time"],
+                        models.UserGroupStatsEntity.group_id,
+                    ) < tuple_(
+                        query.cursor.pin,
+                        GroupQuery.to_dt(query.cursor.sort_time),
+                        query.cursor.group_id,
+                    )
+                )
+            else:
+                statement = statement.filter(
+                    models.GroupEntity.last_message_time < GroupQuery.to_dt(query.until),
+                )
+
+            # "hide = false" instead of "hide is false", to match the partial index
             if query.hidden is not None:
                 statement = statement.filter(
-                    models.UserGroupStatsEntity.hide.is_(query.hidden),
+                    stats["hide"] == query.hidden,
                 )
 
             if query.only_unread:
@@ -174,17 +250,30 @@ class RelationalHandler:
             statement = (
                 statement.order_by(
                     models.UserGroupStatsEntity.pin.desc(),
-                    func.greatest(
-                        models.UserGroupStatsEntity.highlight_time,
-                        models.GroupEntity.last_message_time,
-                    ).desc(),
+                    stats["sort_time"].desc().nullslast(),
+                    models.UserGroupStatsEntity.group_id.desc(),
                 )
                 .limit(query.per_page)
             )
 
-            return statement.all()
+            return [
+                (*self._group_and_stats_from_row(row), row[-1])
+                for row in statement.all()
+            ]
+
+        results = query_groups(watermark=False) + query_groups(watermark=True)
+
+        # the sort key from the query, so the cursor of the next page matches it
+        for _, user_stats, sort_time in results:
+            user_stats.sort_time = sort_time
+
+        results = sorted(
+            results,
+            key=lambda result: (result[1].pin, result[1].sort_time, result[1].group_id),
+            reverse=True,
+        )
+        results = [(group, stats) for group, stats, _ in results[:query.per_page]]
 
-        results = query_groups()
         receiver_stats_base = self.get_receiver_stats(results, user_id, receiver_stats, db)
         count_unread = query.count_unread or False
 
@@ -197,6 +286,7 @@ class RelationalHandler:
             count_receiver=count_receiver_unread,  # when getting user stats we don't care about receivers
         )
 
+    @read_replica()
     def get_groups_updated_since(
         self,
         user_id: int,
@@ -214,25 +304,30 @@ class RelationalHandler:
         @time_method(logger, "get_groups_updated_since(): query groups")
         def query_groups():
             since = GroupUpdatesQuery.to_dt(query.since)
+            stats = self._watermarked_stats()
 
-            return (
-                db.query(models.GroupEntity, models.UserGroupStatsEntity)
+            rows = (
+                db.query(
+                    *GROUP_BASE_COLUMNS,
+                    *USER_STATS_BASE_COLUMNS,
+                    models.UserGroupStatsEntity.watermark,
+                )
                 .filter(
                     models.GroupEntity.group_id == models.UserGroupStatsEntity.group_id,
                     models.UserGroupStatsEntity.user_id == user_id,
-                    models.UserGroupStatsEntity.last_updated_time >= since,
+                    stats["last_updated_time"] >= since,
                 )
                 .order_by(
                     models.UserGroupStatsEntity.pin.desc(),
-                    func.greatest(
-                        models.UserGroupStatsEntity.highlight_time,
-                        models.GroupEntity.last_message_time,
-                    ).desc(),
+                    stats["sort_time"].desc(),
+                    models.UserGroupStatsEntity.group_id.desc(),
                 )
                 .limit(query.per_page)
                 .all()
             )
 
+            return [self._group_and_stats_from_row(row) for row in rows]
+
         results = query_groups()
         receiver_stats = self.get_receiver_stats(results, user_id, receiver_stats, db)
         count_unread = query.count_unread or False
@@ -258,8 +353,14 @@ class RelationalHandler:
 
     # noinspection PyMethodMayBeStatic
     def get_receiver_user_stats(self, group_ids: List[str], user_id: int, db: Session):
+        """
+        :return: rows of USER_STATS_BASE_COLUMNS and the watermark flag
+        """
         return (
-            db.query(models.UserGroupStatsEntity)
+            db.query(
+                *USER_STATS_BASE_COLUMNS,
+                models.UserGroupStatsEntity.watermark,
+            )
             .filter(
                 models.UserGroupStatsEntity.group_id.in_(group_ids),
                 models.UserGroupStatsEntity.user_id != user_id,
@@ -271,8 +372,8 @@ class RelationalHandler:
     def format_group_stats_and_count_unread(
         self,
         db: Session,
-        results: List[Tuple[models.GroupEntity, models.UserGroupStatsEntity]],
-        receiver_stats: List[models.UserGroupStatsEntity],
+        results: List[Tuple[GroupBase, UserGroupStatsBase]],
+        receiver_stats: list,
         user_id: int,
         count_unread: bool,
         count_receiver: bool = True,
@@ -286,29 +387,37 @@ class RelationalHandler:
 
             # only count for receiver if it's a 1v1 group
             if group.group_type == GroupTypes.ONE_TO_ONE and count_receiver:
-                user_a, user_b = group_id_to_users(group.group_id)
-                user_to_count_for = (
-                    user_a if user_b == user_id else user_b
-                )
-                _receiver_unread_count = self.env.storage.get_unread_in_group(
+                if receiver_stat is not None:
+                    _receiver_unread_count = unread_from_seq(group.message_seq, receiver_stat.last_read_seq)
+
+                if _receiver_unread_count is None or _receiver_unread_count < 0:
+                    user_a, user_b = group_id_to_users(group.group_id)
+                    user_to_count_for = (
+                        user_a if user_b == user_id else user_b
+                    )
+                    _receiver_unread_count = self.env.storage.get_unread_in_group(
+                        group_id=group.group_id,
+                        user_id=user_to_count_for,
+                        last_read=user_group_stats.last_read,
+                    )
+
+            # groups and stats from before the sequence numbers were added are counted
+            _unread_count = unread_from_seq(group.message_seq, user_group_stats.last_read_seq)
+
+            if _unread_count is None:
+                _unread_count = self.env.storage.get_unread_in_group(
                     group_id=group.group_id,
-                    user_id=user_to_count_for,
+                    user_id=user_id,
                     last_read=user_group_stats.last_read,
                 )
 
-            _unread_count = self.env.storage.get_unread_in_group(
-                group_id=group.group_id,
-                user_id=user_id,
-                last_read=user_group_stats.last_read,
-            )
-
             return _unread_count, _receiver_unread_count
 
         groups = list()
 
         receivers = dict()
-        for stat in receiver_stats:
-            receivers[stat.group_id] = UserGroupStatsBase(**stat.__dict__)
+        for row in receiver_stats:
+            receivers[row.group_id] = row
 
         # batch all redis/db queries for join times
         group_users_join_time = self.get_user_ids_and_join_time_in_groups(
@@ -316,18 +425,19 @@ class RelationalHandler:
             db
         )
 
-        for group_entity, user_group_stats_entity in results:
-            group = GroupBase(**group_entity.__dict__)
-            user_group_stats = UserGroupStatsBase(**user_group_stats_entity.__dict__)
-
-            unread_count, receiver_unread_count = count_for_group()
-
+        for group, user_group_stats in results:
             receiver_stat = None
             if group.group_id in receivers:
-                receiver_stat = receivers[group.group_id]
+                row = receivers[group.group_id]
+                receiver_stat = self._to_base(UserGroupStatsBase, row)
+
+                if row.watermark:
+                    self._apply_watermark(group, receiver_stat)
+
+            unread_count, receiver_unread_count = count_for_group()
 
-            join_times = group_users_join_time.get(group_entity.group_id, dict())
-            user_group = UserGroupBase(
+            join_times = group_users_join_time.get(group.group_id, dict())
+            user_group = UserGroupBase.construct(
                 group=group,
                 user_stats=user_group_stats,
                 user_join_times=join_times,
@@ -346,27 +456,80 @@ class RelationalHandler:
         sent_time: dt,
         db: Session,
         wakeup_users: bool = True,
+        update_cache: bool = True,
+        new_message: bool = True,
     ) -> None:
-        group = (
-            db.query(models.GroupEntity)
-            .filter(models.GroupEntity.group_id == message.group_id)
-            .first()
+        """
+        new_message is False for attachments, the message they belong to was
+        already counted in the group's message_seq when it was sent
+        """
+        last_message = {
+            "last_message_time": sent_time,
+            "last_message_overview": message.message_payload,
+            "last_message_id": message.message_id,
+            "last_message_type": message.message_type,
+            "last_message_user_id": message.user_id,
+        }
+
+        # when creating action logs, we want to sync changes to apps, but not necessarily un-hide a group
+        # TODO: maybe we actually want to wake them up, check with stakeholders
+        if wakeup_users:
+            last_message["wakeup_time"] = sent_time
+
+        # has to be checked before the group's last message time is updated
+        count_changes, counted_again = self._group_type_count_changes_on_new_message(
+            message.group_id, sent_time, wakeup_users, db
         )
 
-        if group is None:
+        values = {
+            getattr(models.GroupEntity, field): value
+            for field, value in last_message.items()
+        }
+
+        # stays NULL for groups from before the sequence was added until counted
+        if new_message:
+            values[models.GroupEntity.message_seq] = models.GroupEntity.message_seq + 1
+
+        # no need to load the group first, just check that something was updated
+        updated = db.execute(
+            update(models.GroupEntity.__table__)
+            .where(models.GroupEntity.group_id == message.group_id)
+            .values(values)
+            .returning(models.GroupEntity.message_seq)
+        ).first()
+
+        if updated is None:
             raise NoSuchGroupException(message.group_id)
 
         # for knowing if we need to send read-receipts when user opens a conversation
-        self.env.cache.set_last_message_time_in_group(
-            message.group_id,
-            AbstractQuery.to_ts(sent_time)
+        if update_cache:
+            self.env.cache.set_last_message_time_in_group(
+                message.group_id,
+                AbstractQuery.to_ts(sent_time)
+            )
+
+        n_users = len(self.get_user_ids_and_join_time_in_group(message.group_id, db))
+        watermark = n_users > self.fanout_max_users
+
+        # only true for the message that makes the group cross fanout_max_users
+        switched = (
+            db.query(models.GroupEntity)
+            .filter(
+                models.GroupEntity.group_id == message.group_id,
+                models.GroupEntity.watermark.isnot(watermark),
+            )
+            .update({
+                models.GroupEntity.watermark: watermark
+            }, synchronize_session=False)
         )
 
-        group.last_message_time = sent_time
-        group.last_message_overview = message.message_payload
-        group.last_message_id = message.message_id
-        group.last_message_type = message.message_type
-        group.last_message_user_id = message.user_id
+        if len(counted_again):
+            db.query(models.UserGroupStatsEntity).filter(
+                models.UserGroupStatsEntity.group_id == message.group_id,
+                models.UserGroupStatsEntity.user_id.in_(counted_again),
+            ).update({
+                models.UserGroupStatsEntity.cleared: False
+            }, synchronize_session=False)
 
         statement = (
             db.query(models.UserGroupStatsEntity)
@@ -375,22 +538,125 @@ class RelationalHandler:
             )
         )
 
-        # when creating action logs, we want to sync changes to apps, but not necessarily un-hide a group
-        # TODO: maybe we actually want to wake them up, check with stakeholders
-        if wakeup_users:
-            statement.update({
-                models.UserGroupStatsEntity.last_updated_time: sent_time,
-                models.UserGroupStatsEntity.delete_before: models.UserGroupStatsEntity.join_time,
-                models.UserGroupStatsEntity.hide: False,
-            })
+        if watermark:
+            # O(1); the stats of the users are derived from the group row when read
+            if switched:
+                statement.update({
+                    models.UserGroupStatsEntity.watermark: True,
+                }, synchronize_session=False)
+
         else:
-            statement.update({
-                models.UserGroupStatsEntity.last_updated_time: sent_time,
-            })
+            values = dict()
+
+            # the stats were derived from the group until now, so store them before
+            # overwriting last_updated_time, which they're derived from
+            if switched:
+                values.update(self._materialize_watermark())
+                values[models.UserGroupStatsEntity.watermark] = False
+
+            values[models.UserGroupStatsEntity.last_updated_time] = sent_time
+            values[models.UserGroupStatsEntity.sort_time] = func.greatest(
+                models.UserGroupStatsEntity.highlight_time, sent_time
+            )
+
+            if wakeup_users:
+                values[models.UserGroupStatsEntity.delete_before] = models.UserGroupStatsEntity.join_time
+                values[models.UserGroupStatsEntity.hide] = False
+
+            # synchronize_session can't evaluate greatest(), and we commit right after anyway
+            statement.update(values, synchronize_session=False)
 
-        db.add(group)
         db.commit()
 
+        # patching the cached snapshot would race with concurrent messages, and
+        # an older message could overwrite the last message and message_seq
+        self.env.cache.remove_group(message.group_id)
+
+        for user_id, deltas in count_changes.items():
+            self.env.cache.increase_count_group_types_for_user(user_id, deltas)
+
+    # noinspection PyMethodMayBeStatic
+    def _group_type_count_changes_on_new_message(
+        self, group_id: str, sent_time: dt, wakeup_users: bool, db: Session
+    ) -> Tuple[Dict[int, Dict[Tuple[bool, int], int]], List[int]]:
+        """
+        a group is only counted for a user if it has messages after the user's
+        delete_before, so a new message can make it counted again (and unhide it),
+        e.g. the first message after a user joined; only the members that are
+        hidden or cleared are read, using a partial index, usually none
+
+        :return: the changes of the group type counts per user, and the users
+                 whose `cleared` flag should be removed
+        """
+        stats = self._watermarked_stats()
+
+        users = (
+            db.query(
+                models.UserGroupStatsEntity.user_id,
+                models.UserGroupStatsEntity.cleared,
+                stats["hide"],
+                stats["delete_before"],
+                models.UserGroupStatsEntity.join_time,
+                models.GroupEntity.last_message_time,
+                models.GroupEntity.group_type,
+            )
+            .join(
+                models.GroupEntity,
+                models.GroupEntity.group_id == models.UserGroupStatsEntity.group_id,
+            )
+            .filter(
+                models.UserGroupStatsEntity.group_id == group_id,
+                # "= true" instead of "is true", to match the partial index; the flags
+                # can be set for members of watermarked groups that have been woken
+                # up since, but the changes are calculated from the derived values
+                or_(
+                    models.UserGroupStatsEntity.hide == True,  # noqa
+                    models.UserGroupStatsEntity.cleared == True,  # noqa
+                )
+            )
+            .all()
+        )
+
+        changes = dict()
+        counted_again = list()
+
+        for user_id, cleared, hide, delete_before, join_time, last_message_time, group_type in users:
+            if wakeup_users:
+                hide_after, delete_before_after = False, join_time
+            else:
+                hide_after, delete_before_after = hide, delete_before
+
+            changes[user_id] = RelationalHandler._group_type_count_deltas(
+                group_type,
+                before=(hide, delete_before < last_message_time),
+                after=(hide_after, delete_before_after < sent_time),
+            )
+
+            if cleared and delete_before_after < sent_time:
+                counted_again.append(user_id)
+
+        return changes, counted_again
+
+    @staticmethod
+    def _group_type_count_deltas(
+        group_type: int, before: Tuple[bool, bool], after: Tuple[bool, bool]
+    ) -> Dict[Tuple[bool, int], int]:
+        """
+        :param before: (hidden, counted) before the change
+        :param after: (hidden, counted) after the change
+        """
+        deltas = dict()
+        (hidden_before, counted_before), (hidden_after, counted_after) = before, after
+
+        if counted_before:
+            deltas[(hidden_before, group_type)] = -1
+
+        if counted_after:
+            key = (hidden_after, group_type)
+            deltas[key] = deltas.get(key, 0) + 1
+
+        return deltas
+
     def get_last_reads_in_group(self, group_id: str, db: Session) -> Dict[int, float]:
         # TODO: rethink this; some cached some not? maybe we don't have to do this twice
         users = self.get_user_ids_and_join_time_in_group(group_id, db)
@@ -409,25 +675,32 @@ class RelationalHandler:
         if not len(not_cached):
             return last_reads
 
-        reads = (
-            db.query(models.UserGroupStatsEntity)
-            .with_entities(
-                models.UserGroupStatsEntity.user_id,
-                models.UserGroupStatsEntity.last_read,
-            )
-            .filter(
-                models.UserGroupStatsEntity.group_id == group_id,
-                models.UserGroupStatsEntity.user_id.in_(not_cached),
+        def fill() -> Dict[int, float]:
+            reads = (
+                db.query(models.UserGroupStatsEntity)
+                .with_entities(
+                    models.UserGroupStatsEntity.user_id,
+                    models.UserGroupStatsEntity.last_read,
+                )
+                .filter(
+                    models.UserGroupStatsEntity.group_id == group_id,
+                    models.UserGroupStatsEntity.user_id.in_(not_cached),
+                )
+                .all()
             )
-            .all()
-        )
 
-        for user_id, last_read in reads:
-            last_read_float = GroupQuery.to_ts(last_read)
-            last_reads[user_id] = last_read_float
+            filled = {
+                user_id: GroupQuery.to_ts(last_read)
+                for user_id, last_read in reads
+            }
 
-        self.env.cache.set_last_read_in_group_for_users(
-            group_id, last_reads
+            self.env.cache.set_last_read_in_group_for_users(group_id, filled)
+            return filled
+
+        # requests for the same missing users share one query
+        not_cached_hash = sha1(",".join(str(u) for u in sorted(not_cached)).encode()).hexdigest()
+        last_reads.update(
+            self.single_flight.do(f"last_read:{group_id}:{not_cached_hash}", fill)
         )
 
         return last_reads
@@ -435,8 +708,9 @@ class RelationalHandler:
     # noinspection PyMethodMayBeStatic
     def get_all_group_ids_for_user(self, user_id: int, db: Session) -> List[str]:
         """
-        used only when a user is deleting their profile, no need
-        to cache it, shouldn't happen that often
+        used when a user is deleting their profile, and to check if the
+        cached /userstats are still valid when they're counted again; not
+        cached, it only reads the index on user_id
         """
         group_ids = (
             db.query(
@@ -456,11 +730,31 @@ class RelationalHandler:
     def get_group_id_for_1to1(
         self, user_a: int, user_b: int, db: Session
     ) -> Optional[str]:
-        group = self.get_group_for_1to1(user_a, user_b, db)
-        return group.group_id
+        # the group id is derived from the user ids, so we only need to know if it exists
+        group_id = users_to_group_id(user_a, user_b)
+        exists = self.env.cache.get_1to1_group_exists(group_id)
+
+        if exists is True:
+            return group_id
+
+        if exists is False:
+            raise NoSuchGroupException(f"{user_a},{user_b}")
+
+        try:
+            group_id = self.get_group_for_1to1(user_a, user_b, db, parse_result=False)
+        except NoSuchGroupException:
+            self.env.cache.set_1to1_group_exists(group_id, False)
+            raise
+
+        self.env.cache.set_1to1_group_exists(group_id, True)
+        return group_id
 
     # noinspection PyMethodMayBeStatic
     def get_group_from_id(self, group_id: str, db: Session) -> GroupBase:
+        group = self.env.cache.get_group(group_id)
+        if group is not None:
+            return group
+
         group = (
             db.query(models.GroupEntity)
             .filter(
@@ -472,7 +766,10 @@ class RelationalHandler:
         if group is None:
             raise NoSuchGroupException(group_id)
 
-        return GroupBase(**group.__dict__)
+        group = self._to_base(GroupBase, group)
+        self.env.cache.set_group(group)
+
+        return group
 
     # noinspection PyMethodMayBeStatic
     def get_group_for_1to1(
@@ -480,6 +777,12 @@ class RelationalHandler:
     ):
         group_id = users_to_group_id(user_a, user_b)
 
+        if parse_result:
+            group = self.env.cache.get_group(group_id)
+
+            if group is not None and group.group_type == GroupTypes.ONE_TO_ONE:
+                return group
+
         group = (
             db.query(models.GroupEntity)
             .filter(
@@ -493,10 +796,14 @@ class RelationalHandler:
             raise NoSuchGroupException(f"{user_a},{user_b}")
 
         if parse_result:
-            return GroupBase(**group.__dict__)
+            group = self._to_base(GroupBase, group)
+            self.env.cache.set_group(group)
+
+            return group
 
         return group_id
 
+    @pins_to_primary("user_a", "user_b")
     def create_group_for_1to1(self, user_a: int, user_b: int, db: Session) -> GroupBase:
         users = sorted([user_a, user_b])
         group_name = ",".join([str(user_id) for user_id in users])
@@ -506,7 +813,60 @@ class RelationalHandler:
             group_name=group_name, group_type=GroupTypes.ONE_TO_ONE, users=users
         )
 
-        return self.create_group(user_a, query, now, db)
+        try:
+            return self.create_group(user_a, query, now, db)
+        except IntegrityError:
+            # created by a concurrent request, or the cache said it didn't exist
+            # when it did (e.g. the filter was evicted from redis)
+            db.rollback()
+
+            group = self.get_group_for_1to1(user_a, user_b, db)
+            self.env.cache.add_1to1_group(group.group_id)
+
+            return group
+
+    def load_1to1_group_filter(self) -> None:
+        """
+        adds all existing 1v1 group ids to the filter in redis, so lookups of
+        groups that don't exist can skip the database; only one worker does
+        the loading, and the filter isn't used until it's complete
+        """
+        if not self.env.cache.claim_1to1_group_filter_load():
+            return
+
+        def load():
+            db = self.env.SessionLocal()
+
+            try:
+                group_ids = (
+                    db.query(models.GroupEntity.group_id)
+                    .filter(models.GroupEntity.group_type == GroupTypes.ONE_TO_ONE)
+                    .yield_per(10_000)
+                )
+
+                n_groups = 0
+                chunk = list()
+
+                for group_id, in group_ids:
+                    chunk.append(group_id)
+
+                    if len(chunk) >= 10_000:
+                        self.env.cache.add_1to1_groups_to_filter(chunk)
+                        n_groups += len(chunk)
+                        chunk = list()
+
+                self.env.cache.add_1to1_groups_to_filter(chunk)
+                n_groups += len(chunk)
+
+                self.env.cache.set_1to1_group_filter_loaded()
+                logger.info(f"loaded {n_groups} 1v1 groups into the filter")
+            except Exception as e:
+                logger.error(f"could not load 1v1 group filter: {str(e)}")
+                logger.exception(e)
+            finally:
+                db.close()
+
+        threading.Thread(target=load, name="1v1-filter-loader", daemon=True).start()
 
     def get_user_ids_and_join_time_in_groups(self, group_ids: List[str], db: Session) -> dict:
         group_and_users: Dict[str, Dict[int, float]] = \
@@ -539,7 +899,9 @@ class RelationalHandler:
                 group_and_users[group_id] = dict()
             group_and_users[group_id][user_id] = GroupQuery.to_ts(join_time)
 
-        self.env.cache.set_user_ids_and_join_time_in_groups(group_and_users)
+        if not reading_from_replica():
+            self.env.cache.set_user_ids_and_join_time_in_groups(group_and_users)
+
         return group_and_users
 
     def get_user_ids_and_join_time_in_group(self, group_id: str, db: Session) -> dict:
@@ -548,23 +910,33 @@ class RelationalHandler:
         if users is not None:
             return users
 
-        users = (
-            db.query(
-                models.UserGroupStatsEntity.user_id,
-                models.UserGroupStatsEntity.join_time,
+        def fill() -> dict:
+            users_in_group = (
+                db.query(
+                    models.UserGroupStatsEntity.user_id,
+                    models.UserGroupStatsEntity.join_time,
+                )
+                .filter(models.UserGroupStatsEntity.group_id == group_id)
+                .all()
             )
-            .filter(models.UserGroupStatsEntity.group_id == group_id)
-            .all()
-        )
 
-        if users is None or len(users) == 0:
-            return dict()
+            if users_in_group is None or len(users_in_group) == 0:
+                return dict()
+
+            user_ids_join_time = {user[0]: GroupQuery.to_ts(user[1]) for user in users_in_group}
+            self.env.cache.set_user_ids_and_join_time_in_group(group_id, user_ids_join_time)
 
-        user_ids_join_time = {user[0]: GroupQuery.to_ts(user[1]) for user in users}
-        self.env.cache.set_user_ids_and_join_time_in_group(group_id, user_ids_join_time)
+            return user_ids_join_time
 
-        return user_ids_join_time
+        # callers modify the returned dict, and waiters share the same result
+        return dict(self.single_flight.do(
+            f"user_in_group:{group_id}",
+            fill,
+            stale=self.env.cache.get_stale_user_ids_and_join_time_in_group(group_id),
+            check=lambda: self.env.cache.get_user_ids_and_join_time_in_group(group_id),
+        ))
 
+    @pins_to_primary("user_id")
     def remove_last_read_in_group_for_user(
         self, group_id: str, user_id: int, db: Session
     ) -> None:
@@ -582,6 +954,9 @@ class RelationalHandler:
         self.env.cache.remove_last_read_in_group_for_user(group_id, user_id)
         self.env.cache.clear_user_ids_and_join_time_in_group(group_id)
 
+        # rare enough to just count again
+        self.env.cache.reset_count_group_types_for_user(user_id)
+
     # noinspection PyMethodMayBeStatic
     def group_exists(self, group_id: str, db: Session) -> bool:
         group = (
@@ -604,61 +979,110 @@ class RelationalHandler:
             return
 
         group.updated_at = now
+        base = self._to_base(GroupBase, group)
 
         db.add(group)
         db.commit()
 
-    def update_user_stats_on_join_or_create_group(
-        self, group_id: str, users: Dict[int, float], now: dt, db: Session
-    ) -> None:
-        user_ids_for_cache = set()
-        user_ids_to_stats = dict()
-        user_ids = list(users.keys())
+        self.env.cache.set_group(base)
 
-        user_stats = (
-            db.query(models.UserGroupStatsEntity)
-            .filter(models.UserGroupStatsEntity.user_id.in_(user_ids))
-            .filter(models.UserGroupStatsEntity.group_id == group_id)
-            .all()
+    def init_message_seq_in_group(self, group_id: str, n_messages: int, db: Session) -> None:
+        """
+        groups created before message_seq was added start counting from the number
+        of messages in storage; a message sent while they were counted is missed
+        """
+        updated = (
+            db.query(models.GroupEntity)
+            .filter(
+                models.GroupEntity.group_id == group_id,
+                models.GroupEntity.message_seq.is_(None),
+            )
+            .update({
+                models.GroupEntity.message_seq: n_messages
+            }, synchronize_session=False)
         )
 
-        for user_stat in user_stats:
-            user_ids_to_stats[user_stat.user_id] = user_stat
+        db.commit()
 
-        for user_id in user_ids:
-            if user_id not in user_ids_to_stats:
-                self.env.cache.reset_count_group_types_for_user(user_id)
+        if updated > 0:
+            self.env.cache.remove_group(group_id)
 
-                user_ids_for_cache.add(user_id)
-                user_ids_to_stats[user_id] = self._create_user_stats(
-                    group_id, user_id, now
-                )
+    @pins_to_primary("users")
+    def update_user_stats_on_join_or_create_group(
+        self, group_id: str, users: Dict[int, float], now: dt, db: Session
+    ) -> None:
+        """
+        one statement for all users: new users get new stats, and users already in
+        the group only get their last_read updated; new users are not included in
+        the group type counts until the next message is sent, see
+        update_group_new_message()
+
+            insert into user_group_stats (...) values (...), (...), ...
+            on conflict (group_id, user_id) do update
+                set last_read = excluded.last_read, last_read_seq = excluded.last_read_seq
+            returning user_id, join_time;
+        """
+        # insert() with no rows would compile to "insert ... default values"
+        if not len(users):
+            return
 
-            user_ids_to_stats[user_id].last_read = now
-            db.add(user_ids_to_stats[user_id])
+        statement = insert(models.UserGroupStatsEntity.__table__).values([
+            self._user_stats_values(group_id, user_id, now)
+            for user_id in users.keys()
+        ])
+
+        statement = statement.on_conflict_do_update(
+            index_elements=["group_id", "user_id"],
+            set_={
+                "last_read": statement.excluded.last_read,
+                "last_read_seq": statement.excluded.last_read_seq,
+            },
+        ).returning(
+            models.UserGroupStatsEntity.user_id,
+            models.UserGroupStatsEntity.join_time,
+        )
+
+        # existing users keep their original join time
+        join_times = {
+            user_id: GroupQuery.to_ts(join_time)
+            for user_id, join_time in db.execute(statement)
+        }
 
         db.commit()
 
         now_ts = AbstractQuery.to_ts(now)
+        read_times = {user_id: now_ts for user_id in users.keys()}
 
-        join_times = {
-            user_id: GroupQuery.to_ts(stats.join_time)
-            for user_id, stats in user_ids_to_stats.items()
-        }
-        read_times = {user_id: now_ts for user_id in user_ids}
-
-        self.env.cache.add_user_ids_and_join_time_in_group(group_id, join_times)
-        self.env.cache.set_last_read_in_group_for_users(group_id, read_times)
+        self.env.cache.add_user_ids_and_join_time_in_group(
+            group_id, join_times, last_reads=read_times
+        )
 
+    @read_replica()
     def count_group_types_for_user(self, user_id: int, query: GroupQuery, db: Session) -> List[Tuple[int, int]]:
-        hidden = query.hidden
-
-        types = self.env.cache.get_count_group_types_for_user(user_id, hidden)
+        types = self.env.cache.get_count_group_types_for_user(user_id, query.hidden)
         if types is not None:
             return types
 
-        statement = (
+        # count both hidden and visible, the counters are kept up to date from here on
+        counts = self._count_group_types_for_user(user_id, db)
+
+        if not reading_from_replica():
+            self.env.cache.set_count_group_types_for_user(user_id, counts)
+
+        types = dict()
+        for hidden, group_type, count in counts:
+            if query.hidden is None or hidden == query.hidden:
+                types[group_type] = types.get(group_type, 0) + count
+
+        return sorted(types.items())
+
+    # noinspection PyMethodMayBeStatic
+    def _count_group_types_for_user(self, user_id: int, db: Session) -> List[Tuple[bool, int, int]]:
+        stats = self._watermarked_stats()
+
+        return (
             db.query(
+                stats["hide"],
                 models.GroupEntity.group_type,
                 func.count(models.GroupEntity.group_type),
             )
@@ -668,67 +1092,59 @@ class RelationalHandler:
             )
             .filter(
                 models.UserGroupStatsEntity.user_id == user_id,
-                models.UserGroupStatsEntity.delete_before < models.GroupEntity.last_message_time,
-            )
-        )
-
-        if query.hidden is not None:
-            statement = statement.filter(
-                models.UserGroupStatsEntity.hide.is_(hidden)
-            )
-
-        types = (
-            statement.group_by(
-                models.GroupEntity.group_type
+                stats["delete_before"] < models.GroupEntity.last_message_time,
             )
-            .limit(
-                query.per_page
+            .group_by(
+                stats["hide"],
+                models.GroupEntity.group_type,
             )
             .all()
         )
 
-        # if hidden is None, we're counting for both types
-        if query.hidden is not None:
-            self.env.cache.set_count_group_types_for_user(user_id, types, hidden)
+    def reconcile_group_type_counts(self, db: Session, max_users: int = 10_000) -> int:
+        """
+        recount group types for users whose counters changed since the last run,
+        in case concurrent changes made the counters drift
+        """
+        user_ids = self.env.cache.get_users_with_changed_group_type_counts(max_users)
+
+        for user_id in user_ids:
+            counts = self._count_group_types_for_user(user_id, db)
+            self.env.cache.set_count_group_types_for_user(user_id, counts)
 
-        return types
+        return len(user_ids)
 
-    # noinspection PyMethodMayBeStatic
+    @pins_to_primary("user_id")
     def set_last_updated_at_on_all_stats_related_to_user(self, user_id: int, db: Session):
+        """
+        updates the stats of all members in all groups the user is in, one statement
+        even for users with >10k conversations, using the index on user_id
+        """
         now = utcnow_dt()
+        before = utcnow_ts()
 
         group_ids = (
             db.query(models.UserGroupStatsEntity.group_id)
-            .filter(
-                models.UserGroupStatsEntity.user_id == user_id
-            )
-            .all()
+            .filter(models.UserGroupStatsEntity.user_id == user_id)
+            .subquery()
         )
 
-        before = None
-        if len(group_ids) > 250:
-            before = utcnow_ts()
-
-        # some users have >10k conversations; split into chunks to not overload the db
-        for group_id_chunk in split_into_chunks(group_ids, 500):
-            _ = (
-                db.query(models.UserGroupStatsEntity)
-                .filter(
-                    models.UserGroupStatsEntity.group_id.in_(group_id_chunk)
-                )
-                .update(
-                    {models.UserGroupStatsEntity.last_updated_time: now},
-                    synchronize_session="fetch",
-                )
-            )
+        n_updated = (
+            db.query(models.UserGroupStatsEntity)
+            .filter(models.UserGroupStatsEntity.group_id.in_(group_ids))
+            .update({
+                **self._materialize_watermark(),
+                models.UserGroupStatsEntity.last_updated_time: now,
+            }, synchronize_session=False)
+        )
 
         db.commit()
 
-        if before is not None:
+        if n_updated > 250:
             the_time = utcnow_ts() - before
             the_time = "%.2f" % the_time
 
-            logger.info(f"updating {len(group_ids)} user group stats took {the_time}s")
+            logger.info(f"updating {n_updated} user group stats took {the_time}s")
 
     # noinspection PyMethodMayBeStatic
     def set_last_updated_at_for_all_in_group(self, group_id: str, db: Session):
@@ -737,7 +1153,10 @@ class RelationalHandler:
         _ = (
             db.query(models.UserGroupStatsEntity)
             .filter(models.UserGroupStatsEntity.group_id == group_id)
-            .update({models.UserGroupStatsEntity.last_updated_time: now})
+            .update({
+                **self._materialize_watermark(),
+                models.UserGroupStatsEntity.last_updated_time: now,
+            }, synchronize_session=False)
         )
 
         db.commit()
@@ -768,56 +1187,57 @@ class RelationalHandler:
 
         group_entity.updated_at = now
 
-        base = GroupBase(**group_entity.__dict__)
+        base = self._to_base(GroupBase, group_entity)
 
         db.add(group_entity)
         db.commit()
 
+        self.env.cache.set_group(base)
+
         return base
 
+    @pins_to_primary("user_id")
     def mark_all_groups_as_read(self, user_id: int, db: Session) -> None:
-        group_ids = (
-            db.query(models.UserGroupStatsEntity.group_id)
-            .join(
-                models.GroupEntity,
-                models.GroupEntity.group_id == models.UserGroupStatsEntity.group_id
-            )
-            .filter(
+        """
+        what we're doing:
+
+            update user_group_stats u
+            set last_updated_time = now(), last_read = now(), last_read_seq = g.message_seq, bookmark = false
+            from groups g
+            where
+                u.group_id = g.group_id and
+                u.user_id = 1234 and
+                (u.last_read < g.last_message_time or u.bookmark = true)
+            returning u.group_id;
+        """
+        now = utcnow_dt()
+
+        statement = (
+            update(models.UserGroupStatsEntity.__table__)
+            .where(and_(
+                models.UserGroupStatsEntity.group_id == models.GroupEntity.group_id,
                 models.UserGroupStatsEntity.user_id == user_id,
                 or_(
                     models.UserGroupStatsEntity.last_read < models.GroupEntity.last_message_time,
                     models.UserGroupStatsEntity.bookmark.is_(True),
                 )
-            )
-            .all()
+            ))
+            .values({
+                **self._materialize_watermark(joined=True),
+                models.UserGroupStatsEntity.last_updated_time: now,
+                models.UserGroupStatsEntity.last_read: now,
+                models.UserGroupStatsEntity.last_read_seq: models.GroupEntity.message_seq,
+                models.UserGroupStatsEntity.bookmark: False,
+            })
+            .returning(models.UserGroupStatsEntity.group_id)
         )
 
-        # sqlalchemy returns a list of tuples: [(group_id1,), (group_id2,), ...]
-        group_ids = [group_id[0] for group_id in group_ids]
-
-        now = utcnow_dt()
-
-        # some users have >10k conversations; split into chunks to not overload the db
-        for group_id_chunk in split_into_chunks(group_ids, 500):
-            self.env.cache.reset_unread_in_groups(user_id, group_id_chunk)
-
-            _ = (
-                db.query(models.UserGroupStatsEntity)
-                .filter(
-                    models.UserGroupStatsEntity.group_id.in_(group_id_chunk)
-                )
-                .update(
-                    {
-                        models.UserGroupStatsEntity.last_updated_time: now,
-                        models.UserGroupStatsEntity.last_read: now,
-                        models.UserGroupStatsEntity.bookmark: False,
-                    },
-                    synchronize_session="fetch",
-                )
-            )
-
+        group_ids = [group_id for group_id, in db.execute(statement)]
         db.commit()
 
+        if len(group_ids):
+            self.env.cache.reset_unread_in_groups(user_id, group_ids)
+
     # noinspection PyMethodMayBeStatic
     def get_user_stats_in_group(
         self, group_id: str, user_id: int, db: Session
@@ -832,10 +1252,14 @@ class RelationalHandler:
         if user_stats is None:
             raise UserNotInGroupException(f"user {user_id} is not in group {group_id}")
 
-        base = UserGroupStatsBase(**user_stats.__dict__)
+        base = self._to_base(UserGroupStatsBase, user_stats)
+
+        if user_stats.watermark:
+            self._apply_watermark(self.get_group_from_id(group_id, db), base)
 
         return base
 
+    @pins_to_primary("user_id")
     def update_user_group_stats(
         self, group_id: str, user_id: int, query: UpdateUserGroupStats, db: Session
     ) -> None:
@@ -860,6 +1284,13 @@ class RelationalHandler:
 
         # only update if query has new values
         else:
+            # store the values derived from the group before changing them
+            if user_stats.watermark:
+                self._apply_watermark(self.get_group_from_id(group_id, db), user_stats)
+
+            previous_hide = user_stats.hide
+            previous_delete_before = user_stats.delete_before
+
             # used by apps to sync changes
             user_stats.last_updated_time = now
 
@@ -875,15 +1306,24 @@ class RelationalHandler:
             if last_read is not None:
                 user_stats.last_read = last_read
 
+                # the sequence number is only known if everything has been read
+                if last_read >= self.get_group_from_id(group_id, db).last_message_time:
+                    user_stats.last_read_seq = self._message_seq_of(group_id)
+                else:
+                    user_stats.last_read_seq = None
+
                 # highlight time is removed if a user reads a conversation
                 user_stats.highlight_time = self.long_ago
+                user_stats.sort_time = self._sort_time_for(group_id, self.long_ago)
 
             if delete_before is not None:
                 user_stats.delete_before = delete_before
+                user_stats.cleared = delete_before >= self.get_group_from_id(group_id, db).last_message_time
 
             # can't set highlight time if also setting last read time
             if highlight_time is not None and last_read is None:
                 user_stats.highlight_time = highlight_time
+                user_stats.sort_time = self._sort_time_for(group_id, highlight_time)
 
                 # always becomes unhidden if highlighted
                 user_stats.hide = False
@@ -893,35 +1333,58 @@ class RelationalHandler:
                 user_stats.hide = query.hide
                 self.env.cache.set_hide_group(group_id, query.hide, [user_id])
 
-            if query.hide is not None or query.delete_before is not None:
-                self.env.cache.reset_count_group_types_for_user(user_id)
+        hide_after = user_stats.hide
+        delete_before_after = user_stats.delete_before
 
         db.add(user_stats)
         db.commit()
 
+        if hide_after != previous_hide or delete_before_after != previous_delete_before:
+            group = self.get_group_from_id(group_id, db)
+
+            self.env.cache.increase_count_group_types_for_user(
+                user_id,
+                RelationalHandler._group_type_count_deltas(
+                    group.group_type,
+                    before=(previous_hide, previous_delete_before < group.last_message_time),
+                    after=(hide_after, delete_before_after < group.last_message_time),
+                )
+            )
+
     def get_last_message_time_in_group(self, group_id: str, db: Session) -> dt:
         last_message_time = self.env.cache.get_last_message_time_in_group(group_id)
         if last_message_time is not None:
             return AbstractQuery.to_dt(last_message_time)
 
-        last_message_time = (
-            db.query(
-                models.GroupEntity.last_message_time
-            )
-            .filter(
-                models.GroupEntity.group_id == group_id
+        def fill() -> float:
+            message_time = (
+                db.query(
+                    models.GroupEntity.last_message_time
+                )
+                .filter(
+                    models.GroupEntity.group_id == group_id
+                )
+                .first()
             )
-            .first()
-        )
 
-        if last_message_time is None or len(last_message_time) == 0:
-            raise NoSuchGroupException(group_id)
+            if message_time is None or len(message_time) == 0:
+                raise NoSuchGroupException(group_id)
 
-        last_message_time = last_message_time[0]
-        self.env.cache.set_last_message_time_in_group(group_id, AbstractQuery.to_ts(last_message_time))
+            message_time = AbstractQuery.to_ts(message_time[0])
+            self.env.cache.set_last_message_time_in_group(group_id, message_time)
 
-        return last_message_time
+            return message_time
 
+        last_message_time = self.single_flight.do(
+            f"last_message_time:{group_id}",
+            fill,
+            stale=self.env.cache.get_stale_last_message_time_in_group(group_id),
+            check=lambda: self.env.cache.get_last_message_time_in_group(group_id),
+        )
+
+        return AbstractQuery.to_dt(last_message_time)
+
+    @pins_to_primary("user_id")
     def update_last_read_and_highlight_in_group_for_user(
         self, group_id: str, user_id: int, the_time: dt, db: Session
     ) -> None:
@@ -935,17 +1398,27 @@ class RelationalHandler:
         if user_stats is None:
             raise UserNotInGroupException(f"user {user_id} is not in group {group_id}")
 
+        if user_stats.watermark:
+            self._apply_watermark(self.get_group_from_id(group_id, db), user_stats)
+
         user_stats.last_read = the_time
+        user_stats.last_read_seq = self._message_seq_of(group_id)
         user_stats.last_updated_time = the_time
         user_stats.highlight_time = self.long_ago
+        user_stats.sort_time = self._sort_time_for(group_id, self.long_ago)
         user_stats.bookmark = False
 
         db.add(user_stats)
         db.commit()
 
+    @pins_to_primary("user_id")
     def update_last_read_and_sent_in_group_for_user(
-        self, group_id: str, user_id: int, the_time: dt, db: Session
+        self, group_id: str, user_id: int, the_time: dt, db: Session, update_cache: bool = True
     ) -> None:
+        """
+        when sending a message, update_cache is False since the caller updates
+        the cache for the whole send in one go with set_message_sent_in_group()
+        """
         user_stats = (
             db.query(models.UserGroupStatsEntity)
             .filter(models.UserGroupStatsEntity.user_id == user_id)
@@ -953,19 +1426,24 @@ class RelationalHandler:
             .first()
         )
 
-        the_time_ts = GroupQuery.to_ts(the_time)
-        self.env.cache.set_last_read_in_group_for_user(group_id, user_id, the_time_ts)
+        if update_cache:
+            the_time_ts = GroupQuery.to_ts(the_time)
+            self.env.cache.set_last_read_in_group_for_user(group_id, user_id, the_time_ts)
 
-        # used for user global stats api
-        self.env.cache.set_last_sent_for_user(user_id, group_id, the_time_ts)
+            # used for user global stats api
+            self.env.cache.set_last_sent_for_user(user_id, group_id, the_time_ts)
 
-        self.env.cache.set_hide_group(group_id, False)
-        self.env.cache.set_unread_in_group(group_id, user_id, 0)
+            self.env.cache.set_hide_group(group_id, False)
+            self.env.cache.set_unread_in_group(group_id, user_id, 0)
 
         if user_stats is None:
             raise UserNotInGroupException(f"user {user_id} is not in group {group_id}")
 
+        if user_stats.watermark:
+            self._apply_watermark(self.get_group_from_id(group_id, db), user_stats)
+
         user_stats.last_read = the_time
+        user_stats.last_read_seq = self._message_seq_of(group_id)
         user_stats.last_sent = the_time
         user_stats.last_sent_group_id = group_id
         user_stats.last_updated_time = the_time
@@ -976,6 +1454,7 @@ class RelationalHandler:
         db.add(user_stats)
         db.commit()
 
+    @pins_to_primary("owner_id")
     def create_group(
         self, owner_id: int, query: CreateGroupQuery, utc_now, db: Session
     ) -> GroupBase:
@@ -1010,18 +1489,35 @@ class RelationalHandler:
         user_ids = {owner_id}
         user_ids.update(query.users)
 
-        for user_id in user_ids:
-            self.env.cache.reset_count_group_types_for_user(user_id)
-            user_stats = self._create_user_stats(
-                group_entity.group_id, user_id, created_at
+        db.execute(insert(models.UserGroupStatsEntity.__table__).values([
+            self._user_stats_values(
+                group_entity.group_id,
+                user_id,
+                created_at,
+                sort_time=utc_now,
+                watermark=False,
+                last_read_seq=0,
+                cleared=False,
             )
-            db.add(user_stats)
+            for user_id in user_ids
+        ]))
 
-        base = GroupBase(**group_entity.__dict__)
+        base = self._to_base(GroupBase, group_entity)
 
         db.add(group_entity)
         db.commit()
 
+        self.env.cache.set_group(base)
+
+        if query.group_type == GroupTypes.ONE_TO_ONE:
+            self.env.cache.add_1to1_group(group_id)
+
+        # last_message_time is after created_at, so it's counted for everyone
+        for user_id in user_ids:
+            self.env.cache.increase_count_group_types_for_user(
+                user_id, {(False, query.group_type): 1}
+            )
+
         return base
 
     # noinspection PyMethodMayBeStatic
@@ -1035,7 +1531,27 @@ class RelationalHandler:
         )
 
         db.commit()
+        self.env.cache.remove_group(group_id)
 
+    @read_replica(user_arg=None)
+    @time_method(logger, "get_group_ids_after()")
+    # noinspection PyMethodMayBeStatic
+    def get_group_ids_after(self, after_id: int, limit: int, db: Session) -> List[Tuple[int, str]]:
+        """
+        all groups ordered by primary key, used by backfill.py to walk them in batches
+        """
+        return (
+            db.query(
+                models.GroupEntity.id,
+                models.GroupEntity.group_id,
+            )
+            .filter(models.GroupEntity.id > after_id)
+            .order_by(models.GroupEntity.id)
+            .limit(limit)
+            .all()
+        )
+
+    @read_replica(user_arg=None)
     @time_method(logger, "get_groups_with_undeleted_messages()")
     def get_groups_with_undeleted_messages(self, db: Session):
         """
@@ -1064,11 +1580,16 @@ class RelationalHandler:
                         else 0 end
                     ),
                 0) = 0;
+
+        but using the delete_before derived from the group's watermark, since it's
+        not stored for large groups until the user's stats are updated
         """
+        delete_before = self._watermarked_stats()["delete_before"]
+
         return (
             db.query(
                 models.GroupEntity.group_id,
-                func.min(models.UserGroupStatsEntity.delete_before)
+                func.min(delete_before)
             )
             .join(
                 models.UserGroupStatsEntity,
@@ -1080,7 +1601,7 @@ class RelationalHandler:
             .having(
                 func.coalesce(
                     func.sum(case(
-                        [(models.UserGroupStatsEntity.delete_before <= models.GroupEntity.first_message_time, 1)],
+                        [(delete_before <= models.GroupEntity.first_message_time, 1)],
                         else_=0
                     )),
                     0
@@ -1100,15 +1621,175 @@ class RelationalHandler:
             .first()
         )
 
-    def _create_user_stats(
-        self, group_id: str, user_id: int, default_dt: dt
-    ) -> models.UserGroupStatsEntity:
+    @staticmethod
+    def _sort_time_for(group_id: str, highlight_time: dt):
+        """
+        greatest(highlight_time, last_message_time of the group), evaluated by
+        the database when flushing, so a message sent meanwhile isn't missed
+        """
+        last_message_time = (
+            select([models.GroupEntity.last_message_time])
+            .where(models.GroupEntity.group_id == group_id)
+            .as_scalar()
+        )
+
+        return func.greatest(highlight_time, last_message_time)
+
+    @staticmethod
+    def _message_seq_of(group_id: str):
+        """
+        message_seq of the group, evaluated by the database when flushing
+        """
+        return (
+            select([models.GroupEntity.message_seq])
+            .where(models.GroupEntity.group_id == group_id)
+            .as_scalar()
+        )
+
+    @staticmethod
+    def _watermarked_stats(wakeup_time=None, last_message_time=None) -> dict:
+        """
+        the hide, delete_before, last_updated_time and sort_time of the user stats
+        as they would be if every message had updated them; the stats are only
+        updated for groups with few users, but these expressions are correct for
+        all groups, so they can always be used instead of the columns
+
+        the group columns default to the ones of a query joined with the groups
+        table; user stats are "woken up" (un-hidden) if a message that wakes users
+        up was sent after their stats were last updated
+        """
+        stats = models.UserGroupStatsEntity
+
+        if wakeup_time is None:
+            wakeup_time = models.GroupEntity.wakeup_time
+        if last_message_time is None:
+            last_message_time = models.GroupEntity.last_message_time
+
+        woken_up = wakeup_time > stats.last_updated_time
+
+        return {
+            "hide": case([(woken_up, literal(False))], else_=stats.hide),
+            "delete_before": case([(woken_up, stats.join_time)], else_=stats.delete_before),
+            "last_updated_time": func.greatest(stats.last_updated_time, last_message_time),
+            "sort_time": func.greatest(stats.sort_time, last_message_time),
+        }
+
+    @staticmethod
+    def _materialize_watermark(joined: bool = False) -> dict:
+        """
+        values for a bulk update of user stats that stores the watermarked values;
+        has to be included when last_updated_time is overwritten, otherwise a
+        wakeup from the group would be lost
+
+        :param joined: True if the update already has the groups table in its
+                       FROM clause, otherwise correlated subqueries are used
+        """
+        def of_group(column):
+            return (
+                select([column])
+                .where(models.GroupEntity.group_id == models.UserGroupStatsEntity.group_id)
+                .as_scalar()
+            )
+
+        if joined:
+            stats = RelationalHandler._watermarked_stats()
+        else:
+            stats = RelationalHandler._watermarked_stats(
+                wakeup_time=of_group(models.GroupEntity.wakeup_time),
+                last_message_time=of_group(models.GroupEntity.last_message_time),
+            )
+
+        return {
+            models.UserGroupStatsEntity.hide: stats["hide"],
+            models.UserGroupStatsEntity.delete_before: stats["delete_before"],
+            models.UserGroupStatsEntity.sort_time: stats["sort_time"],
+        }
+
+    @staticmethod
+    def _to_base(schema, values, offset: int = 0):
+        """
+        creates a GroupBase or UserGroupStatsBase without validation, the values
+        come from the database so they already have the right types
+
+        :param schema: GroupBase or UserGroupStatsBase
+        :param values: an entity, or a row with the columns of the schema (see
+                       GROUP_BASE_COLUMNS) starting at position `offset`
+        """
+        if isinstance(values, tuple):
+            fields = zip(schema.__fields__, values[offset:offset + len(schema.__fields__)])
+        else:
+            fields = ((field, getattr(values, field)) for field in schema.__fields__)
+
+        return schema.construct(**dict(fields))
+
+    def _group_and_stats_from_row(self, row) -> Tuple[GroupBase, UserGroupStatsBase]:
+        """
+        :param row: GROUP_BASE_COLUMNS, USER_STATS_BASE_COLUMNS and the watermark
+                    flag of the user stats, in that order
+        """
+        n_group_columns = len(GROUP_BASE_COLUMNS)
+
+        group = self._to_base(GroupBase, row)
+        user_stats = self._to_base(UserGroupStatsBase, row, offset=n_group_columns)
+
+        if row[n_group_columns + len(USER_STATS_BASE_COLUMNS)]:
+            self._apply_watermark(group, user_stats)
+
+        return group, user_stats
+
+    @staticmethod
+    def _apply_watermark(group: GroupBase, user_stats) -> None:
+        """
+        same as _watermarked_stats() but in python; applied to a UserGroupStatsBase
+        it's only for reading, and applied to an entity the values will be stored
+        (lazily materialized) when it's committed
+        """
+        if group.wakeup_time is not None and group.wakeup_time > user_stats.last_updated_time:
+            user_stats.hide = False
+            user_stats.delete_before = user_stats.join_time
+
+        if user_stats.sort_time is None or user_stats.sort_time < group.last_message_time:
+            user_stats.sort_time = group.last_message_time
+
+        if user_stats.last_updated_time < group.last_message_time:
+            user_stats.last_updated_time = group.last_message_time
+
+    def _user_stats_values(
+        self,
+        group_id: str,
+        user_id: int,
+        default_dt: dt,
+        sort_time: dt = None,
+        watermark: bool = None,
+        last_read_seq: int = None,
+        cleared: bool = True,
+    ) -> dict:
+        """
+        column values of a new user_group_stats row, for bulk inserts; `cleared`
+        is True unless the group's last message is after `default_dt`
+        """
         now = utcnow_dt()
 
-        return models.UserGroupStatsEntity(
+        if sort_time is None:
+            sort_time = self._sort_time_for(group_id, self.long_ago)
+
+        # same as the group, evaluated by the database when inserting
+        if watermark is None:
+            watermark = (
+                select([models.GroupEntity.watermark])
+                .where(models.GroupEntity.group_id == group_id)
+                .as_scalar()
+            )
+
+        # last_read is now, so everything sent so far has been read
+        if last_read_seq is None:
+            last_read_seq = self._message_seq_of(group_id)
+
+        return dict(
             group_id=group_id,
             user_id=user_id,
             last_read=default_dt,
+            last_read_seq=last_read_seq,
             delete_before=default_dt,  # TODO: for group chats, should this be long_ago or join_time? to see old history
             last_sent=default_dt,
             join_time=default_dt,
@@ -1116,4 +1797,7 @@ class RelationalHandler:
             hide=False,
             pin=False,
             highlight_time=self.long_ago,
+            sort_time=sort_time,
+            watermark=watermark,
+            cleared=cleared,
         )
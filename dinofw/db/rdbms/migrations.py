@@ -0,0 +1,230 @@
+import logging
+from typing import List
+from typing import Tuple
+
+from sqlalchemy import text
+
+from dinofw.utils.exceptions import SchemaOutdatedException
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+# (version, description, statements); never change a migration after it has been
+# deployed, add a new one instead, and keep the models in models.py in sync with
+# the result; every statement is idempotent, so an existing database that was
+# created before this table existed can be upgraded from version 1
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "initial schema", [
+        """
+        CREATE TABLE IF NOT EXISTS groups (
+            id SERIAL NOT NULL,
+            group_id VARCHAR(36),
+            name VARCHAR(128),
+            owner_id INTEGER,
+            status INTEGER,
+            group_type INTEGER DEFAULT '0',
+            created_at TIMESTAMP WITH TIME ZONE,
+            first_message_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE,
+            last_message_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            last_message_user_id INTEGER,
+            last_message_id VARCHAR(36),
+            last_message_type INTEGER DEFAULT '0' NOT NULL,
+            last_message_overview VARCHAR(512),
+            meta INTEGER,
+            context VARCHAR(512),
+            description VARCHAR(256),
+            PRIMARY KEY (id)
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_groups_group_id ON groups (group_id)",
+        "CREATE INDEX IF NOT EXISTS ix_groups_first_message_time ON groups (first_message_time)",
+        "CREATE INDEX IF NOT EXISTS ix_groups_updated_at ON groups (updated_at)",
+        "CREATE INDEX IF NOT EXISTS ix_groups_last_message_time ON groups (last_message_time)",
+        """
+        CREATE TABLE IF NOT EXISTS user_group_stats (
+            id SERIAL NOT NULL,
+            group_id VARCHAR(36),
+            user_id INTEGER,
+            last_read TIMESTAMP WITH TIME ZONE,
+            last_sent TIMESTAMP WITH TIME ZONE,
+            delete_before TIMESTAMP WITH TIME ZONE,
+            join_time TIMESTAMP WITH TIME ZONE,
+            first_sent TIMESTAMP WITH TIME ZONE,
+            last_updated_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            highlight_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            pin BOOLEAN NOT NULL,
+            hide BOOLEAN NOT NULL,
+            bookmark BOOLEAN NOT NULL,
+            rating INTEGER,
+            PRIMARY KEY (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_user_group_stats_group_id ON user_group_stats (group_id)",
+        "CREATE INDEX IF NOT EXISTS ix_user_group_stats_user_id ON user_group_stats (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_user_group_stats_pin ON user_group_stats (pin)",
+    ]),
+    (2, "sort time for keyset pagination of the inbox", [
+        "ALTER TABLE user_group_stats ADD COLUMN IF NOT EXISTS sort_time TIMESTAMP WITH TIME ZONE",
+        """
+        UPDATE user_group_stats u
+        SET sort_time = greatest(u.highlight_time, g.last_message_time)
+        FROM groups g
+        WHERE g.group_id = u.group_id AND u.sort_time IS NULL
+        """,
+    ]),
+    (3, "watermarks for large groups", [
+        "ALTER TABLE groups ADD COLUMN IF NOT EXISTS wakeup_time TIMESTAMP WITH TIME ZONE",
+        "ALTER TABLE groups ADD COLUMN IF NOT EXISTS watermark BOOLEAN DEFAULT false NOT NULL",
+        "ALTER TABLE user_group_stats ADD COLUMN IF NOT EXISTS watermark BOOLEAN DEFAULT false NOT NULL",
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_group_stats_watermark
+        ON user_group_stats (user_id, watermark)
+        """,
+    ]),
+    (4, "unique (user_id, group_id) and partial indexes for user stats", [
+        # duplicates could be created by concurrent joins before the constraint existed
+        """
+        DELETE FROM user_group_stats a
+        USING user_group_stats b
+        WHERE a.group_id = b.group_id AND a.user_id = b.user_id AND a.id > b.id
+        """,
+        # also used by the upsert when joining groups, ON CONFLICT doesn't care about the column order
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_user_group_stats_user_group
+        ON user_group_stats (user_id, group_id)
+        """,
+        # the (group_id, user_id) constraint might have been added manually; user_id
+        # alone is covered by the composite index
+        "ALTER TABLE user_group_stats DROP CONSTRAINT IF EXISTS uq_user_group_stats_group_user",
+        "DROP INDEX IF EXISTS ix_user_group_stats_user_id",
+        "DROP INDEX IF EXISTS idx_user_group_stats_inbox",
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_group_stats_inbox
+        ON user_group_stats (user_id, pin, sort_time, group_id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_group_stats_inbox_visible
+        ON user_group_stats (user_id, pin, sort_time, group_id)
+        WHERE hide = false
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_group_stats_bookmark
+        ON user_group_stats (user_id)
+        WHERE bookmark = true
+        """,
+    ]),
+    (5, "message sequence numbers for counting unread messages", [
+        # existing groups stay NULL until their messages are counted, only new groups start at 0
+        "ALTER TABLE groups ADD COLUMN IF NOT EXISTS message_seq BIGINT",
+        "ALTER TABLE groups ALTER COLUMN message_seq SET DEFAULT 0",
+        "ALTER TABLE user_group_stats ADD COLUMN IF NOT EXISTS last_read_seq BIGINT",
+    ]),
+    (6, "flag for members whose group type counts can change on new messages", [
+        "ALTER TABLE user_group_stats ADD COLUMN IF NOT EXISTS cleared BOOLEAN DEFAULT false NOT NULL",
+        """
+        UPDATE user_group_stats u
+        SET cleared = true
+        FROM groups g
+        WHERE g.group_id = u.group_id AND u.delete_before >= g.last_message_time AND NOT u.cleared
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_user_group_stats_uncounted
+        ON user_group_stats (group_id)
+        WHERE hide = true OR cleared = true
+        """,
+    ]),
+    (7, "sort time of stats inserted by servers from before version 2", [
+        """
+        UPDATE user_group_stats u
+        SET sort_time = greatest(u.highlight_time, g.last_message_time)
+        FROM groups g
+        WHERE g.group_id = u.group_id AND u.sort_time IS NULL
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection) -> int:
+    if not connection.dialect.has_table(connection, SCHEMA_VERSION_TABLE):
+        return 0
+
+    version = connection.execute(
+        text(f"SELECT max(version) FROM {SCHEMA_VERSION_TABLE}")
+    ).scalar()
+
+    return version or 0
+
+
+def check_schema(engine) -> None:
+    """
+    called on startup; the migrations are postgres only, other databases (e.g.
+    sqlite for local development) are expected to be created from the models
+    """
+    if engine.dialect.name != "postgresql":
+        return
+
+    with engine.connect() as connection:
+        version = current_version(connection)
+
+    if version < LATEST_VERSION:
+        raise SchemaOutdatedException(
+            f"database schema is at version {version} but {LATEST_VERSION} is "
+            f"required, run 'python migrate.py' with the same environment first"
+        )
+
+    if version > LATEST_VERSION:
+        logger.warning(
+            f"database schema is at version {version}, newer than {LATEST_VERSION}; "
+            f"an older version of the service is running against an upgraded database"
+        )
+
+
+def upgrade(engine) -> int:
+    """
+    applies the migrations newer than the current version of the database, each
+    in its own transaction; the indexes aren't created concurrently, so the
+    tables are locked for writes while they're built
+
+    :return: the version of the schema after upgrading
+    """
+    with engine.begin() as connection:
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} ("
+            f"version INTEGER PRIMARY KEY, "
+            f"description VARCHAR(256), "
+            f"applied_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL)"
+        ))
+
+    with engine.connect() as connection:
+        version = current_version(connection)
+
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        logger.info(f"migrating database schema to version {migration_version}: {description}")
+
+        with engine.begin() as connection:
+            # only one instance can run a migration at a time
+            connection.execute(text(f"LOCK TABLE {SCHEMA_VERSION_TABLE} IN EXCLUSIVE MODE"))
+
+            if current_version(connection) >= migration_version:
+                continue
+
+            for statement in statements:
+                connection.execute(text(statement))
+
+            connection.execute(
+                text(f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, description) VALUES (:version, :description)"),
+                version=migration_version,
+                description=description,
+            )
+
+        version = migration_version
+
+    logger.info(f"database schema is at version {version}")
+    return version
@@ -1,8 +1,11 @@
+from sqlalchemy import BigInteger
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import DateTime
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
+from sqlalchemy import text
 
 from dinofw.utils.environ import env
 
@@ -35,6 +38,16 @@ class GroupEntity(env.Base):
     last_message_type = Column(Integer, nullable=False, server_default="0")
     last_message_overview = Column(String(512), nullable=True)
 
+    # time of the last message that un-hid the group for everyone; large groups
+    # (watermark=true) only update this row when a message is sent, and the hide,
+    # delete_before and sort_time of the members are derived from it when read
+    wakeup_time = Column(DateTime(timezone=True), nullable=True)
+    watermark = Column(Boolean, default=False, nullable=False, server_default="false")
+
+    # number of messages sent in the group, increased with every new message; NULL
+    # for groups created before it was added, until the messages have been counted
+    message_seq = Column(BigInteger, nullable=True, default=0, server_default="0")
+
     meta = Column(Integer, nullable=True)
     context = Column(String(512), nullable=True)
     description = Column(String(256), nullable=True)
@@ -45,8 +58,9 @@ class UserGroupStatsEntity(env.Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
 
+    # user_id is the first column of the unique index below
     group_id = Column(String(36), index=True)
-    user_id = Column(Integer, index=True)
+    user_id = Column(Integer)
 
     last_read = Column(DateTime(timezone=True))
     last_sent = Column(DateTime(timezone=True))
@@ -60,6 +74,10 @@ class UserGroupStatsEntity(env.Base):
     # a user can highlight a 1-to-1 group for ANOTHER user
     highlight_time = Column(DateTime(timezone=True), nullable=False)
 
+    # greatest(highlight_time, groups.last_message_time), kept here so the inbox
+    # can be paginated using the index below instead of sorting all groups
+    sort_time = Column(DateTime(timezone=True))
+
     # a user can pin groups he/she wants to keep on top, and will be sorted higher than last_message_time
     pin = Column(Boolean, default=False, nullable=False, index=True)
 
@@ -71,3 +89,53 @@ class UserGroupStatsEntity(env.Base):
 
     # a user can rate conversations
     rating = Column(Integer, nullable=True)
+
+    # same as groups.watermark; if true, hide, delete_before, last_updated_time and
+    # sort_time might be older than the group's last message, see RelationalHandler
+    watermark = Column(Boolean, default=False, nullable=False, server_default="false")
+
+    # groups.message_seq when last_read was set, unread is the difference; NULL if
+    # not known (e.g. last_read set by the api), then the messages are counted
+    last_read_seq = Column(BigInteger, nullable=True)
+
+    # true if delete_before might be after the group's last message (joined or
+    # cleared the history since), then the group isn't in the user's group type
+    # counts until the next message; only these and hidden groups are checked when
+    # a message is sent, see RelationalHandler.update_group_new_message()
+    cleared = Column(Boolean, default=False, nullable=False, server_default="false")
+
+    # created by migrations.py, keep in sync with the latest migration
+    __table_args__ = (
+        # also needed for upserting stats when users join, see RelationalHandler
+        Index(
+            "uq_user_group_stats_user_group",
+            "user_id", "group_id",
+            unique=True,
+        ),
+        Index(
+            "idx_user_group_stats_inbox",
+            "user_id", "pin", "sort_time", "group_id",
+        ),
+        # the inbox without hidden groups, most queries don't include them
+        Index(
+            "idx_user_group_stats_inbox_visible",
+            "user_id", "pin", "sort_time", "group_id",
+            postgresql_where=text("hide = false"),
+        ),
+        # for counting unread groups, bookmarked groups count as unread
+        Index(
+            "idx_user_group_stats_bookmark",
+            "user_id",
+            postgresql_where=text("bookmark = true"),
+        ),
+        Index(
+            "idx_user_group_stats_watermark",
+            "user_id", "watermark",
+        ),
+        # the members whose group type counts can change when a message is sent
+        Index(
+            "idx_user_group_stats_uncounted",
+            "group_id",
+            postgresql_where=text("hide = true or cleared = true"),
+        ),
+    )
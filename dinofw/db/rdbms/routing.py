@@ -0,0 +1,93 @@
+import inspect
+import threading
+from functools import wraps
+from typing import Optional
+
+_replica = threading.local()
+
+
+def reading_from_replica() -> bool:
+    """
+    True while a read_replica() method runs on a replica in this thread; what it
+    reads can be behind the primary, so it's not written to the shared cache,
+    where every worker would read the stale values until they expire
+    """
+    return getattr(_replica, "active", False)
+
+
+def read_replica(user_arg: Optional[str] = "user_id"):
+    """
+    runs a RelationalHandler method using a session on a read replica instead of
+    the `db` session it was called with; the primary is still used if the user in
+    argument `user_arg` wrote something recently (see pins_to_primary()), if no
+    replicas are configured, or if called with `primary=True`, e.g. by callers
+    that cache what the method returns
+
+    :param user_arg: name of the argument with the user id, or None if the query
+                     isn't for a specific user, e.g. for the deleter
+    """
+    def factory(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(self, *args, primary: bool = False, **kwargs):
+            if self.env.ReplicaSessionLocal is None or primary:
+                return func(self, *args, **kwargs)
+
+            arguments = signature.bind(self, *args, **kwargs)
+
+            if user_arg is not None:
+                user_id = arguments.arguments[user_arg]
+
+                if self.env.cache.is_user_pinned_to_primary(user_id):
+                    return func(self, *args, **kwargs)
+
+            replica = self.env.ReplicaSessionLocal()
+            arguments.arguments["db"] = replica
+
+            was_active = reading_from_replica()
+            _replica.active = True
+
+            try:
+                return func(*arguments.args, **arguments.kwargs)
+            finally:
+                _replica.active = was_active
+                replica.close()
+
+        return wrapper
+    return factory
+
+
+def pins_to_primary(*user_args: str):
+    """
+    after a RelationalHandler method has written something for the users in the
+    arguments `user_args` (a user id, or a list/dict of user ids), reads for those
+    users go to the primary for a few seconds, so they see their own changes
+    """
+    def factory(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            result = func(self, *args, **kwargs)
+
+            if self.env.ReplicaSessionLocal is None:
+                return result
+
+            arguments = signature.bind(self, *args, **kwargs).arguments
+            user_ids = list()
+
+            for user_arg in user_args:
+                value = arguments[user_arg]
+
+                if isinstance(value, int):
+                    user_ids.append(value)
+                else:
+                    user_ids.extend(value)
+
+            self.env.cache.pin_users_to_primary(user_ids, self.replica_pin_ttl)
+
+            return result
+
+        return wrapper
+    return factory
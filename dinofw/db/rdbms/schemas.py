@@ -17,6 +17,8 @@ class GroupBase(BaseModel):
     last_message_overview: Optional[str]
     last_message_type: Optional[int]
     last_message_user_id: Optional[int]
+    wakeup_time: Optional[datetime]
+    message_seq: Optional[int]
 
     status: Optional[int]
     group_type: int
@@ -41,6 +43,8 @@ class UserGroupStatsBase(BaseModel):
     highlight_time: Optional[datetime]
     last_updated_time: datetime
     first_sent: Optional[datetime]
+    sort_time: Optional[datetime]
+    last_read_seq: Optional[int]
 
     hide: bool
     pin: bool
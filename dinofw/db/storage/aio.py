@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import time
+from functools import partial
+
+from dinofw.utils.config import ConfigKeys
+from dinofw.utils.executor import ExecutorProxy
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStorage(ExecutorProxy):
+    """
+    Awaitable version of the storage handler; every method of the wrapped
+    handler can be awaited through this class, with the same arguments, e.g.:
+
+        messages = await self.env.async_storage.get_messages_in_group_for_user(group_id, user_stats, query)
+
+    Methods the handler implements natively on top of the driver's execute_async
+    (the same name with an `_async` suffix, see CassandraHandler) are awaited
+    directly, without occupying a thread while waiting for cassandra; the other
+    methods still use the object mapper, and run in a thread pool instead.
+
+    At most `max_in_flight` requests are sent to cassandra at the same time,
+    the rest wait here instead of piling up in the driver's connections; the
+    reported wait is the wait for the limiter, not for a thread.
+    The sync handler (env.storage) is still used by the cron jobs and background tasks.
+    """
+
+    wait_stat = "storage.limiter.wait"
+
+    def __init__(self, env, storage):
+        self.storage = storage
+
+        storage_conf = env.config.get(ConfigKeys.STORAGE, default=dict()) or dict()
+        self.max_in_flight = int(storage_conf.get(ConfigKeys.MAX_IN_FLIGHT, 256))
+
+        # created on first use, has to belong to the event loop of the server
+        self.limiter = None
+
+        super().__init__(
+            env, max_workers=int(storage_conf.get(ConfigKeys.POOL_SIZE, 20)), thread_name_prefix="storage"
+        )
+
+    def _wrapped(self):
+        return self.storage
+
+    def __getattr__(self, item):
+        native = getattr(self.storage, f"{item}_async", None)
+        method = getattr(self.storage, item)
+
+        async def call(*args, **kwargs):
+            if self.limiter is None:
+                self.limiter = asyncio.Semaphore(self.max_in_flight)
+
+            submitted = time.monotonic()
+
+            async with self.limiter:
+                self._report_wait(time.monotonic() - submitted)
+
+                self.n_in_flight += 1
+                try:
+                    if native is not None:
+                        return await native(*args, **kwargs)
+
+                    return await asyncio.get_running_loop().run_in_executor(
+                        self.executor, partial(method, *args, **kwargs)
+                    )
+                finally:
+                    self.n_in_flight -= 1
+
+        return call
+
+    def _report_gauges(self) -> None:
+        self.env.stats.gauge("storage.in_flight", self.n_in_flight)
@@ -19,17 +19,28 @@ from cassandra.cqlengine.query import BatchQuery
 from cassandra.policies import DCAwareRoundRobinPolicy
 from cassandra.policies import RetryPolicy
 from cassandra.policies import TokenAwarePolicy
+from cassandra.query import tuple_factory
 
+from dinofw.db.rdbms.routing import reading_from_replica
 from dinofw.db.rdbms.schemas import UserGroupStatsBase
+from dinofw.db.storage.models import AttachmentBucketModel
+from dinofw.db.storage.models import AttachmentByFileModel
 from dinofw.db.storage.models import AttachmentModel
+from dinofw.db.storage.models import BucketModel
+from dinofw.db.storage.models import MessageBucketModel
+from dinofw.db.storage.models import MessageByIdModel
 from dinofw.db.storage.models import MessageModel
 from dinofw.db.storage.schemas import MessageBase
+from dinofw.db.storage.statements import PROFILE_BATCH
+from dinofw.db.storage.statements import PROFILE_ROWS
+from dinofw.db.storage.statements import Statements
 from dinofw.rest.models import AttachmentQuery
 from dinofw.rest.models import CreateActionLogQuery
 from dinofw.rest.models import CreateAttachmentQuery
 from dinofw.rest.models import MessageQuery
 from dinofw.rest.models import SendMessageQuery
 from dinofw.utils import utcnow_dt
+from dinofw.utils.config import BucketModes
 from dinofw.utils.config import ConfigKeys
 from dinofw.utils.config import DefaultValues
 from dinofw.utils.config import MessageTypes
@@ -46,6 +57,17 @@ class CassandraHandler:
         beginning_of_1995 = 789_000_000
         self.long_ago = dt.utcfromtimestamp(beginning_of_1995)
 
+        # prepared in setup_tables() when connected
+        self.statements: Optional[Statements] = None
+
+        # while migrating to the bucketed tables, writes go to both the old and
+        # the bucketed tables, and backfill.py copies the existing rows
+        storage_conf = env.config.get(ConfigKeys.STORAGE, default=dict()) or dict()
+        bucket_mode = str(storage_conf.get(ConfigKeys.BUCKETS, BucketModes.OFF)).strip().lower()
+
+        self.write_buckets = bucket_mode in [BucketModes.DUAL, BucketModes.ON]
+        self.read_buckets = bucket_mode == BucketModes.ON
+
     def setup_tables(self):
         key_space = self.env.config.get(ConfigKeys.KEY_SPACE, domain=ConfigKeys.STORAGE)
         hosts = self.env.config.get(ConfigKeys.HOST, domain=ConfigKeys.STORAGE)
@@ -62,14 +84,21 @@ class CassandraHandler:
                 # should probably be changed to QUORUM when having more than 3 nodes in the cluster
                 consistency_level=ConsistencyLevel.LOCAL_ONE,
             ),
-            # TODO: there doesn't seem to be a way to specify execution profile when
-            #  using the library's object mapping approach, only when writing pure
-            #  cql queries:
-            #  https://docs.datastax.com/en/developer/python-driver/3.24/execution_profiles/
+            # the object mapper can't specify an execution profile, these are used
+            # by the prepared statements in statements.py; rows are plain tuples
+            # since they're converted to MessageBase right away anyway
+            PROFILE_ROWS: ExecutionProfile(
+                load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
+                retry_policy=RetryPolicy(),
+                request_timeout=10.0,
+                row_factory=tuple_factory,
+                consistency_level=ConsistencyLevel.LOCAL_ONE,
+            ),
             # batch profile has longer timeout since they are run async anyway
-            "batch": ExecutionProfile(
+            PROFILE_BATCH: ExecutionProfile(
                 load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()),
                 request_timeout=120.0,
+                row_factory=tuple_factory,
                 consistency_level=ConsistencyLevel.LOCAL_ONE,
             )
         }
@@ -95,6 +124,15 @@ class CassandraHandler:
 
         sync_table(MessageModel)
         sync_table(AttachmentModel)
+        sync_table(MessageByIdModel)
+        sync_table(AttachmentByFileModel)
+
+        if self.write_buckets:
+            sync_table(MessageBucketModel)
+            sync_table(AttachmentBucketModel)
+            sync_table(BucketModel)
+
+        self.statements = Statements(connection.get_session(), key_space, buckets=self.write_buckets)
 
     def _get_from_conf(self, key, domain):
         if key not in self.env.config.get(domain):
@@ -106,7 +144,6 @@ class CassandraHandler:
 
         return value
 
-    # noinspection PyMethodMayBeStatic
     def get_messages_in_group(
         self,
         group_id: str,
@@ -114,6 +151,15 @@ class CassandraHandler:
     ) -> List[MessageBase]:
         until = MessageQuery.to_dt(query.until)
 
+        if self.read_buckets:
+            return self.statements.messages_in_buckets(
+                self.statements.messages_in_bucket_for_user,
+                Statements.to_uuid(group_id),
+                until,
+                self.long_ago,
+                query.per_page or DefaultValues.PER_PAGE,
+            )
+
         raw_messages = (
             MessageModel.objects(
                 MessageModel.group_id == group_id,
@@ -130,71 +176,107 @@ class CassandraHandler:
 
         return messages
 
-    # noinspection PyMethodMayBeStatic
     def get_attachments_in_group_for_user(
             self,
             group_id: str,
             user_stats: UserGroupStatsBase,
             query: MessageQuery
     ) -> List[MessageBase]:
-        until = MessageQuery.to_dt(query.until)
-
-        raw_attachments = (
-            AttachmentModel.objects(
-                AttachmentModel.group_id == group_id,
-                AttachmentModel.created_at <= until,
-                AttachmentModel.created_at > user_stats.delete_before,
+        if self.read_buckets:
+            return self.statements.messages_in_buckets(
+                self.statements.attachments_in_bucket_for_user,
+                *CassandraHandler._for_user_parameters(group_id, user_stats, query)
             )
-            .limit(query.per_page or DefaultValues.PER_PAGE)
-            .all()
-        )
 
-        attachments = list()
+        return self.statements.messages(
+            self.statements.attachments_for_user,
+            *CassandraHandler._for_user_parameters(group_id, user_stats, query)
+        )
 
-        for attachment in raw_attachments:
-            attachments.append(CassandraHandler.message_base_from_entity(attachment))
+    async def get_attachments_in_group_for_user_async(
+            self,
+            group_id: str,
+            user_stats: UserGroupStatsBase,
+            query: MessageQuery
+    ) -> List[MessageBase]:
+        if self.read_buckets:
+            return await self.statements.messages_in_buckets_async(
+                self.statements.attachments_in_bucket_for_user,
+                *CassandraHandler._for_user_parameters(group_id, user_stats, query)
+            )
 
-        return attachments
+        return await self.statements.messages_async(
+            self.statements.attachments_for_user,
+            *CassandraHandler._for_user_parameters(group_id, user_stats, query)
+        )
 
-    # noinspection PyMethodMayBeStatic
     def get_messages_in_group_for_user(
             self,
             group_id: str,
             user_stats: UserGroupStatsBase,
             query: MessageQuery
     ) -> List[MessageBase]:
-        until = MessageQuery.to_dt(query.until)
-
-        raw_messages = (
-            MessageModel.objects(
-                MessageModel.group_id == group_id,
-                MessageModel.created_at < until,
-                MessageModel.created_at > user_stats.delete_before,
+        if self.read_buckets:
+            return self.statements.messages_in_buckets(
+                self.statements.messages_in_bucket_for_user,
+                *CassandraHandler._for_user_parameters(group_id, user_stats, query)
             )
-            .limit(query.per_page or DefaultValues.PER_PAGE)
-            .all()
+
+        return self.statements.messages(
+            self.statements.messages_for_user,
+            *CassandraHandler._for_user_parameters(group_id, user_stats, query)
         )
 
-        messages = list()
+    async def get_messages_in_group_for_user_async(
+            self,
+            group_id: str,
+            user_stats: UserGroupStatsBase,
+            query: MessageQuery
+    ) -> List[MessageBase]:
+        if self.read_buckets:
+            return await self.statements.messages_in_buckets_async(
+                self.statements.messages_in_bucket_for_user,
+                *CassandraHandler._for_user_parameters(group_id, user_stats, query)
+            )
 
-        for message in raw_messages:
-            messages.append(CassandraHandler.message_base_from_entity(message))
+        return await self.statements.messages_async(
+            self.statements.messages_for_user,
+            *CassandraHandler._for_user_parameters(group_id, user_stats, query)
+        )
 
-        return messages
+    @staticmethod
+    def _for_user_parameters(group_id: str, user_stats: UserGroupStatsBase, query: MessageQuery) -> tuple:
+        return (
+            Statements.to_uuid(group_id),
+            MessageQuery.to_dt(query.until),
+            user_stats.delete_before,
+            query.per_page or DefaultValues.PER_PAGE,
+        )
 
-    # noinspection PyMethodMayBeStatic
     def count_messages_in_group_since(self, group_id: str, since: dt) -> int:
-        return (
-            MessageModel.objects(
-                MessageModel.group_id == group_id,
-            )
-            .filter(
-                MessageModel.created_at > since,
-            )
-            .limit(None)
-            .count()
+        if self.read_buckets:
+            return self.statements.count_in_buckets(Statements.to_uuid(group_id), since)
+
+        (count,) = self.statements.execute(
+            self.statements.count_messages_since,
+            Statements.to_uuid(group_id),
+            since,
+        ).one()
+
+        return count
+
+    async def count_messages_in_group_since_async(self, group_id: str, since: dt) -> int:
+        if self.read_buckets:
+            return await self.statements.count_in_buckets_async(Statements.to_uuid(group_id), since)
+
+        rows = await self.statements.execute_async(
+            self.statements.count_messages_since,
+            Statements.to_uuid(group_id),
+            since,
         )
 
+        return rows[0][0]
+
     def get_unread_in_group(self, group_id: str, user_id: int, last_read: dt) -> int:
         unread = self.env.cache.get_unread_in_group(group_id, user_id)
         if unread is not None:
@@ -202,7 +284,10 @@ class CassandraHandler:
 
         unread = self.count_messages_in_group_since(group_id, last_read)
 
-        self.env.cache.set_unread_in_group(group_id, user_id, unread)
+        # last_read from a replica can be behind, see read_replica()
+        if not reading_from_replica():
+            self.env.cache.set_unread_in_group(group_id, user_id, unread)
+
         return unread
 
     def delete_attachments_in_all_groups(
@@ -229,28 +314,65 @@ class CassandraHandler:
         return group_to_atts
 
     def delete_messages_in_group_before(self, group_id: str, before: dt):
-        messages = (
-            MessageModel.objects(
-                MessageModel.group_id == group_id,
-                MessageModel.created_at <= before,
-            )
-            .all()
+        self.logger.info(f"deleting messages in group {group_id} before {before}...")
+        self._delete_lookups_before(
+            group_id, before, self.statements.message_ids_before, self.statements.delete_message_id
+        )
+        self.statements.execute(
+            self.statements.delete_messages_before,
+            Statements.to_uuid(group_id),
+            before,
         )
 
-        self.logger.info(f"deleting {len(messages)} messages in group {group_id}...")
-        self._delete_messages(messages, "messages")
+        if self.write_buckets:
+            self._delete_buckets_before(
+                group_id,
+                before,
+                self.statements.delete_messages_bucket,
+                self.statements.delete_messages_in_bucket_before,
+            )
 
     def delete_attachments_in_group_before(self, group_id: str, before: dt):
-        attachments = (
-            AttachmentModel.objects(
-                AttachmentModel.group_id == group_id,
-                AttachmentModel.created_at <= before,
-            )
-            .all()
+        self.logger.info(f"deleting attachments in group {group_id} before {before}...")
+        self._delete_lookups_before(
+            group_id, before, self.statements.file_ids_before, self.statements.delete_file_id
+        )
+        self.statements.execute(
+            self.statements.delete_attachments_before,
+            Statements.to_uuid(group_id),
+            before,
         )
 
-        self.logger.info(f"deleting {len(attachments)} attachments in group {group_id}...")
-        self._delete_messages(attachments, "attachments")
+        if self.write_buckets:
+            self._delete_buckets_before(
+                group_id,
+                before,
+                self.statements.delete_attachments_bucket,
+                self.statements.delete_attachments_in_bucket_before,
+            )
+
+    def _delete_lookups_before(self, group_id: str, before: dt, ids_before, delete_id) -> None:
+        """
+        the range delete can't reach the rows in messages_by_id and attachments_by_file,
+        so their keys are read first and deleted one by one, before the range delete
+        """
+        ids = self.statements.execute(ids_before, Statements.to_uuid(group_id), before)
+        self.statements.execute_concurrent((delete_id, (key,)) for key, in ids)
+
+    def _delete_buckets_before(self, group_id: str, before: dt, delete_bucket, delete_in_bucket) -> None:
+        """
+        buckets older than the one `before` is in are dropped with one partition
+        tombstone each, only the newest one needs a range delete; the rows in
+        message_buckets are kept, readers don't walk past delete_before anyway
+        """
+        group_uuid = Statements.to_uuid(group_id)
+        last_bucket = Statements.bucket_of(before)
+
+        for bucket, in self.statements.execute(self.statements.buckets_between, group_uuid, last_bucket, 0):
+            if bucket < last_bucket:
+                self.statements.execute(delete_bucket, group_uuid, bucket)
+            else:
+                self.statements.execute(delete_in_bucket, group_uuid, bucket, before)
 
     def delete_attachments(
         self,
@@ -304,15 +426,7 @@ class CassandraHandler:
         group_created_at: dt,
         query: AttachmentQuery
     ) -> MessageBase:
-        attachment = (
-            AttachmentModel.objects(
-                AttachmentModel.group_id == group_id,
-                AttachmentModel.created_at > group_created_at,
-                AttachmentModel.file_id == query.file_id,
-            )
-            .allow_filtering()
-            .first()
-        )
+        attachment = self._get_attachment(group_id, query.file_id, group_created_at)
 
         if attachment is None:
             raise NoSuchAttachmentException(query.file_id)
@@ -332,25 +446,18 @@ class CassandraHandler:
 
         # delete attachment after message; delete_message() throws NoSuchMessage if not found
         attachment.delete()
+        CassandraHandler._lookup_of(attachment).delete()
+
+        if self.write_buckets:
+            self._to_bucket(attachment).delete()
 
         return attachment_base
 
-    # noinspection PyMethodMayBeStatic
     def delete_message(
         self, group_id: str, user_id: int, message_id: str, created_at: dt
     ) -> None:
         approx_date = arrow.get(created_at).shift(minutes=-1).datetime
-
-        message = (
-            MessageModel.objects(
-                MessageModel.group_id == group_id,
-                MessageModel.created_at > approx_date,
-                MessageModel.user_id == user_id,
-                MessageModel.message_id == message_id,
-            )
-            .allow_filtering()
-            .first()
-        )
+        message = self._get_message(group_id, user_id, message_id, approx_date)
 
         if message is None:
             raise NoSuchMessageException(message_id)
@@ -362,53 +469,28 @@ class CassandraHandler:
             removed_at=removed_at,
             updated_at=removed_at,
         )
+        self._copy_to_bucket(message)
 
-    # noinspection PyMethodMayBeStatic
     def get_attachment_from_file_id(self, group_id: str, created_at: dt, query: AttachmentQuery) -> MessageBase:
         approx_date = arrow.get(created_at).shift(minutes=-1).datetime
-
-        attachment = (
-            AttachmentModel.objects(
-                AttachmentModel.group_id == group_id,
-                AttachmentModel.created_at > approx_date,
-                AttachmentModel.file_id == query.file_id,
-            )
-            .allow_filtering()
-            .first()
-        )
+        attachment = self._get_attachment(group_id, query.file_id, approx_date)
 
         if attachment is None:
             raise NoSuchAttachmentException(query.file_id)
 
         return CassandraHandler.message_base_from_entity(attachment)
 
-    # noinspection PyMethodMayBeStatic
     def store_attachment(
             self, group_id: str, user_id: int, message_id: str, query: CreateAttachmentQuery
     ) -> MessageBase:
-        # we should filter on the 'created_at' field, since it's a clustering key
-        # and 'message_id' is not; if we don't filter by 'created_at' each edit
-        # will require a full table scan, and editing a recent message happens
-        # quite often, which will become very slow after a group has a long
-        # message history...
         created_at = query.created_at
         now = utcnow_dt()
 
-        # querying by exact datetime seems to be shifty in cassandra, so just
-        # filter by a minute before and after
         approx_date_after = arrow.get(created_at).shift(minutes=-1).datetime
         approx_date_before = arrow.get(created_at).shift(minutes=1).datetime
 
-        message = (
-            MessageModel.objects(
-                MessageModel.group_id == group_id,
-                MessageModel.user_id == user_id,
-                MessageModel.created_at > approx_date_after,
-                MessageModel.created_at < approx_date_before,
-                MessageModel.message_id == message_id,
-            )
-            .allow_filtering()
-            .first()
+        message = self._get_message(
+            group_id, user_id, message_id, approx_date_after, approx_date_before
         )
 
         if message is None:
@@ -419,8 +501,9 @@ class CassandraHandler:
             file_id=query.file_id,
             updated_at=now,
         )
+        self._copy_to_bucket(message)
 
-        AttachmentModel.create(
+        attachment = AttachmentModel.create(
             group_id=group_id,
             user_id=user_id,
             created_at=message.created_at,
@@ -430,9 +513,126 @@ class CassandraHandler:
             updated_at=now,
             file_id=query.file_id,
         )
+        AttachmentByFileModel.create(
+            file_id=query.file_id,
+            group_id=group_id,
+            created_at=message.created_at,
+            user_id=user_id,
+            message_id=message_id,
+        )
+        self._copy_to_bucket(attachment)
 
         return CassandraHandler.message_base_from_entity(message)
 
+    def _get_message(
+        self,
+        group_id: str,
+        user_id: int,
+        message_id: str,
+        approx_date_after: dt,
+        approx_date_before: dt = None,
+    ) -> Optional[MessageModel]:
+        """
+        the primary key is looked up in messages_by_id; messages from before that
+        table existed that backfill.py hasn't copied yet aren't found there, and
+        are filtered for in the group's partition around the time the client says
+        it was sent; their key is then added to the lookup, so it's only done once
+        """
+        key = self.statements.execute(
+            self.statements.message_by_id, Statements.to_uuid(message_id)
+        ).one()
+
+        if key is not None:
+            key_group_id, created_at, key_user_id = key
+
+            if str(key_group_id) != group_id or key_user_id != user_id:
+                return None
+
+            return (
+                MessageModel.objects(
+                    MessageModel.group_id == group_id,
+                    MessageModel.created_at == created_at,
+                    MessageModel.user_id == user_id,
+                )
+                .first()
+            )
+
+        messages = MessageModel.objects(
+            MessageModel.group_id == group_id,
+            MessageModel.user_id == user_id,
+            MessageModel.created_at > approx_date_after,
+            MessageModel.message_id == message_id,
+        )
+
+        if approx_date_before is not None:
+            messages = messages.filter(MessageModel.created_at < approx_date_before)
+
+        message = messages.allow_filtering().first()
+
+        if message is not None:
+            self.statements.execute(
+                self.statements.insert_message_id,
+                message.message_id,
+                message.group_id,
+                message.created_at,
+                message.user_id,
+            )
+
+        return message
+
+    def _get_attachment(self, group_id: str, file_id: str, approx_date_after: dt) -> Optional[AttachmentModel]:
+        """
+        same as _get_message(), but using attachments_by_file
+        """
+        key = self.statements.execute(self.statements.attachment_by_file, file_id).one()
+
+        if key is not None:
+            key_group_id, created_at, user_id = key
+
+            if str(key_group_id) != group_id:
+                return None
+
+            return (
+                AttachmentModel.objects(
+                    AttachmentModel.group_id == group_id,
+                    AttachmentModel.created_at == created_at,
+                    AttachmentModel.user_id == user_id,
+                )
+                .first()
+            )
+
+        attachment = (
+            AttachmentModel.objects(
+                AttachmentModel.group_id == group_id,
+                AttachmentModel.created_at > approx_date_after,
+                AttachmentModel.file_id == file_id,
+            )
+            .allow_filtering()
+            .first()
+        )
+
+        if attachment is not None:
+            self.statements.execute(
+                self.statements.insert_file_id,
+                attachment.file_id,
+                attachment.group_id,
+                attachment.created_at,
+                attachment.user_id,
+                attachment.message_id,
+            )
+
+        return attachment
+
+    @staticmethod
+    def _lookup_of(entity):
+        """
+        the row in messages_by_id or attachments_by_file of a message or attachment
+        """
+        if isinstance(entity, MessageModel):
+            return MessageByIdModel.objects(MessageByIdModel.message_id == entity.message_id)
+
+        return AttachmentByFileModel.objects(AttachmentByFileModel.file_id == entity.file_id)
+
     def delete_messages_in_group(self, group_id: str, query: MessageQuery) -> None:
         def callback(message: MessageModel):
             message.removed_at = removed_at
@@ -442,7 +642,6 @@ class CassandraHandler:
 
         self._update_all_messages_in_group(group_id=group_id, callback=callback)
 
-    # noinspection PyMethodMayBeStatic
     def create_action_log(
             self,
             user_id: int,
@@ -459,6 +658,13 @@ class CassandraHandler:
             message_payload=query.payload,
             message_id=uuid(),
         )
+        MessageByIdModel.create(
+            message_id=log.message_id,
+            group_id=group_id,
+            created_at=action_time,
+            user_id=user_id,
+        )
+        self._copy_to_bucket(log, new_bucket=True)
 
         return CassandraHandler.message_base_from_entity(log)
 
@@ -477,21 +683,65 @@ class CassandraHandler:
             group_id=group_id, callback=callback, user_id=user_id,
         )
 
-    # noinspection PyMethodMayBeStatic
     def store_message(self, group_id: str, user_id: int, query: SendMessageQuery) -> MessageBase:
-        created_at = utcnow_dt()
-        message_id = uuid()
+        message = CassandraHandler._new_message(group_id, user_id, query)
+        self.statements.execute_batch(self._inserts(message))
+
+        return message
 
-        message = MessageModel.create(
+    async def store_message_async(self, group_id: str, user_id: int, query: SendMessageQuery) -> MessageBase:
+        message = CassandraHandler._new_message(group_id, user_id, query)
+        await self.statements.execute_batch_async(self._inserts(message))
+
+        return message
+
+    @staticmethod
+    def _new_message(group_id: str, user_id: int, query: SendMessageQuery) -> MessageBase:
+        return MessageBase.construct(
             group_id=group_id,
+            created_at=utcnow_dt(),
             user_id=user_id,
-            created_at=created_at,
-            message_id=message_id,
+            message_id=str(uuid()),
             message_payload=query.message_payload,
             message_type=query.message_type,
+            updated_at=None,
+            file_id=None,
         )
 
-        return CassandraHandler.message_base_from_entity(message)
+    def _inserts(self, message: MessageBase) -> list:
+        """
+        the statements and their parameters for storing a new message; they're
+        written in one logged batch, so a message can't be stored without its
+        key in messages_by_id (or its row in the bucketed table)
+        """
+        parameters = CassandraHandler._insert_parameters(message)
+        group_id, created_at, user_id, message_id = parameters[:4]
+
+        inserts = [
+            (self.statements.insert_message, parameters),
+            (self.statements.insert_message_id, (message_id, group_id, created_at, user_id)),
+        ]
+
+        if self.write_buckets:
+            bucket = Statements.bucket_of(created_at)
+
+            inserts.extend([
+                (self.statements.insert_message_in_bucket, (group_id, bucket, *parameters[1:])),
+                (self.statements.insert_bucket, (group_id, bucket)),
+            ])
+
+        return inserts
+
+    @staticmethod
+    def _insert_parameters(message: MessageBase) -> tuple:
+        return (
+            Statements.to_uuid(message.group_id),
+            message.created_at,
+            message.user_id,
+            Statements.to_uuid(message.message_id),
+            message.message_payload,
+            message.message_type,
+        )
 
     def _update_all_messages_in_group(
         self, group_id: str, callback: callable, user_id: int = None
@@ -522,12 +772,85 @@ class CassandraHandler:
         with BatchQuery() as b:
             for message in messages:
                 message.batch(b).delete()
+                CassandraHandler._lookup_of(message).batch(b).delete()
+
+                if self.write_buckets:
+                    self._to_bucket(message).batch(b).delete()
 
         elapsed = time() - start
         if elapsed > 1:
             self.logger.info(f"batch deleted {len(message)} {types} in {elapsed:.2f}s")
 
-    # noinspection PyMethodMayBeStatic
+    def _copy_to_bucket(self, entity, new_bucket: bool = False) -> None:
+        """
+        writes the whole row again to the bucketed table after it was changed
+        using the object mapper, so rows not yet copied by the backfill are complete
+        """
+        if not self.write_buckets:
+            return
+
+        copy = self._to_bucket(entity)
+        copy.save()
+
+        if new_bucket:
+            BucketModel.create(group_id=copy.group_id, bucket=copy.bucket)
+
+    @staticmethod
+    def _to_bucket(entity):
+        model = MessageBucketModel if isinstance(entity, MessageModel) else AttachmentBucketModel
+
+        return model(
+            bucket=Statements.bucket_of(entity.created_at),
+            **{name: getattr(entity, name) for name in entity._columns.keys()}
+        )
+
+    def backfill_group(self, group_id: str, write_time: int) -> int:
+        """
+        used by backfill.py to copy the keys of the existing messages and attachments
+        of a group to the lookup tables, and the rows to the bucketed tables if
+        they're used; `write_time` (microseconds) is when the backfill started, so
+        anything the servers wrote after that wins over the copies
+
+        :return: the number of messages copied
+        """
+        group_uuid = Statements.to_uuid(group_id)
+        buckets = set()
+        n_messages = 0
+
+        def messages():
+            nonlocal n_messages
+
+            for row in self.statements.execute(self.statements.all_messages_in_group, group_uuid):
+                _, created_at, user_id, message_id = row[:4]
+                n_messages += 1
+
+                yield self.statements.copy_message_id, (message_id, group_uuid, created_at, user_id, write_time)
+
+                if self.write_buckets:
+                    bucket = Statements.bucket_of(created_at)
+                    buckets.add(bucket)
+
+                    yield self.statements.copy_message_to_bucket, (bucket, *row, write_time)
+
+        def attachments():
+            for row in self.statements.execute(self.statements.all_attachments_in_group, group_uuid):
+                _, created_at, user_id, message_id, _, file_id = row[:6]
+
+                yield self.statements.copy_file_id, (file_id, group_uuid, created_at, user_id, message_id, write_time)
+
+                if self.write_buckets:
+                    yield self.statements.copy_attachment_to_bucket, (
+                        Statements.bucket_of(created_at), *row, write_time
+                    )
+
+        self.statements.execute_concurrent(messages())
+        self.statements.execute_concurrent(attachments())
+        self.statements.execute_concurrent(
+            (self.statements.copy_bucket, (group_uuid, bucket)) for bucket in buckets
+        )
+
+        return n_messages
+
     def _update_messages(
         self, messages: List[MessageModel], callback: callable
     ) -> Optional[dt]:
@@ -538,6 +861,9 @@ class CassandraHandler:
                 callback(message)
                 message.batch(b).save()
 
+                if self.write_buckets:
+                    self._to_bucket(message).batch(b).save()
+
                 until = message.created_at
 
         return until
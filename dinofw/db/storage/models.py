@@ -44,6 +44,111 @@ class MessageModel(Model):
     removed_at = DateTime()
 
 
+class MessageBucketModel(Model):
+    """
+    same as MessageModel, but partitioned by month as well (see Statements.bucket_of()),
+    so the partitions of long-lived groups don't grow forever, and the deleter
+    can drop whole months at once; written in addition to MessageModel while
+    migrating, see CassandraHandler
+    """
+    __table_name__ = "messages_by_bucket"
+
+    group_id = UUID(
+        required=True,
+        primary_key=True,
+        partition_key=True,
+    )
+    bucket = Integer(
+        required=True,
+        primary_key=True,
+        partition_key=True,
+    )
+    created_at = DateTime(
+        required=True,
+        primary_key=True,
+        clustering_order="DESC",
+    )
+    user_id = Integer(
+        required=True,
+        primary_key=True,
+    )
+    message_id = UUID(
+        required=True,
+        default=uuid.uuid4
+    )
+    file_id = Text(
+        required=False
+    )
+    message_payload = Text(
+        required=False
+    )
+    message_type = Integer(
+        required=True
+    )
+    updated_at = DateTime()
+    removed_at = DateTime()
+
+
+class AttachmentBucketModel(Model):
+    """
+    same as AttachmentModel, partitioned by month like MessageBucketModel
+    """
+    __table_name__ = "attachments_by_bucket"
+
+    group_id = UUID(
+        required=True,
+        primary_key=True,
+        partition_key=True,
+    )
+    bucket = Integer(
+        required=True,
+        primary_key=True,
+        partition_key=True,
+    )
+    created_at = DateTime(
+        required=True,
+        primary_key=True,
+        clustering_order="DESC",
+    )
+    user_id = Integer(
+        required=True,
+        primary_key=True,
+    )
+    message_id = UUID(
+        required=True,
+        default=uuid.uuid4
+    )
+    file_id = Text(
+        required=True
+    )
+    message_payload = Text(
+        required=False
+    )
+    message_type = Integer(
+        required=True
+    )
+    updated_at = DateTime()
+
+
+class BucketModel(Model):
+    """
+    the months a group has messages in, newest first, so readers only query
+    buckets that exist; attachments are always in a bucket of their message
+    """
+    __table_name__ = "message_buckets"
+
+    group_id = UUID(
+        required=True,
+        primary_key=True,
+        partition_key=True,
+    )
+    bucket = Integer(
+        required=True,
+        primary_key=True,
+        clustering_order="DESC",
+    )
+
+
 class AttachmentModel(Model):
     # duplicate attachments from message table to this table for fast querying
     __table_name__ = "attachments"
@@ -113,3 +218,51 @@ class AttachmentModel(Model):
     is_resized tinyint(1) DEFAULT '1',
     new_msg_id varchar(23) CHARACTER SET utf8 DEFAULT NULL,
     """
+
+
+class MessageByIdModel(Model):
+    """
+    the primary key of a message in MessageModel by its id, so edits and deletes
+    don't have to filter the partition of the group
+    """
+    __table_name__ = "messages_by_id"
+
+    message_id = UUID(
+        required=True,
+        primary_key=True,
+        partition_key=True,
+    )
+    group_id = UUID(
+        required=True
+    )
+    created_at = DateTime(
+        required=True
+    )
+    user_id = Integer(
+        required=True
+    )
+
+
+class AttachmentByFileModel(Model):
+    """
+    the primary key of an attachment in AttachmentModel by its file id
+    """
+    __table_name__ = "attachments_by_file"
+
+    file_id = Text(
+        required=True,
+        primary_key=True,
+        partition_key=True,
+    )
+    group_id = UUID(
+        required=True
+    )
+    created_at = DateTime(
+        required=True
+    )
+    user_id = Integer(
+        required=True
+    )
+    message_id = UUID(
+        required=True
+    )
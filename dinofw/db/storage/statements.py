@@ -0,0 +1,406 @@
+import asyncio
+from datetime import datetime as dt
+from typing import Iterable
+from typing import List
+from typing import Tuple
+from uuid import UUID
+
+from cassandra.cluster import Session
+from cassandra.concurrent import execute_concurrent
+from cassandra.query import BatchStatement
+from cassandra.query import BatchType
+from cassandra.query import PreparedStatement
+
+from dinofw.db.storage.schemas import MessageBase
+
+# execution profiles, see CassandraHandler.setup_tables()
+PROFILE_ROWS = "rows"
+PROFILE_BATCH = "batch"
+
+# same order as the fields of MessageBase, so rows can be converted by position
+MESSAGE_COLUMNS = [
+    "group_id",
+    "created_at",
+    "user_id",
+    "message_id",
+    "message_type",
+    "file_id",
+    "message_payload",
+    "updated_at",
+]
+
+
+class PreparedQuery:
+    __slots__ = ("statement", "profile")
+
+    def __init__(self, statement: PreparedStatement, profile: str):
+        self.statement = statement
+        self.profile = profile
+
+
+class Statements:
+    """
+    CQL for the hot paths of CassandraHandler, prepared once at startup; the object
+    mapper builds the CQL text for every query and creates a model instance for
+    every row, and can't use execution profiles
+
+    cqlengine is still used for syncing the tables and for the other queries;
+    the statements for the bucketed tables are only prepared if the tables are
+    used, see BucketModes
+    """
+
+    def __init__(self, session: Session, key_space: str, buckets: bool = False):
+        self.session = session
+
+        messages = f"{key_space}.messages"
+        attachments = f"{key_space}.attachments"
+        columns = ", ".join(MESSAGE_COLUMNS)
+
+        self.insert_message = self._prepare(
+            f"INSERT INTO {messages} "
+            f"(group_id, created_at, user_id, message_id, message_payload, message_type) "
+            f"VALUES (?, ?, ?, ?, ?, ?)"
+        )
+        self.messages_for_user = self._prepare(
+            f"SELECT {columns} FROM {messages} "
+            f"WHERE group_id = ? AND created_at < ? AND created_at > ? LIMIT ?"
+        )
+        self.attachments_for_user = self._prepare(
+            f"SELECT {columns} FROM {attachments} "
+            f"WHERE group_id = ? AND created_at <= ? AND created_at > ? LIMIT ?"
+        )
+        self.count_messages_since = self._prepare(
+            f"SELECT COUNT(*) FROM {messages} "
+            f"WHERE group_id = ? AND created_at > ?"
+        )
+
+        # range deletes for the deleter, one tombstone instead of one per row
+        self.delete_messages_before = self._prepare(
+            f"DELETE FROM {messages} WHERE group_id = ? AND created_at <= ?",
+            profile=PROFILE_BATCH,
+        )
+        self.delete_attachments_before = self._prepare(
+            f"DELETE FROM {attachments} WHERE group_id = ? AND created_at <= ?",
+            profile=PROFILE_BATCH,
+        )
+
+        # the keys in the lookups of what the range deletes remove
+        self.message_ids_before = self._prepare(
+            f"SELECT message_id FROM {messages} WHERE group_id = ? AND created_at <= ?",
+            profile=PROFILE_BATCH,
+        )
+        self.file_ids_before = self._prepare(
+            f"SELECT file_id FROM {attachments} WHERE group_id = ? AND created_at <= ?",
+            profile=PROFILE_BATCH,
+        )
+        self.delete_message_id = self._prepare(
+            f"DELETE FROM {key_space}.messages_by_id WHERE message_id = ?",
+            profile=PROFILE_BATCH,
+        )
+        self.delete_file_id = self._prepare(
+            f"DELETE FROM {key_space}.attachments_by_file WHERE file_id = ?",
+            profile=PROFILE_BATCH,
+        )
+
+        # primary keys of messages and attachments for edits and deletes
+        self.insert_message_id = self._prepare(
+            f"INSERT INTO {key_space}.messages_by_id "
+            f"(message_id, group_id, created_at, user_id) VALUES (?, ?, ?, ?)"
+        )
+        self.insert_file_id = self._prepare(
+            f"INSERT INTO {key_space}.attachments_by_file "
+            f"(file_id, group_id, created_at, user_id, message_id) VALUES (?, ?, ?, ?, ?)"
+        )
+        self.message_by_id = self._prepare(
+            f"SELECT group_id, created_at, user_id FROM {key_space}.messages_by_id "
+            f"WHERE message_id = ?"
+        )
+        self.attachment_by_file = self._prepare(
+            f"SELECT group_id, created_at, user_id FROM {key_space}.attachments_by_file "
+            f"WHERE file_id = ?"
+        )
+
+        # used by backfill.py, see copy_* below
+        self.all_messages_in_group = self._prepare(
+            f"SELECT {columns}, removed_at FROM {messages} WHERE group_id = ?",
+            profile=PROFILE_BATCH,
+        )
+        self.all_attachments_in_group = self._prepare(
+            f"SELECT {columns} FROM {attachments} WHERE group_id = ?",
+            profile=PROFILE_BATCH,
+        )
+
+        # the write time of the copies is when the backfill started, so rows
+        # written or deleted by the servers after that aren't overwritten
+        self.copy_message_id = self._prepare(
+            f"INSERT INTO {key_space}.messages_by_id "
+            f"(message_id, group_id, created_at, user_id) VALUES (?, ?, ?, ?) USING TIMESTAMP ?",
+            profile=PROFILE_BATCH,
+        )
+        self.copy_file_id = self._prepare(
+            f"INSERT INTO {key_space}.attachments_by_file "
+            f"(file_id, group_id, created_at, user_id, message_id) VALUES (?, ?, ?, ?, ?) USING TIMESTAMP ?",
+            profile=PROFILE_BATCH,
+        )
+
+        if buckets:
+            self._prepare_buckets(key_space)
+
+    def _prepare_buckets(self, key_space: str) -> None:
+        messages = f"{key_space}.messages_by_bucket"
+        attachments = f"{key_space}.attachments_by_bucket"
+        buckets = f"{key_space}.message_buckets"
+        columns = ", ".join(MESSAGE_COLUMNS)
+
+        self.insert_message_in_bucket = self._prepare(
+            f"INSERT INTO {messages} "
+            f"(group_id, bucket, created_at, user_id, message_id, message_payload, message_type) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?)"
+        )
+        self.insert_bucket = self._prepare(
+            f"INSERT INTO {buckets} (group_id, bucket) VALUES (?, ?)"
+        )
+
+        # buckets are clustered newest first
+        self.buckets_between = self._prepare(
+            f"SELECT bucket FROM {buckets} "
+            f"WHERE group_id = ? AND bucket <= ? AND bucket >= ?"
+        )
+        self.buckets_since = self._prepare(
+            f"SELECT bucket FROM {buckets} "
+            f"WHERE group_id = ? AND bucket >= ?"
+        )
+
+        self.messages_in_bucket_for_user = self._prepare(
+            f"SELECT {columns} FROM {messages} "
+            f"WHERE group_id = ? AND bucket = ? AND created_at < ? AND created_at > ? LIMIT ?"
+        )
+        self.attachments_in_bucket_for_user = self._prepare(
+            f"SELECT {columns} FROM {attachments} "
+            f"WHERE group_id = ? AND bucket = ? AND created_at <= ? AND created_at > ? LIMIT ?"
+        )
+        self.count_messages_in_bucket_since = self._prepare(
+            f"SELECT COUNT(*) FROM {messages} "
+            f"WHERE group_id = ? AND bucket = ? AND created_at > ?"
+        )
+
+        # the deleter drops whole partitions, and a range in the newest one
+        self.delete_messages_bucket = self._prepare(
+            f"DELETE FROM {messages} WHERE group_id = ? AND bucket = ?",
+            profile=PROFILE_BATCH,
+        )
+        self.delete_attachments_bucket = self._prepare(
+            f"DELETE FROM {attachments} WHERE group_id = ? AND bucket = ?",
+            profile=PROFILE_BATCH,
+        )
+        self.delete_messages_in_bucket_before = self._prepare(
+            f"DELETE FROM {messages} WHERE group_id = ? AND bucket = ? AND created_at <= ?",
+            profile=PROFILE_BATCH,
+        )
+        self.delete_attachments_in_bucket_before = self._prepare(
+            f"DELETE FROM {attachments} WHERE group_id = ? AND bucket = ? AND created_at <= ?",
+            profile=PROFILE_BATCH,
+        )
+
+        # used by backfill.py
+        self.copy_message_to_bucket = self._prepare(
+            f"INSERT INTO {messages} (bucket, {columns}, removed_at) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) USING TIMESTAMP ?",
+            profile=PROFILE_BATCH,
+        )
+        self.copy_attachment_to_bucket = self._prepare(
+            f"INSERT INTO {attachments} (bucket, {columns}) "
+            f"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) USING TIMESTAMP ?",
+            profile=PROFILE_BATCH,
+        )
+        self.copy_bucket = self._prepare(
+            f"INSERT INTO {buckets} (group_id, bucket) VALUES (?, ?)",
+            profile=PROFILE_BATCH,
+        )
+
+    def _prepare(self, cql: str, profile: str = PROFILE_ROWS) -> PreparedQuery:
+        return PreparedQuery(self.session.prepare(cql), profile)
+
+    def execute(self, query: PreparedQuery, *parameters):
+        return self.session.execute(
+            query.statement, parameters, execution_profile=query.profile
+        )
+
+    def execute_batch(self, queries: Iterable[Tuple[PreparedQuery, tuple]]) -> None:
+        self.session.execute(Statements._logged_batch(queries), execution_profile=PROFILE_ROWS)
+
+    async def execute_batch_async(self, queries: Iterable[Tuple[PreparedQuery, tuple]]) -> None:
+        response = self.session.execute_async(Statements._logged_batch(queries), execution_profile=PROFILE_ROWS)
+        await self._result_of(response, "logged batch")
+
+    @staticmethod
+    def _logged_batch(queries: Iterable[Tuple[PreparedQuery, tuple]]) -> BatchStatement:
+        """
+        either all or none of the statements are applied, even if they're for
+        different tables and partitions
+        """
+        batch = BatchStatement(batch_type=BatchType.LOGGED)
+
+        for query, parameters in queries:
+            batch.add(query.statement, parameters)
+
+        return batch
+
+    def execute_concurrent(
+        self,
+        queries: Iterable[Tuple[PreparedQuery, tuple]],
+        profile: str = PROFILE_BATCH,
+        concurrency: int = 50,
+    ) -> None:
+        """
+        consumes `queries` lazily, with at most `concurrency` requests in flight
+        """
+        execute_concurrent(
+            self.session,
+            ((query.statement, parameters) for query, parameters in queries),
+            concurrency=concurrency,
+            execution_profile=profile,
+        )
+
+    async def execute_async(self, query: PreparedQuery, *parameters) -> list:
+        """
+        the driver's ResponseFuture calls back on its own event loop thread, so the
+        result is handed over to the asyncio loop that awaits it; if the limit of
+        the query is above the fetch size, the other pages are fetched the same
+        way before returning, like iterating the result of execute() does
+        """
+        response = self.session.execute_async(
+            query.statement, parameters, execution_profile=query.profile
+        )
+
+        return await self._result_of(response, query.statement)
+
+    @staticmethod
+    async def _result_of(response, statement) -> list:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        rows = list()
+
+        # called again with the next page after start_fetching_next_page()
+        def on_result(page):
+            rows.extend(page or list())
+
+            if response.has_more_pages:
+                try:
+                    response.start_fetching_next_page()
+                except Exception as e:
+                    on_error(e)
+                return
+
+            loop.call_soon_threadsafe(Statements._set_result, future, rows)
+
+        def on_error(e):
+            loop.call_soon_threadsafe(Statements._set_exception, future, e)
+
+        response.add_callbacks(on_result, on_error)
+
+        return await future
+
+    def messages(self, query: PreparedQuery, *parameters) -> List[MessageBase]:
+        return [
+            Statements.message_base_from_row(row)
+            for row in self.execute(query, *parameters)
+        ]
+
+    async def messages_async(self, query: PreparedQuery, *parameters) -> List[MessageBase]:
+        return [
+            Statements.message_base_from_row(row)
+            for row in await self.execute_async(query, *parameters)
+        ]
+
+    def messages_in_buckets(
+        self, query: PreparedQuery, group_id: UUID, until: dt, since: dt, limit: int
+    ) -> List[MessageBase]:
+        """
+        walks the buckets between `until` and `since`, newest first, until `limit`
+        messages have been found; usually the first bucket is enough
+        """
+        messages = list()
+        buckets = self.execute(
+            self.buckets_between, group_id, Statements.bucket_of(until), Statements.bucket_of(since)
+        )
+
+        for bucket, in buckets:
+            messages.extend(self.messages(
+                query, group_id, bucket, until, since, limit - len(messages)
+            ))
+
+            if len(messages) >= limit:
+                break
+
+        return messages
+
+    async def messages_in_buckets_async(
+        self, query: PreparedQuery, group_id: UUID, until: dt, since: dt, limit: int
+    ) -> List[MessageBase]:
+        messages = list()
+        buckets = await self.execute_async(
+            self.buckets_between, group_id, Statements.bucket_of(until), Statements.bucket_of(since)
+        )
+
+        for bucket, in buckets:
+            messages.extend(await self.messages_async(
+                query, group_id, bucket, until, since, limit - len(messages)
+            ))
+
+            if len(messages) >= limit:
+                break
+
+        return messages
+
+    def count_in_buckets(self, group_id: UUID, since: dt) -> int:
+        return sum(
+            self.execute(self.count_messages_in_bucket_since, group_id, bucket, since).one()[0]
+            for bucket, in self.execute(self.buckets_since, group_id, Statements.bucket_of(since))
+        )
+
+    async def count_in_buckets_async(self, group_id: UUID, since: dt) -> int:
+        buckets = await self.execute_async(self.buckets_since, group_id, Statements.bucket_of(since))
+
+        counts = await asyncio.gather(*[
+            self.execute_async(self.count_messages_in_bucket_since, group_id, bucket, since)
+            for bucket, in buckets
+        ])
+
+        return sum(rows[0][0] for rows in counts)
+
+    @staticmethod
+    def _set_result(future: asyncio.Future, rows) -> None:
+        # the request might have been cancelled (e.g. client disconnected) meanwhile
+        if not future.done():
+            future.set_result(rows)
+
+    @staticmethod
+    def _set_exception(future: asyncio.Future, e: Exception) -> None:
+        if not future.done():
+            future.set_exception(e)
+
+    @staticmethod
+    def message_base_from_row(row: tuple) -> MessageBase:
+        """
+        rows come from the tuple row factory with MESSAGE_COLUMNS, trusted, so
+        no validation is needed
+        """
+        group_id, created_at, user_id, message_id, *rest = row
+
+        return MessageBase.construct(**dict(zip(
+            MESSAGE_COLUMNS,
+            [str(group_id), created_at, user_id, str(message_id), *rest],
+        )))
+
+    @staticmethod
+    def bucket_of(created_at: dt) -> int:
+        """
+        the month of a message as yyyymm, e.g. 202610; all times are utc
+        """
+        return created_at.year * 100 + created_at.month
+
+    @staticmethod
+    def to_uuid(value: str) -> UUID:
+        # cqlengine converts the ids for us, the driver expects a UUID
+        return UUID(value)
@@ -38,11 +38,11 @@ class BaseResource(ABC):
         self.logger = logging.getLogger(__name__)
 
     @time_method(logger, "_user_opens_conversation()")
-    def _user_opens_conversation(self, group_id: str, user_id: int, user_stats: UserGroupStatsBase, db):
+    async def _user_opens_conversation(self, group_id: str, user_id: int, user_stats: UserGroupStatsBase, db):
         """
         update database and cache with everything related to opening a conversation (if needed)
         """
-        last_message_time = self.env.db.get_last_message_time_in_group(group_id, db)
+        last_message_time = await self.env.async_db.get_last_message_time_in_group(group_id, db)
 
         # if a user opens a conversation a second time and nothing has changed, we don't need to update
         if BaseResource.need_to_update_stats_in_group(user_stats, last_message_time):
@@ -50,20 +50,23 @@ class BaseResource(ABC):
             now_dt = utcnow_dt(now_ts)
 
             # something changed, so update and set last_updated_time to sync to apps
-            self.env.db.update_last_read_and_highlight_in_group_for_user(
+            await self.env.async_db.update_last_read_and_highlight_in_group_for_user(
                 group_id, user_id, now_dt, db
             )
 
             # no point updating if already newer than last message (also skips
             # broadcasting unnecessary read-receipts)
             if last_message_time > user_stats.last_read:
-                user_ids = self.env.db.get_user_ids_and_join_time_in_group(group_id, db)
+                user_ids = await self.env.async_db.get_user_ids_and_join_time_in_group(group_id, db)
 
                 del user_ids[user_id]
                 self.env.client_publisher.read(group_id, user_id, user_ids, now_ts)
-                self.env.cache.set_unread_in_group(group_id, user_id, 0)
+                await self.env.async_cache.set_unread_in_group(group_id, user_id, 0)
 
-    def _user_sends_a_message(
+            # after the unread count is reset, so a poll in between doesn't cache the old one
+            await self.env.async_cache.reset_user_stats([user_id])
+
+    async def _user_sends_a_message(
         self, group_id: str, user_id: int, message: MessageBase, db
     ):
         """
@@ -72,51 +75,60 @@ class BaseResource(ABC):
         # cassandra DT is different from python DT
         now = utcnow_dt()
 
-        self.env.db.update_group_new_message(message, now, db)
-        self.env.db.update_last_read_and_sent_in_group_for_user(
-            group_id, user_id, now, db
+        await self.env.async_db.update_group_new_message(message, now, db, update_cache=False)
+        await self.env.async_db.update_last_read_and_sent_in_group_for_user(
+            group_id, user_id, now, db, update_cache=False
         )
 
-        user_ids = self.env.db.get_user_ids_and_join_time_in_group(group_id, db)
-        self.env.client_publisher.message(message, user_ids)
+        user_ids = await self.env.async_db.get_user_ids_and_join_time_in_group(group_id, db)
 
-        # don't increase unread for the sender
-        del user_ids[user_id]
-        self.env.cache.increase_unread_in_group_for(group_id, user_ids)
+        # don't increase unread for the sender; also increases the group version,
+        # which makes the cached /userstats of the members outdated, before
+        # publishing since apps poll the stats when they get the message
+        receiver_ids = [receiver_id for receiver_id in user_ids if receiver_id != user_id]
+        await self.env.async_cache.set_message_sent_in_group(
+            group_id, user_id, AbstractQuery.to_ts(now), receiver_ids
+        )
 
-    def _user_sends_action_log(
+        self.env.client_publisher.message(message, user_ids)
+
+    async def _user_sends_action_log(
         self, group_id: str, message: MessageBase, db
     ):
         # cassandra DT is different from python DT
         now = utcnow_dt()
 
-        self.env.db.update_group_new_message(
+        await self.env.async_db.update_group_new_message(
             message,
             now,
             db,
             wakeup_users=False  # not for action logs
         )
 
-        self.env.db.set_last_updated_at_for_all_in_group(group_id, db)
-        user_ids = self.env.db.get_user_ids_and_join_time_in_group(group_id, db)
+        await self.env.async_db.set_last_updated_at_for_all_in_group(group_id, db)
+        user_ids = await self.env.async_db.get_user_ids_and_join_time_in_group(group_id, db)
 
+        await self.env.async_cache.increase_group_version(group_id)
         self.env.client_publisher.message(message, user_ids)
 
-    def _user_sends_an_attachment(self, group_id: str, attachment: MessageBase, db):
+    async def _user_sends_an_attachment(self, group_id: str, attachment: MessageBase, db):
         # cassandra DT is different from python DT
         now = utcnow_dt()
 
-        self.env.db.update_group_new_message(attachment, now, db)
-        user_ids = self.env.db.get_user_ids_and_join_time_in_group(group_id, db)
+        # the message of the attachment was already counted when it was sent
+        await self.env.async_db.update_group_new_message(attachment, now, db, new_message=False)
+        user_ids = await self.env.async_db.get_user_ids_and_join_time_in_group(group_id, db)
+
+        await self.env.async_cache.increase_group_version(group_id)
         self.env.client_publisher.attachment(attachment, user_ids)
 
     async def _get_or_create_group_for_1v1(
         self, user_id: int, receiver_id: int, db: Session
     ) -> str:
         try:
-            return self.env.db.get_group_id_for_1to1(user_id, receiver_id, db)
+            return await self.env.async_db.get_group_id_for_1to1(user_id, receiver_id, db)
         except NoSuchGroupException:
-            group = self.env.db.create_group_for_1to1(user_id, receiver_id, db)
+            group = await self.env.async_db.create_group_for_1to1(user_id, receiver_id, db)
             return group.group_id
 
     @staticmethod
@@ -169,10 +181,17 @@ class BaseResource(ABC):
         user_count: int,
         message_amount: int = -1
     ) -> Group:
-        group_dict = group.dict()
+        # the bases are created from trusted db data, so construct() the response
+        # models instead of validating every field again; fastapi validates the
+        # response once when serializing it
+        group_dict = {
+            field: value
+            for field, value in group.__dict__.items()
+            if field in Group.__fields__
+        }
 
         users = [
-            GroupJoinTime(user_id=user_id, join_time=join_time,)
+            GroupJoinTime.construct(user_id=user_id, join_time=join_time)
             for user_id, join_time in users.items()
         ]
         users.sort(key=lambda user: user.join_time, reverse=True)
@@ -191,7 +210,7 @@ class BaseResource(ABC):
         group_dict["user_count"] = user_count
         group_dict["message_amount"] = message_amount
 
-        return Group(**group_dict)
+        return Group.construct(**group_dict)
 
     @staticmethod
     def group_base_to_user_group(
@@ -205,7 +224,11 @@ class BaseResource(ABC):
     ) -> UserGroup:
         group = BaseResource.group_base_to_group(group_base, users, user_count)
 
-        stats_dict = stats_base.__dict__
+        stats_dict = {
+            field: value
+            for field, value in stats_base.__dict__.items()
+            if field in UserGroupStats.__fields__
+        }
         stats_dict["unread"] = unread
         stats_dict["receiver_unread"] = receiver_unread
 
@@ -224,13 +247,16 @@ class BaseResource(ABC):
         stats_dict["first_sent"] = AbstractQuery.to_ts(
             stats_base.first_sent, allow_none=True
         )
+        stats_dict["sort_time"] = AbstractQuery.to_ts(
+            stats_base.sort_time, allow_none=True
+        )
         stats_dict["last_updated_time"] = AbstractQuery.to_ts(
             stats_base.last_updated_time
         )
 
-        stats = UserGroupStats(**stats_dict)
+        stats = UserGroupStats.construct(**stats_dict)
 
-        return UserGroup(group=group, stats=stats,)
+        return UserGroup.construct(group=group, stats=stats)
 
     @staticmethod
     def user_group_stats_base_to_user_group_stats(user_stats: UserGroupStatsBase):
@@ -21,6 +21,7 @@ from dinofw.rest.models import UpdateGroupQuery
 from dinofw.rest.models import UpdateUserGroupStats
 from dinofw.rest.models import UserGroupStats
 from dinofw.utils import utcnow_dt
+from dinofw.utils import unread_from_seq
 from dinofw.utils import utcnow_ts
 from dinofw.utils.decorators import time_method
 from dinofw.utils.exceptions import NoSuchGroupException
@@ -32,7 +33,7 @@ class GroupResource(BaseResource):
     async def get_users_in_group(
         self, group_id: str, db: Session
     ) -> Optional[GroupUsers]:
-        group, first_users, n_users = self.env.db.get_users_in_group(group_id, db)
+        group, first_users, n_users = await self.env.async_db.get_users_in_group(group_id, db)
 
         users = [
             GroupJoinTime(user_id=user_id, join_time=join_time,)
@@ -44,11 +45,13 @@ class GroupResource(BaseResource):
         )
 
     async def get_group(self, group_id: str, query: GroupInfoQuery, db: Session) -> Optional[Group]:
-        group, first_users, n_users = self.env.db.get_users_in_group(group_id, db)
+        group, first_users, n_users = await self.env.async_db.get_users_in_group(group_id, db)
 
         message_amount = -1
         if query.count_messages:
-            message_amount = self.env.storage.count_messages_in_group_since(group_id, group.created_at)
+            message_amount = await self.env.async_storage.count_messages_in_group_since(
+                group_id, group.created_at
+            )
 
         return GroupResource.group_base_to_group(
             group, users=first_users, user_count=n_users, message_amount=message_amount,
@@ -57,29 +60,30 @@ class GroupResource(BaseResource):
     async def get_attachments_in_group_for_user(
         self, group_id: str, user_id: int, query: MessageQuery, db: Session
     ) -> List[Message]:
-        user_stats = self.env.db.get_user_stats_in_group(group_id, user_id, db)
-        attachments = self.env.storage.get_attachments_in_group_for_user(group_id, user_stats, query)
+        user_stats = await self.env.async_db.get_user_stats_in_group(group_id, user_id, db)
+        attachments = await self.env.async_storage.get_attachments_in_group_for_user(group_id, user_stats, query)
 
         return [
             GroupResource.message_base_to_message(attachment)
             for attachment in attachments
         ]
 
-    def mark_all_as_read(self, user_id: int, db: Session) -> None:
-        self.env.db.mark_all_groups_as_read(user_id, db)
+    async def mark_all_as_read(self, user_id: int, db: Session) -> None:
+        await self.env.async_db.mark_all_groups_as_read(user_id, db)
+        await self.env.async_cache.reset_user_stats([user_id])
 
     async def get_1v1_info(
         self, user_id_a: int, user_id_b: int, db: Session
     ) -> OneToOneStats:
         users = sorted([user_id_a, user_id_b])
-        group = self.env.db.get_group_for_1to1(users[0], users[1], db)
+        group = await self.env.async_db.get_group_for_1to1(users[0], users[1], db)
 
         if group is None:
             raise NoSuchGroupException(",".join([str(user_id) for user_id in users]))
 
         group_id = group.group_id
-        message_amount = await self.count_messages_in_group(group_id)
-        users_and_join_time = self.env.db.get_user_ids_and_join_time_in_group(
+        message_amount = await self.count_messages_in_group(group_id, db)
+        users_and_join_time = await self.env.async_db.get_user_ids_and_join_time_in_group(
             group_id, db
         )
 
@@ -105,44 +109,49 @@ class GroupResource(BaseResource):
         self, group_id: str, user_id: int, query: MessageQuery, db: Session
     ) -> Histories:
         @time_method(logger, "histories().user_stats()")
-        def get_user_stats():
-            return self.env.db.get_user_stats_in_group(group_id, user_id, db)
+        async def get_user_stats():
+            return await self.env.async_db.get_user_stats_in_group(group_id, user_id, db)
 
         @time_method(logger, "histories().get_messages()")
-        def get_messages():
+        async def get_messages():
             return [
                 GroupResource.message_base_to_message(message)
-                for message in self.env.storage.get_messages_in_group_for_user(
+                for message in await self.env.async_storage.get_messages_in_group_for_user(
                     group_id, user_stats, query
                 )
             ]
 
         @time_method(logger, "histories().get_last_reads()")
-        def get_last_reads():
+        async def get_last_reads():
             return [
                 GroupResource.to_last_read(this_user_id, last_read)
-                for this_user_id, last_read in self.env.db.get_last_reads_in_group(
-                    group_id, db
+                for this_user_id, last_read in (
+                    await self.env.async_db.get_last_reads_in_group(group_id, db)
                 ).items()
             ]
 
-        user_stats = get_user_stats()
+        user_stats = await get_user_stats()
         if user_stats.hide:
             return Histories(messages=list(), action_logs=list(), last_reads=list())
 
-        messages = get_messages()
-        last_reads = get_last_reads()
+        messages = await get_messages()
+        last_reads = await get_last_reads()
 
         if len(messages):
-            self._user_opens_conversation(group_id, user_id, user_stats, db)
+            await self._user_opens_conversation(group_id, user_id, user_stats, db)
 
         return Histories(
             messages=messages,
             last_reads=last_reads,
         )
 
-    async def count_messages_in_group(self, group_id: str) -> int:
-        n_messages, until = self.env.cache.get_messages_in_group(group_id)
+    async def count_messages_in_group(self, group_id: str, db: Session) -> int:
+        group = await self.env.async_db.get_group_from_id(group_id, db)
+        if group.message_seq is not None:
+            return group.message_seq
+
+        # only groups from before the sequence numbers were added need to be counted, once
+        n_messages, until = await self.env.async_cache.get_messages_in_group(group_id)
 
         if until is None:
             until = self.long_ago
@@ -150,17 +159,19 @@ class GroupResource(BaseResource):
         else:
             until = AbstractQuery.to_dt(until)
 
-        messages_since = self.env.storage.count_messages_in_group_since(group_id, until)
+        messages_since = await self.env.async_storage.count_messages_in_group_since(group_id, until)
         total_messages = n_messages + messages_since
         now = utcnow_ts()
 
-        self.env.cache.set_messages_in_group(group_id, total_messages, now)
+        await self.env.async_cache.set_messages_in_group(group_id, total_messages, now)
+        await self.env.async_db.init_message_seq_in_group(group_id, total_messages, db)
+
         return total_messages
 
     async def get_user_group_stats(
         self, group_id: str, user_id: int, message_amount: int, db: Session
     ) -> Optional[UserGroupStats]:
-        user_stats: UserGroupStatsBase = self.env.db.get_user_stats_in_group(
+        user_stats: UserGroupStatsBase = await self.env.async_db.get_user_stats_in_group(
             group_id, user_id, db
         )
 
@@ -174,9 +185,13 @@ class GroupResource(BaseResource):
         first_sent = AbstractQuery.to_ts(user_stats.first_sent, allow_none=True)
         join_time = AbstractQuery.to_ts(user_stats.join_time, allow_none=True)
 
-        unread_amount = self.env.storage.count_messages_in_group_since(
-            group_id, user_stats.last_read
-        )
+        group = await self.env.async_db.get_group_from_id(group_id, db)
+        unread_amount = unread_from_seq(group.message_seq, user_stats.last_read_seq)
+
+        if unread_amount is None:
+            unread_amount = await self.env.async_storage.count_messages_in_group_since(
+                group_id, user_stats.last_read
+            )
 
         return UserGroupStats(
             user_id=user_id,
@@ -199,7 +214,8 @@ class GroupResource(BaseResource):
     async def update_user_group_stats(
         self, group_id: str, user_id: int, query: UpdateUserGroupStats, db: Session
     ) -> None:
-        self.env.db.update_user_group_stats(group_id, user_id, query, db)
+        await self.env.async_db.update_user_group_stats(group_id, user_id, query, db)
+        await self.env.async_cache.reset_user_stats([user_id])
 
     async def create_action_log(
         self, user_id: int, query: CreateActionLogQuery, db: Session
@@ -215,8 +231,8 @@ class GroupResource(BaseResource):
         else:
             raise ValueError("either receiver_id or group_id is required in CreateActionLogQuery")
 
-        log = self.env.storage.create_action_log(user_id, group_id, query)
-        self._user_sends_action_log(group_id, log, db)
+        log = await self.env.async_storage.create_action_log(user_id, group_id, query)
+        await self._user_sends_action_log(group_id, log, db)
 
         return GroupResource.message_base_to_message(log)
 
@@ -226,15 +242,16 @@ class GroupResource(BaseResource):
         now = utcnow_dt()
         now_ts = CreateGroupQuery.to_ts(now)
 
-        group_base = self.env.db.create_group(user_id, query, now, db)
+        group_base = await self.env.async_db.create_group(user_id, query, now, db)
         users = {user_id: float(now_ts)}
 
         if query.users is not None and query.users:
             users.update({user_id: float(now_ts) for user_id in query.users})
 
-        self.env.db.update_user_stats_on_join_or_create_group(
+        await self.env.async_db.update_user_stats_on_join_or_create_group(
             group_base.group_id, users, now, db
         )
+        await self.env.async_cache.reset_user_stats(list(users.keys()))
 
         group = GroupResource.group_base_to_group(
             group=group_base, users=users, user_count=len(users),
@@ -248,14 +265,16 @@ class GroupResource(BaseResource):
     async def update_group_information(
         self, group_id: str, query: UpdateGroupQuery, db: Session
     ) -> None:
-        group = self.env.db.update_group_information(group_id, query, db)
-        self.env.db.set_last_updated_at_for_all_in_group(group_id, db)
+        group = await self.env.async_db.update_group_information(group_id, query, db)
+        await self.env.async_db.set_last_updated_at_for_all_in_group(group_id, db)
 
-        user_ids_and_join_times = self.env.db.get_user_ids_and_join_time_in_group(
+        user_ids_and_join_times = await self.env.async_db.get_user_ids_and_join_time_in_group(
             group.group_id, db
         )
         user_ids = user_ids_and_join_times.keys()
 
+        # the stats of every member depend on the group, not only of the user who changed it
+        await self.env.async_cache.increase_group_version(group_id)
         self.env.client_publisher.group_change(group, user_ids)
 
     async def join_group(self, group_id: str, query: JoinGroupQuery, db: Session) -> None:
@@ -267,28 +286,35 @@ class GroupResource(BaseResource):
             for user_id in query.users
         }
 
-        self.env.db.set_group_updated_at(group_id, now, db)
-        self.env.db.update_user_stats_on_join_or_create_group(
+        await self.env.async_db.set_group_updated_at(group_id, now, db)
+        await self.env.async_db.update_user_stats_on_join_or_create_group(
             group_id, user_ids_and_last_read, now, db
         )
 
-        user_ids_and_join_times = self.env.db.get_user_ids_and_join_time_in_group(
+        user_ids_and_join_times = await self.env.async_db.get_user_ids_and_join_time_in_group(
             group_id, db
         )
         user_ids_in_group = user_ids_and_join_times.keys()
+
+        # the cached stats of the users who joined don't have a version for this group
+        await self.env.async_cache.reset_user_stats(query.users)
+        await self.env.async_cache.increase_group_version(group_id)
         self.env.client_publisher.join(group_id, user_ids_in_group, query.users, now_ts)
 
-    def leave_group(self, group_id: str, user_id: int, db: Session) -> None:
+    async def leave_group(self, group_id: str, user_id: int, db: Session) -> None:
         now = utcnow_dt()
         now_ts = AbstractQuery.to_ts(now)
 
-        self.env.db.remove_last_read_in_group_for_user(group_id, user_id, db)
+        await self.env.async_db.remove_last_read_in_group_for_user(group_id, user_id, db)
 
         # shouldn't send this event to the guy who left, so get from db/cache after removing the leaver id
-        user_ids_and_join_times = self.env.db.get_user_ids_and_join_time_in_group(
+        user_ids_and_join_times = await self.env.async_db.get_user_ids_and_join_time_in_group(
             group_id, db
         )
 
+        # also outdates the cached stats of the user who left
+        await self.env.async_cache.increase_group_version(group_id)
+
         # if it's the last user we don't need to publish anything
         if len(user_ids_and_join_times):
             user_ids_in_group = user_ids_and_join_times.keys()
@@ -311,9 +337,9 @@ class GroupResource(BaseResource):
             # TODO: how to tell apps an attachment was deleted? <-- update: create action log on deletions
             # self.env.db.update_group_updated_at ?
 
-    def delete_all_groups_for_user(self, user_id: int, db: Session) -> None:
-        group_ids = self.env.db.get_all_group_ids_for_user(user_id, db)
+    async def delete_all_groups_for_user(self, user_id: int, db: Session) -> None:
+        group_ids = await self.env.async_db.get_all_group_ids_for_user(user_id, db)
 
         # TODO: this is async, but check how long time this would take for like 5-10k groups
         for group_id in group_ids:
-            self.leave_group(group_id, user_id, db)
+            await self.leave_group(group_id, user_id, db)
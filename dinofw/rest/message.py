@@ -21,8 +21,8 @@ class MessageResource(BaseResource):
     async def send_message_to_group(
         self, group_id: str, user_id: int, query: SendMessageQuery, db: Session
     ) -> Message:
-        message = self.env.storage.store_message(group_id, user_id, query)
-        self._user_sends_a_message(group_id, user_id, message, db)
+        message = await self.env.async_storage.store_message(group_id, user_id, query)
+        await self._user_sends_a_message(group_id, user_id, message, db)
 
         return MessageResource.message_base_to_message(message)
 
@@ -40,7 +40,7 @@ class MessageResource(BaseResource):
     async def messages_in_group(
         self, group_id: str, query: MessageQuery
     ) -> List[Message]:
-        raw_messages = self.env.storage.get_messages_in_group(group_id, query)
+        raw_messages = await self.env.async_storage.get_messages_in_group(group_id, query)
         messages = list()
 
         for message_base in raw_messages:
@@ -52,12 +52,12 @@ class MessageResource(BaseResource):
     async def messages_for_user(
         self, group_id: str, user_id: int, query: MessageQuery, db: Session
     ) -> List[Message]:
-        user_stats = self.env.db.get_user_stats_in_group(group_id, user_id, db)
+        user_stats = await self.env.async_db.get_user_stats_in_group(group_id, user_id, db)
 
         if user_stats.hide:
             return list()
 
-        raw_messages = self.env.storage.get_messages_in_group_for_user(
+        raw_messages = await self.env.async_storage.get_messages_in_group_for_user(
             group_id, user_stats, query
         )
         messages = list()
@@ -69,9 +69,9 @@ class MessageResource(BaseResource):
         return messages
 
     async def get_attachment_info(self, group_id: str, query: AttachmentQuery, db: Session) -> Message:
-        group = self.env.db.get_group_from_id(group_id, db)
+        group = await self.env.async_db.get_group_from_id(group_id, db)
 
-        message_base = self.env.storage.get_attachment_from_file_id(
+        message_base = await self.env.async_storage.get_attachment_from_file_id(
             group_id,
             group.created_at,
             query
@@ -94,10 +94,10 @@ class MessageResource(BaseResource):
                 user_id, query.receiver_id, db
             )
 
-        attachment = self.env.storage.store_attachment(
+        attachment = await self.env.async_storage.store_attachment(
             group_id, user_id, message_id, query
         )
-        self._user_sends_an_attachment(group_id, attachment, db)
+        await self._user_sends_an_attachment(group_id, attachment, db)
 
         return MessageResource.message_base_to_message(attachment)
 
@@ -131,7 +131,7 @@ class MessageResource(BaseResource):
             # self.env.db.update_group_updated_at ?
 
     async def update_messages(self, group_id: str, query: MessageQuery):
-        self.env.storage.update_messages_in_group(group_id, query)
+        await self.env.async_storage.update_messages_in_group(group_id, query)
 
     async def delete_messages(self, group_id: str, query: MessageQuery):
-        self.env.storage.delete_messages_in_group(group_id, query)
+        await self.env.async_storage.delete_messages_in_group(group_id, query)
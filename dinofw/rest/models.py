@@ -92,8 +92,19 @@ class GroupInfoQuery(AbstractQuery):
     count_messages: Optional[bool] = False
 
 
+class GroupCursor(BaseModel):
+    """
+    position in the list of a user's groups, taken from the last group of the
+    previous page (stats.pin, stats.sort_time, stats.group_id)
+    """
+    pin: bool
+    sort_time: float
+    group_id: str
+
+
 class GroupQuery(PaginationQuery, UserStatsQuery):
-    pass
+    # if specified, `until` is ignored
+    cursor: Optional[GroupCursor]
 
 
 class GroupUpdatesQuery(GroupQuery):
@@ -184,6 +195,7 @@ class UserGroupStats(BaseModel):
     highlight_time: Optional[float]
     last_updated_time: float
     first_sent: Optional[float]
+    sort_time: Optional[float]
 
     hide: Optional[bool]
     pin: Optional[bool]
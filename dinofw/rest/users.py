@@ -16,21 +16,49 @@ from dinofw.utils.decorators import time_method
 
 logger = logging.getLogger(__name__)
 
+# checking the versions of more groups than this on every poll costs about as
+# much as counting the stats again, so they're not cached for those users
+MAX_GROUPS_FOR_CACHED_STATS = 1000
+
 
 class UserResource(BaseResource):
     async def get_groups_for_user(
         self, user_id: int, query: GroupQuery, db: Session
     ) -> List[UserGroup]:
-        user_groups: List[UserGroupBase] = self.env.db.get_groups_for_user(user_id, query, db, receiver_stats=True)
+        user_groups: List[UserGroupBase] = await self.env.async_db.get_groups_for_user(user_id, query, db, receiver_stats=True)
         return BaseResource.to_user_group(user_groups)
 
     async def get_groups_updated_since(
         self, user_id: int, query: GroupUpdatesQuery, db: Session
     ) -> List[UserGroup]:
-        user_groups: List[UserGroupBase] = self.env.db.get_groups_updated_since(user_id, query, db, receiver_stats=True)
+        user_groups: List[UserGroupBase] = await self.env.async_db.get_groups_updated_since(user_id, query, db, receiver_stats=True)
         return BaseResource.to_user_group(user_groups)
 
     async def get_user_stats(self, user_id: int, query: UserStatsQuery, db: Session) -> UserStats:
+        """
+        apps poll this, so the stats are cached per user until something changes
+        for the user; the cached stats are ignored when the version of one of the
+        user's groups changed (new messages, leaves, new info), and BaseResource and
+        GroupResource reset them for the user on reads, stats updates and joins
+        """
+        query_key = f"{query.hidden}:{query.count_unread}:{query.only_unread}"
+
+        stats = await self.env.async_cache.get_user_stats(user_id, query_key)
+        if stats is not None:
+            return stats
+
+        # before counting, so a change while counting isn't missed
+        group_ids = await self.env.async_db.get_all_group_ids_for_user(user_id, db)
+        versions = await self.env.async_cache.get_group_versions(group_ids)
+
+        stats = await self._count_user_stats(user_id, query, db)
+
+        if len(group_ids) <= MAX_GROUPS_FOR_CACHED_STATS and versions is not None:
+            await self.env.async_cache.set_user_stats(user_id, query_key, stats, dict(zip(group_ids, versions)))
+
+        return stats
+
+    async def _count_user_stats(self, user_id: int, query: UserStatsQuery, db: Session) -> UserStats:
         # if the user has more than 100 groups with unread messages in
         # it won't matter if the count is exact or not, just forget about
         # the super old ones (if a user reads a group, another unread
@@ -42,8 +70,10 @@ class UserResource(BaseResource):
             hidden=query.hidden,
         )
 
-        user_groups: List[UserGroupBase] = self.env.db.get_groups_for_user(
-            user_id, sub_query, db, count_receiver_unread=False,
+        # on the primary, the stats are cached with the group versions from before
+        # counting, so they can't be behind those versions like a replica can
+        user_groups: List[UserGroupBase] = await self.env.async_db.get_groups_for_user(
+            user_id, sub_query, db, count_receiver_unread=False, primary=True,
         )
 
         if query.count_unread:
@@ -60,10 +90,10 @@ class UserResource(BaseResource):
             unread_amount = -1
             n_unread_groups = -1
 
-        group_amounts = self.env.db.count_group_types_for_user(user_id, sub_query, db)
+        group_amounts = await self.env.async_db.count_group_types_for_user(user_id, sub_query, db, primary=True)
         group_amounts = dict(group_amounts)
 
-        last_sent_group_id, last_sent_time = self.env.db.get_last_sent_for_user(user_id, db)
+        last_sent_group_id, last_sent_time = await self.env.async_db.get_last_sent_for_user(user_id, db)
         if last_sent_time is None:
             last_sent_time = self.long_ago
 
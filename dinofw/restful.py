@@ -60,3 +60,5 @@ app = create_app()
 async def startup():
     await environ.env.client_publisher.setup()
     environ.env.server_publisher.setup()
+    environ.env.cache.start_invalidation_listener()
+    environ.env.db.load_1to1_group_filter()
@@ -34,7 +34,7 @@ async def leave_group(
     * `250`: if an unknown error occurred.
     """
     try:
-        return environ.env.rest.group.leave_group(group_id, user_id, db)
+        return await environ.env.rest.group.leave_group(group_id, user_id, db)
     except NoSuchGroupException as e:
         log_error_and_raise_known(ErrorCodes.NO_SUCH_GROUP, sys.exc_info(), e)
     except Exception as e:
@@ -57,8 +57,8 @@ async def delete_all_groups_for_user(
     * `250`: if an unknown error occurred.
     """
 
-    def leave_all_groups(user_id_, db_):
-        environ.env.rest.group.delete_all_groups_for_user(user_id_, db_)
+    async def leave_all_groups(user_id_, db_):
+        await environ.env.rest.group.delete_all_groups_for_user(user_id_, db_)
 
     try:
         task = BackgroundTask(leave_all_groups, user_id_=user_id, db_=db)
@@ -54,7 +54,7 @@ async def get_user_statistics_in_group(
     * `250`: if an unknown error occurred.
     """
     try:
-        message_amount = await environ.env.rest.group.count_messages_in_group(group_id)
+        message_amount = await environ.env.rest.group.count_messages_in_group(group_id, db)
         return await environ.env.rest.group.get_user_group_stats(
             group_id, user_id, message_amount, db
         )
@@ -64,3 +64,26 @@ async def get_user_statistics_in_group(
         log_error_and_raise_known(ErrorCodes.USER_NOT_IN_GROUP, sys.exc_info(), e)
     except Exception as e:
         log_error_and_raise_unknown(sys.exc_info(), e)
+
+
+@router.get("/debug/cache")
+async def get_cache_stats() -> dict:
+    """
+    Get hits, misses, number of calls and average round-trip time per cache key
+    family since this worker started, together with the size of the in-process
+    cache and the redis connection pool. Only for debugging; the same numbers
+    are reported to statsd.
+
+    **Potential error codes in response:**
+    * `250`: if an unknown error occurred.
+    """
+    try:
+        # e.g. CacheAllMiss doesn't keep any stats
+        debug_stats = getattr(environ.env.cache, "debug_stats", None)
+
+        if not callable(debug_stats):
+            return dict()
+
+        return debug_stats() or dict()
+    except Exception as e:
+        log_error_and_raise_unknown(sys.exc_info(), e)
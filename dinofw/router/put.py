@@ -68,8 +68,8 @@ async def mark_all_groups_as_read(
     * `250`: if an unknown error occurred.
     """
 
-    def set_read_time(user_id_, db_):
-        environ.env.rest.group.mark_all_as_read(user_id_, db_)
+    async def set_read_time(user_id_, db_):
+        await environ.env.rest.group.mark_all_as_read(user_id_, db_)
 
     try:
         task = BackgroundTask(set_read_time, user_id_=user_id, db_=db)
@@ -2,11 +2,12 @@ from abc import ABC
 
 
 class IStats(ABC):
-    def incr(self, key: str) -> None:
+    def incr(self, key: str, count: int = 1) -> None:
         """
         increment a key
 
         :param key: the key to increment
+        :param count: how much to increment it with
         :return: nothing
         """
 
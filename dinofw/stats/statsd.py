@@ -7,11 +7,11 @@ class MockStatsd(IStats):
         self.vals = dict()
         self.timings = dict()
 
-    def incr(self, key: str) -> None:
+    def incr(self, key: str, count: int = 1) -> None:
         if key not in self.vals:
-            self.vals[key] = 1
+            self.vals[key] = count
         else:
-            self.vals[key] += 1
+            self.vals[key] += count
 
     def decr(self, key: str) -> None:
         if key not in self.vals:
@@ -56,8 +56,8 @@ class StatsdService(IStats):
 
             self.statsd = statsd.StatsClient(host, int(port), prefix=prefix)
 
-    def incr(self, key: str) -> None:
-        self.statsd.incr(key)
+    def incr(self, key: str, count: int = 1) -> None:
+        self.statsd.incr(key, count)
 
     def decr(self, key: str) -> None:
         self.statsd.decr(key)
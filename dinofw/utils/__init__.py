@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Optional
 
 import arrow
 
@@ -47,3 +48,13 @@ def group_id_to_users(group_id: str) -> (int, int):
     user_b = int(group_id[16:].lstrip("0"), 16)
 
     return sorted([user_a, user_b])
+
+
+def unread_from_seq(message_seq: Optional[int], last_read_seq: Optional[int]) -> Optional[int]:
+    """
+    :return: None if either sequence number is unknown, then the messages have to be counted
+    """
+    if message_seq is None or last_read_seq is None:
+        return None
+
+    return max(0, message_seq - last_read_seq)
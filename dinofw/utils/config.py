@@ -17,6 +17,17 @@ class MessageTypes:
     ACTION = 100
 
 
+class BucketModes:
+    # only the messages and attachments tables
+    OFF = "off"
+
+    # write to the bucketed tables as well, but read from the old ones (while backfilling)
+    DUAL = "dual"
+
+    # write to both, read the history and counts from the bucketed tables
+    ON = "on"
+
+
 class DefaultValues:
     PER_PAGE: Final = 100
 
@@ -28,6 +39,8 @@ class DefaultValues:
 class RedisKeys:
     RKEY_AUTH = "user:auth:{}"  # user:auth:user_id
     RKEY_USERS_IN_GROUP = "group:users:{}"  # group:users:group_id
+    RKEY_USERS_IN_GROUP_PACKED = "group:users:packed:{}"  # group:users:packed:group_id
+    RKEY_FILL_LOCK = "fill:lock:{}"  # fill:lock:key
     RKEY_LAST_SEND_TIME = "group:lastsent:{}"  # group:lastsent:group_id
     RKEY_LAST_READ_TIME = "group:lastread:{}"  # group:lastread:group_id
     RKEY_USER_STATS_IN_GROUP = "group:stats:{}"  # group:stats:group_id
@@ -35,11 +48,49 @@ class RedisKeys:
     RKEY_HIDE_GROUP = "group:hide:{}"  # group:hide:group_id
     RKEY_USER_MESSAGE_STATUS = "user:status:{}"  # user:status:user_id
     RKEY_MESSAGES_IN_GROUP = "group:messages:{}"  # group:messages:group_id
-    RKEY_GROUP_COUNT_INCL_HIDDEN = "group:count:inclhidden:{}"  # group:count:inclhidden:user_id
-    RKEY_GROUP_COUNT_NO_HIDDEN = "group:count:visible:{}"  # group:count:visible:user_id
+    RKEY_GROUP_COUNT_TYPES = "group:count:types:{}"  # group:count:types:user_id
+    RKEY_GROUP_COUNT_TYPES_CHANGED = "group:count:types:changed"
     RKEY_LAST_SENT_TIME_USER = "user:lastsent:{}"  # user:lastsent:user_id
     RKEY_LAST_READ_TIME_USER = "user:lastread:{}"  # user:lastread:user_id
     RKEY_LAST_MESSAGE_TIME = "group:lastmsgtime:{}"  # group:lastmsgtime:group_id
+    RKEY_GROUP_EXISTS = "group:exists:{}"  # group:exists:group_id
+    RKEY_GROUP = "group:info:{}"  # group:info:group_id
+    RKEY_ONE_TO_ONE_FILTER = "group:1v1:filter"
+    RKEY_ONE_TO_ONE_FILTER_LOADED = "group:1v1:filter:loaded"
+    RKEY_ONE_TO_ONE_FILTER_LOADING = "group:1v1:filter:loading"
+    RKEY_PRIMARY_PIN = "db:primary:{}"  # db:primary:user_id
+    RKEY_USER_STATS = "user:stats:{}"  # user:stats:user_id
+    RKEY_GROUP_VERSION = "group:version:{}"  # group:version:group_id
+    RKEY_INVALIDATION_CHANNEL = "cache:invalidate"
+    RKEY_INVALIDATION_VERSION = "cache:invalidate:version"
+
+    @staticmethod
+    def invalidation_channel() -> str:
+        return RedisKeys.RKEY_INVALIDATION_CHANNEL
+
+    @staticmethod
+    def invalidation_version() -> str:
+        return RedisKeys.RKEY_INVALIDATION_VERSION
+
+    @staticmethod
+    def group(group_id: str) -> str:
+        return RedisKeys.RKEY_GROUP.format(group_id)
+
+    @staticmethod
+    def group_exists(group_id: str) -> str:
+        return RedisKeys.RKEY_GROUP_EXISTS.format(group_id)
+
+    @staticmethod
+    def one_to_one_filter() -> str:
+        return RedisKeys.RKEY_ONE_TO_ONE_FILTER
+
+    @staticmethod
+    def one_to_one_filter_loaded() -> str:
+        return RedisKeys.RKEY_ONE_TO_ONE_FILTER_LOADED
+
+    @staticmethod
+    def one_to_one_filter_loading() -> str:
+        return RedisKeys.RKEY_ONE_TO_ONE_FILTER_LOADING
 
     @staticmethod
     def last_message_time(group_id: str) -> str:
@@ -54,12 +105,24 @@ class RedisKeys:
         return RedisKeys.RKEY_LAST_SENT_TIME_USER.format(user_id)
 
     @staticmethod
-    def count_group_types_including_hidden(user_id: int) -> str:
-        return RedisKeys.RKEY_GROUP_COUNT_INCL_HIDDEN.format(user_id)
+    def count_group_types(user_id: int) -> str:
+        return RedisKeys.RKEY_GROUP_COUNT_TYPES.format(user_id)
+
+    @staticmethod
+    def count_group_types_changed() -> str:
+        return RedisKeys.RKEY_GROUP_COUNT_TYPES_CHANGED
+
+    @staticmethod
+    def primary_pin(user_id: int) -> str:
+        return RedisKeys.RKEY_PRIMARY_PIN.format(user_id)
+
+    @staticmethod
+    def user_stats(user_id: int) -> str:
+        return RedisKeys.RKEY_USER_STATS.format(user_id)
 
     @staticmethod
-    def count_group_types_not_including_hidden(user_id: int) -> str:
-        return RedisKeys.RKEY_GROUP_COUNT_NO_HIDDEN.format(user_id)
+    def group_version(group_id: str) -> str:
+        return RedisKeys.RKEY_GROUP_VERSION.format(group_id)
 
     @staticmethod
     def messages_in_group(group_id: str) -> str:
@@ -89,6 +152,14 @@ class RedisKeys:
     def user_in_group(group_id: str) -> str:
         return RedisKeys.RKEY_USERS_IN_GROUP.format(group_id)
 
+    @staticmethod
+    def user_in_group_packed(group_id: str) -> str:
+        return RedisKeys.RKEY_USERS_IN_GROUP_PACKED.format(group_id)
+
+    @staticmethod
+    def fill_lock(key: str) -> str:
+        return RedisKeys.RKEY_FILL_LOCK.format(key)
+
     @staticmethod
     def unread_in_group(group_id: str) -> str:
         return RedisKeys.RKEY_UNREAD_IN_GROUP.format(group_id)
@@ -129,6 +200,26 @@ class ConfigKeys:
     INCLUDE_HOST_NAME = "include_hostname"
     URI = "uri"
     DROPPED_EVENT_FILE = "dropped_log"
+    LOCAL_CACHE_SIZE = "local_size"
+    LOCAL_CACHE_TTL = "local_ttl"
+    POOL_SIZE = "pool_size"
+    POOL_TIMEOUT = "pool_timeout"
+    PACKED_MEMBERSHIP = "packed_membership"
+    LOCAL_CACHE_STALE_TTL = "local_stale_ttl"
+    FILL_LOCK = "fill_lock"
+    FILL_LOCK_TTL = "fill_lock_ttl"
+    FILL_LOCK_WAIT = "fill_lock_wait"
+    NEGATIVE_TTL = "negative_ttl"
+    ONE_TO_ONE_FILTER_BITS = "one_to_one_filter_bits"
+    FANOUT_MAX_USERS = "fanout_max_users"
+    MAX_OVERFLOW = "max_overflow"
+    POOL_RECYCLE = "pool_recycle"
+    POOL_PRE_PING = "pool_pre_ping"
+    PGBOUNCER = "pgbouncer"
+    REPLICAS = "replicas"
+    REPLICA_PIN_TTL = "replica_pin_ttl"
+    MAX_IN_FLIGHT = "max_in_flight"
+    BUCKETS = "buckets"
 
     # will be overwritten even if specified in config file
     ENVIRONMENT = "_environment"
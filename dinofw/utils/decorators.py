@@ -1,3 +1,4 @@
+import asyncio
 import sys
 import time
 import traceback
@@ -8,15 +9,28 @@ from dinofw.utils import environ
 
 def time_method(_logger, prefix: str):
     def factory(view_func):
+        def log_time(before):
+            the_time = (time.time() - before) * 1000
+            if the_time > 10:
+                _logger.debug(f"{prefix} took {the_time:.2f}ms")
+
+        if asyncio.iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_decorator(*args, **kwargs):
+                before = time.time()
+                try:
+                    return await view_func(*args, **kwargs)
+                finally:
+                    log_time(before)
+            return async_decorator
+
         @wraps(view_func)
         def decorator(*args, **kwargs):
             before = time.time()
             try:
                 return view_func(*args, **kwargs)
             finally:
-                the_time = (time.time() - before) * 1000
-                if the_time > 10:
-                    _logger.debug(f"{prefix} took {the_time:.2f}ms")
+                log_time(before)
         return decorator
     return factory
 
@@ -70,6 +70,9 @@ def init_database(gn_env: GNEnvironment):
     from dinofw.db.rdbms.handler import RelationalHandler
     gn_env.db = RelationalHandler(gn_env)
 
+    from dinofw.db.rdbms.aio import AsyncRelationalHandler
+    gn_env.async_db = AsyncRelationalHandler(gn_env, gn_env.db)
+
 
 def init_cassandra(gn_env: GNEnvironment):
     if len(gn_env.config) == 0 or gn_env.config.get(ConfigKeys.TESTING, False):
@@ -81,6 +84,9 @@ def init_cassandra(gn_env: GNEnvironment):
     gn_env.storage = CassandraHandler(gn_env)
     gn_env.storage.setup_tables()
 
+    from dinofw.db.storage.aio import AsyncStorage
+    gn_env.async_storage = AsyncStorage(gn_env, gn_env.storage)
+
 
 def init_cache_service(gn_env: GNEnvironment):
     if len(gn_env.config) == 0 or gn_env.config.get(ConfigKeys.TESTING, False):
@@ -123,6 +129,10 @@ def init_cache_service(gn_env: GNEnvironment):
             f"unknown cache type {cache_type}, use one of [redis, nutcracker, memory, missall]"
         )
 
+    from dinofw.cache.aio import AsyncCache
+
+    gn_env.async_cache = AsyncCache(gn_env, gn_env.cache)
+
 
 def init_stats_service(gn_env: GNEnvironment) -> None:
     if len(gn_env.config) == 0 or gn_env.config.get(ConfigKeys.TESTING, False):
@@ -191,8 +201,17 @@ def initialize_env(dino_env):
     logging.basicConfig(level="DEBUG", format=ConfigKeys.DEFAULT_LOG_FORMAT)
 
     is_deleter_service = os.getenv("DINO_DELETER") is not None
+    is_migration = os.getenv("DINO_MIGRATE") is not None
+
+    # the db pool and cache report to statsd if it's initialized, which it isn't for the deleter
+    dino_env.stats = None
 
     init_logging(dino_env)
+
+    # migrate.py only needs the config, and init_database() checks the schema version
+    if is_migration:
+        return
+
     init_database(dino_env)
     init_cassandra(dino_env)
     init_cache_service(dino_env)
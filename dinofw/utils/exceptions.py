@@ -26,3 +26,8 @@ class NoSuchUserException(Exception):
 class QueryValidationError(Exception):
     def __init__(self, message):
         self.message = f"query validation error: {message}"
+
+
+class SchemaOutdatedException(Exception):
+    def __init__(self, message):
+        self.message = f"schema outdated: {message}"
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExecutorProxy:
+    """
+    Base class for the awaitable versions of the sync cache, db and storage
+    handlers (AsyncCache, AsyncRelationalHandler and AsyncStorage); every method
+    of the wrapped object can be awaited through a subclass, with the same
+    arguments, and runs in a thread pool instead of on the event loop.
+
+    Subclasses set `wait_stat` (the statsd name for the wait before a call
+    starts) and implement `_wrapped()`, and can override `_report_gauges()` to
+    send their own gauges together with the wait.
+
+    The wait is summed up and sent to statsd at most every STATS_INTERVAL seconds
+    (average and max), instead of once per call.
+    """
+
+    STATS_INTERVAL = 10
+
+    wait_stat = None
+
+    def __init__(self, env, max_workers: int, thread_name_prefix: str):
+        self.env = env
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=thread_name_prefix
+        )
+        self.lock = threading.Lock()
+        self.last_stats = 0.0
+        self.n_waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.n_in_flight = 0
+
+    def _wrapped(self):
+        raise NotImplementedError()
+
+    def __getattr__(self, item):
+        method = getattr(self._wrapped(), item)
+
+        async def call(*args, **kwargs):
+            return await self._run_in_executor(method, *args, **kwargs)
+
+        return call
+
+    async def _run_in_executor(self, method, *args, **kwargs):
+        submitted = time.monotonic()
+
+        def run():
+            self._report_wait(time.monotonic() - submitted)
+            return method(*args, **kwargs)
+
+        self.n_in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+        finally:
+            self.n_in_flight -= 1
+
+    def _report_wait(self, waited: float) -> None:
+        if self.env.stats is None:
+            return
+
+        with self.lock:
+            self.n_waits += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+            now = time.monotonic()
+            if now - self.last_stats < self.STATS_INTERVAL:
+                return
+
+            n_waits, wait_total, wait_max = self.n_waits, self.wait_total, self.wait_max
+            self.n_waits, self.wait_total, self.wait_max = 0, 0.0, 0.0
+            self.last_stats = now
+
+        self.env.stats.timing(self.wait_stat, wait_total * 1000 / n_waits)
+        self.env.stats.timing(f"{self.wait_stat}_max", wait_max * 1000)
+        self._report_gauges()
+
+    def _report_gauges(self) -> None:
+        pass
@@ -0,0 +1,17 @@
+import os
+
+MIGRATE_KEY = "DINO_MIGRATE"
+
+# indicate this is a schema migration (won't initialize anything but the config)
+os.environ[MIGRATE_KEY] = "1"
+
+from dinofw.db.rdbms.database import create_engine_from_config
+from dinofw.db.rdbms.migrations import upgrade
+from dinofw.utils import environ
+from dinofw.utils.config import ConfigKeys
+
+engine = create_engine_from_config(
+    environ.env, environ.env.config.get(ConfigKeys.URI, domain=ConfigKeys.DB)
+)
+
+upgrade(engine)
@@ -0,0 +1,496 @@
+import time
+
+import arrow
+
+from dinofw.cache.redis import CacheRedis
+from dinofw.cache.redis import MemoryCache
+from dinofw.cache.redis import pack_join_times
+from dinofw.cache.redis import unpack_join_times
+from dinofw.db.rdbms.schemas import GroupBase
+from dinofw.stats.statsd import MockStatsd
+from dinofw.utils import users_to_group_id
+from dinofw.utils.config import RedisKeys
+from test.base import BaseTest
+from test.base import async_test
+
+
+class TestMemoryCache(BaseTest):
+    def test_lru_eviction(self):
+        cache = MemoryCache(max_size=2)
+
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # touch 'a' so 'b' becomes the least recently used
+        self.assertEqual(1, cache.get("a"))
+
+        cache.set("c", 3)
+
+        self.assertEqual(2, cache.size())
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual(3, cache.get("c"))
+
+    def test_expired_entry_is_removed(self):
+        cache = MemoryCache()
+        cache.set("a", 1, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, cache.size())
+
+    def test_hits_and_misses(self):
+        cache = MemoryCache()
+        cache.set("a", 1)
+
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+
+class TestCacheRedisLocalTier(BaseTest):
+    def test_join_times_served_from_local_tier(self):
+        cache = self.fake_env.cache
+        cache.set_user_ids_and_join_time_in_group(BaseTest.GROUP_ID, {BaseTest.USER_ID: 1.0})
+
+        # remove it from redis only, the local tier should still answer
+        cache.redis.delete(RedisKeys.user_in_group(BaseTest.GROUP_ID))
+
+        users = cache.get_user_ids_and_join_time_in_group(BaseTest.GROUP_ID)
+        self.assertEqual({BaseTest.USER_ID: 1.0}, users)
+
+    def test_returned_join_times_can_be_modified(self):
+        cache = self.fake_env.cache
+        cache.set_user_ids_and_join_time_in_group(BaseTest.GROUP_ID, {BaseTest.USER_ID: 1.0})
+
+        users = cache.get_user_ids_and_join_time_in_group(BaseTest.GROUP_ID)
+        del users[BaseTest.USER_ID]
+
+        users = cache.get_user_ids_and_join_time_in_group(BaseTest.GROUP_ID)
+        self.assertIn(BaseTest.USER_ID, users)
+
+    def test_clear_join_times_removes_local_copy(self):
+        cache = self.fake_env.cache
+        cache.set_user_ids_and_join_time_in_group(BaseTest.GROUP_ID, {BaseTest.USER_ID: 1.0})
+        cache.clear_user_ids_and_join_time_in_group(BaseTest.GROUP_ID)
+
+        self.assertIsNone(cache.get_user_ids_and_join_time_in_group(BaseTest.GROUP_ID))
+
+    def test_local_tier_disabled_without_invalidation(self):
+        self.fake_env.config.config["cache"] = {"type": "nutcracker"}
+        cache = CacheRedis(self.fake_env, host="mock")
+        cache.set_user_ids_and_join_time_in_group(BaseTest.GROUP_ID, {BaseTest.USER_ID: 1.0})
+
+        cache.redis.delete(RedisKeys.user_in_group(BaseTest.GROUP_ID))
+
+        self.assertFalse(cache.invalidation_enabled)
+        self.assertIsNone(cache.get_user_ids_and_join_time_in_group(BaseTest.GROUP_ID))
+
+
+class TestCountGroupTypes(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache = self.fake_env.cache
+        self.cache.set_count_group_types_for_user(
+            BaseTest.USER_ID, [(False, 0, 2), (False, 1, 3), (True, 1, 1)]
+        )
+
+    def test_count_by_hidden(self):
+        self.assertEqual([(0, 2), (1, 3)], self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=False))
+        self.assertEqual([(1, 1)], self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=True))
+        self.assertEqual([(0, 2), (1, 4)], self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=None))
+
+    def test_reset(self):
+        self.cache.reset_count_group_types_for_user(BaseTest.USER_ID)
+        self.assertIsNone(self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=False))
+
+    def test_increase(self):
+        # a group of type 1 was hidden
+        self.cache.increase_count_group_types_for_user(BaseTest.USER_ID, {(False, 1): -1, (True, 1): 1})
+
+        self.assertEqual([(0, 2), (1, 2)], self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=False))
+        self.assertEqual([(1, 2)], self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=True))
+
+    def test_increase_without_count_is_ignored(self):
+        self.cache.increase_count_group_types_for_user(BaseTest.OTHER_USER_ID, {(False, 1): 1})
+        self.assertIsNone(self.cache.get_count_group_types_for_user(BaseTest.OTHER_USER_ID, hidden=False))
+
+    def test_served_from_local_tier_until_increased(self):
+        key = RedisKeys.count_group_types(BaseTest.USER_ID)
+
+        self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=False)
+        self.cache.redis.hset(key, "0:0", 5)
+
+        self.assertEqual([(0, 2), (1, 3)], self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=False))
+
+        self.cache.increase_count_group_types_for_user(BaseTest.USER_ID, {(False, 1): 1})
+        self.assertEqual([(0, 5), (1, 4)], self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=False))
+
+    def test_increase_with_script(self):
+        try:
+            import lupa  # noqa
+        except ImportError:
+            self.skipTest("fakeredis needs lupa to run lua scripts")
+
+        self.cache.scripts_enabled = True
+        self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=False)
+
+        self.cache.increase_count_group_types_for_user(BaseTest.USER_ID, {(False, 1): -1, (True, 1): 1})
+        self.assertEqual([(1, 2)], self.cache.get_count_group_types_for_user(BaseTest.USER_ID, hidden=True))
+
+    def test_changed_users_are_recorded(self):
+        self.cache.increase_count_group_types_for_user(BaseTest.USER_ID, {(False, 1): 1})
+        self.cache.increase_count_group_types_for_user(BaseTest.OTHER_USER_ID, {(False, 1): 1})
+
+        user_ids = self.cache.get_users_with_changed_group_type_counts(10)
+        self.assertEqual({BaseTest.USER_ID, BaseTest.OTHER_USER_ID}, set(user_ids))
+        self.assertEqual(list(), self.cache.get_users_with_changed_group_type_counts(10))
+
+
+class TestPackedMembership(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache = self.fake_env.cache
+        self.cache.packed_membership = True
+
+    def test_round_trip(self):
+        users = {BaseTest.USER_ID: 1600000000.123, BaseTest.OTHER_USER_ID: 1.5, 2 ** 40: 0.0}
+        packed = pack_join_times(users)
+
+        self.assertEqual(1 + 3 * 16, len(packed))
+        self.assertEqual(users, unpack_join_times(packed))
+
+    def test_unknown_version_is_a_miss(self):
+        packed = pack_join_times({BaseTest.USER_ID: 1.0})
+        self.assertIsNone(unpack_join_times(b"\x02" + packed[1:]))
+        self.assertIsNone(unpack_join_times(None))
+
+    def test_set_and_get(self):
+        users = {BaseTest.USER_ID: 1.0, BaseTest.OTHER_USER_ID: 2.0}
+        self.cache.set_user_ids_and_join_time_in_group(BaseTest.GROUP_ID, users)
+        self.cache.flush_local()
+
+        self.assertEqual(users, self.cache.get_user_ids_and_join_time_in_group(BaseTest.GROUP_ID))
+        self.assertEqual(2, self.cache.get_user_count_in_group(BaseTest.GROUP_ID))
+        self.assertEqual(0, self.cache.redis.exists(RedisKeys.user_in_group(BaseTest.GROUP_ID)))
+
+    def test_hash_layout_is_removed_on_read(self):
+        self.cache.packed_membership = False
+        self.cache.set_user_ids_and_join_time_in_groups({BaseTest.GROUP_ID: {BaseTest.USER_ID: 1.0}})
+        self.cache.flush_local()
+
+        self.cache.packed_membership = True
+        users = self.cache.get_user_ids_and_join_time_in_groups([BaseTest.GROUP_ID])
+
+        # refilled from the database by the caller
+        self.assertEqual(dict(), users)
+        self.assertEqual(0, self.cache.redis.exists(RedisKeys.user_in_group(BaseTest.GROUP_ID)))
+        self.assertEqual(0, self.cache.redis.exists(RedisKeys.user_in_group_packed(BaseTest.GROUP_ID)))
+
+    def test_add_removes_packed_value(self):
+        self.cache.set_user_ids_and_join_time_in_group(BaseTest.GROUP_ID, {BaseTest.USER_ID: 1.0})
+        self.cache.add_user_ids_and_join_time_in_group(BaseTest.GROUP_ID, {BaseTest.OTHER_USER_ID: 2.0})
+
+        self.assertIsNone(self.cache.get_user_ids_and_join_time_in_group(BaseTest.GROUP_ID))
+
+
+class TestOneToOneGroupExists(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache = self.fake_env.cache
+        self.group_id = users_to_group_id(BaseTest.USER_ID, BaseTest.OTHER_USER_ID)
+
+    def test_unknown_until_filter_loaded(self):
+        self.assertIsNone(self.cache.get_1to1_group_exists(self.group_id))
+
+        self.cache.set_1to1_group_filter_loaded()
+        self.assertFalse(self.cache.get_1to1_group_exists(self.group_id))
+
+    def test_added_group_exists(self):
+        self.cache.set_1to1_group_filter_loaded()
+        self.cache.add_1to1_group(self.group_id)
+        self.cache.flush_local()
+
+        self.assertTrue(self.cache.get_1to1_group_exists(self.group_id))
+
+    def test_filter_has_no_false_negatives(self):
+        group_ids = [users_to_group_id(BaseTest.USER_ID, user_id) for user_id in range(100)]
+        self.cache.add_1to1_groups_to_filter(group_ids)
+        self.cache.set_1to1_group_filter_loaded()
+
+        for group_id in group_ids:
+            self.assertIsNone(self.cache.get_1to1_group_exists(group_id))
+
+    def test_negative_entry_replaced_on_create(self):
+        self.cache.set_1to1_group_exists(self.group_id, False)
+        self.assertFalse(self.cache.get_1to1_group_exists(self.group_id))
+
+        self.cache.add_1to1_group(self.group_id)
+        self.assertTrue(self.cache.get_1to1_group_exists(self.group_id))
+
+    def test_only_one_worker_loads_filter(self):
+        self.assertTrue(self.cache.claim_1to1_group_filter_load())
+        self.assertFalse(self.cache.claim_1to1_group_filter_load())
+
+        self.cache.set_1to1_group_filter_loaded()
+        self.assertFalse(self.cache.claim_1to1_group_filter_load())
+
+
+class TestGroupSnapshot(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache = self.fake_env.cache
+
+        now = arrow.utcnow().datetime
+        self.group = GroupBase(
+            group_id=BaseTest.GROUP_ID,
+            name="a group",
+            created_at=now,
+            updated_at=now,
+            first_message_time=now,
+            last_message_time=now,
+            last_message_overview="hello",
+            group_type=0,
+            owner_id=BaseTest.USER_ID,
+        )
+
+    def test_round_trip(self):
+        self.cache.set_group(self.group)
+        self.assertEqual(self.group, self.cache.get_group(BaseTest.GROUP_ID))
+
+    def test_remove_group(self):
+        self.cache.set_group(self.group)
+        self.cache.remove_group(BaseTest.GROUP_ID)
+
+        self.assertIsNone(self.cache.get_group(BaseTest.GROUP_ID))
+
+
+class TestCacheMetrics(BaseTest):
+    def test_hits_and_misses_per_family(self):
+        cache = self.fake_env.cache
+
+        cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID)
+        cache.set_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID, 2)
+        cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID)
+        cache.get_last_sent_for_user(BaseTest.USER_ID)
+
+        families = cache.debug_stats()["families"]
+
+        self.assertEqual(3, families["unread_in_group"]["calls"])
+        self.assertEqual(1, families["unread_in_group"]["hits"])
+        self.assertEqual(1, families["unread_in_group"]["misses"])
+        self.assertEqual(0.5, families["unread_in_group"]["hit_ratio"])
+        self.assertEqual(1, families["last_sent_time_user"]["misses"])
+
+    def test_reported_to_stats(self):
+        stats = MockStatsd()
+        cache = self.fake_env.cache
+        cache.metrics.env.stats = stats
+        cache.metrics.last_report = 0
+
+        cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID)
+
+        self.assertEqual(1, stats.vals["cache.unread_in_group.misses"])
+        self.assertIn("cache.unread_in_group.time", stats.timings)
+
+    def test_reported_as_counters(self):
+        stats = MockStatsd()
+        cache = self.fake_env.cache
+        cache.metrics.env.stats = stats
+
+        for _ in range(2):
+            cache.metrics.last_report = 0
+            cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID)
+
+        # added up, not overwritten by the next interval (or another worker)
+        self.assertEqual(2, stats.vals["cache.unread_in_group.calls"])
+
+    @async_test
+    async def test_pool_wait_reported_once_per_interval(self):
+        stats = MockStatsd()
+        async_cache = self.fake_env.async_cache
+        async_cache.env.stats = stats
+        async_cache.last_stats = time.monotonic()
+
+        for _ in range(3):
+            await async_cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID)
+
+        self.assertNotIn("cache.pool.wait", stats.timings)
+        self.assertEqual(3, async_cache.n_waits)
+
+        async_cache.last_stats = 0
+        await async_cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID)
+
+        self.assertIn("cache.pool.wait", stats.timings)
+        self.assertIn("cache.pool.wait_max", stats.timings)
+        self.assertEqual(0, async_cache.n_waits)
+
+
+class TestCacheInvalidation(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache = self.fake_env.cache
+        self.listener = self.cache.invalidation_listener
+        self.key = RedisKeys.user_in_group(BaseTest.GROUP_ID)
+
+    def test_mutation_publishes_key_and_version(self):
+        pubsub = self.cache.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(RedisKeys.invalidation_channel())
+
+        self.cache.clear_user_ids_and_join_time_in_group(BaseTest.GROUP_ID)
+
+        # the first call only consumes the (ignored) subscribe confirmation
+        message = pubsub.get_message(timeout=1.0) or pubsub.get_message(timeout=1.0)
+        self.assertEqual(f"1|{self.key}", str(message["data"], "utf-8"))
+
+    def test_message_evicts_local_key(self):
+        self.cache._set(self.key, {BaseTest.USER_ID: 1.0})
+        self.cache._set("other", 1)
+        self.listener.last_version = 4
+
+        self.listener.on_message(f"5|{self.key}".encode())
+
+        self.assertIsNone(self.cache._get(self.key))
+        self.assertEqual(1, self.cache._get("other"))
+        self.assertEqual(5, self.listener.last_version)
+
+    def test_missed_version_flushes_everything(self):
+        self.cache._set(self.key, {BaseTest.USER_ID: 1.0})
+        self.cache._set("other", 1)
+        self.listener.last_version = 4
+
+        self.listener.on_message(f"7|{self.key}".encode())
+
+        self.assertIsNone(self.cache._get("other"))
+        self.assertEqual(7, self.listener.last_version)
+
+    def test_version_check_flushes_if_still_behind(self):
+        self.listener.last_version = 0
+        self.cache.clear_user_ids_and_join_time_in_group(BaseTest.GROUP_ID)
+
+        # first check only records the global version
+        self.listener.check_version()
+        self.assertEqual(1, self.listener.pending_version)
+
+        self.cache._set("other", 1)
+
+        # the message for version 1 never arrived
+        self.listener.check_version()
+        self.assertIsNone(self.cache._get("other"))
+        self.assertEqual(1, self.listener.last_version)
+
+
+class TestAsyncCache(BaseTest):
+    @async_test
+    async def test_awaited_calls_use_same_cache(self):
+        await self.fake_env.async_cache.set_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID, 3)
+
+        self.assertEqual(3, self.fake_env.cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID))
+        self.assertEqual(
+            3, await self.fake_env.async_cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID)
+        )
+
+
+class TestMessageSentInGroup(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache = self.fake_env.cache
+        self.cache.set_hide_group(BaseTest.GROUP_ID, True, [BaseTest.OTHER_USER_ID])
+
+    def assert_message_sent(self):
+        self.cache.set_message_sent_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID, 1234.5, [BaseTest.OTHER_USER_ID])
+        self.cache.flush_local()
+
+        self.assertEqual(1234.5, self.cache.get_last_message_time_in_group(BaseTest.GROUP_ID))
+        self.assertEqual(1234.5, self.cache.get_last_read_in_group_for_user(BaseTest.GROUP_ID, BaseTest.USER_ID))
+        self.assertEqual((BaseTest.GROUP_ID, 1234.5), self.cache.get_last_sent_for_user(BaseTest.USER_ID))
+        self.assertEqual(0, self.cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.USER_ID))
+        self.assertEqual(1, self.cache.get_unread_in_group(BaseTest.GROUP_ID, BaseTest.OTHER_USER_ID))
+
+        hidden = self.cache.redis.hget(RedisKeys.hide_group(BaseTest.GROUP_ID), BaseTest.OTHER_USER_ID)
+        self.assertEqual(b"f", hidden)
+
+    def test_pipeline(self):
+        self.assert_message_sent()
+
+    def test_script(self):
+        try:
+            import lupa  # noqa
+        except ImportError:
+            self.skipTest("fakeredis needs lupa to run lua scripts")
+
+        self.cache.scripts_enabled = True
+        self.assert_message_sent()
+
+
+class TestPrimaryPin(BaseTest):
+    def test_pinned_users_expire(self):
+        cache = self.fake_env.cache
+        self.assertFalse(cache.is_user_pinned_to_primary(BaseTest.USER_ID))
+
+        cache.pin_users_to_primary([BaseTest.USER_ID], ttl=5)
+        self.assertTrue(cache.is_user_pinned_to_primary(BaseTest.USER_ID))
+        self.assertFalse(cache.is_user_pinned_to_primary(BaseTest.OTHER_USER_ID))
+
+        ttl = cache.redis.ttl(RedisKeys.primary_pin(BaseTest.USER_ID))
+        self.assertTrue(0 < ttl <= 5)
+
+
+class TestUserStats(BaseTest):
+    def test_reset_user_stats(self):
+        from dinofw.rest.models import UserStats
+
+        cache = self.fake_env.cache
+        stats = UserStats(
+            user_id=BaseTest.USER_ID,
+            unread_amount=3,
+            group_amount=1,
+            one_to_one_amount=2,
+            unread_groups_amount=2,
+        )
+
+        self.assertIsNone(cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+
+        cache.set_user_stats(BaseTest.USER_ID, "None:True:True", stats, dict())
+        self.assertEqual(stats, cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+        self.assertIsNone(cache.get_user_stats(BaseTest.USER_ID, "True:True:True"))
+
+        cache.reset_user_stats([BaseTest.OTHER_USER_ID, BaseTest.USER_ID])
+        self.assertIsNone(cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+
+    def test_user_stats_outdated_by_group_version(self):
+        from dinofw.rest.models import UserStats
+
+        cache = self.fake_env.cache
+        stats = UserStats(
+            user_id=BaseTest.USER_ID,
+            unread_amount=3,
+            group_amount=1,
+            one_to_one_amount=2,
+            unread_groups_amount=2,
+        )
+        other_group_id = "other-group"
+
+        group_ids = [BaseTest.GROUP_ID, other_group_id]
+        self.assertEqual([0, 0], cache.get_group_versions(group_ids))
+
+        cache.set_user_stats(BaseTest.USER_ID, "None:True:True", stats, dict(zip(group_ids, [0, 0])))
+        cache.increase_group_version("not-the-users-group")
+        self.assertEqual(stats, cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+
+        cache.increase_group_version(other_group_id)
+        self.assertIsNone(cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+
+        versions = cache.get_group_versions(group_ids)
+        self.assertEqual([0, 1], versions)
+
+        cache.set_user_stats(BaseTest.USER_ID, "None:True:True", stats, dict(zip(group_ids, versions)))
+        self.assertEqual(stats, cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+
+        # a new message, no matter how many receivers
+        cache.set_message_sent_in_group(BaseTest.GROUP_ID, BaseTest.OTHER_USER_ID, 1.0, [BaseTest.USER_ID])
+        self.assertIsNone(cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+        self.assertEqual([1, 1], cache.get_group_versions(group_ids))
@@ -0,0 +1,126 @@
+import threading
+import time
+
+from dinofw.cache.redis import MemoryCache
+from dinofw.cache.singleflight import SingleFlight
+from dinofw.utils.config import RedisKeys
+from test.base import BaseTest
+
+
+class TestSingleFlight(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.single_flight = SingleFlight(self.fake_env)
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.n_fills = 0
+
+    def slow_fill(self):
+        self.n_fills += 1
+        self.started.set()
+        self.release.wait(timeout=5)
+        return "fresh"
+
+    def start_leader(self, results: list) -> threading.Thread:
+        leader = threading.Thread(
+            target=lambda: results.append(self.single_flight.do("key", self.slow_fill))
+        )
+        leader.start()
+        self.started.wait(timeout=5)
+
+        return leader
+
+    def test_concurrent_callers_share_one_fill(self):
+        results = list()
+        leader = self.start_leader(results)
+
+        waiters = [
+            threading.Thread(
+                target=lambda: results.append(self.single_flight.do("key", self.slow_fill))
+            )
+            for _ in range(5)
+        ]
+        for waiter in waiters:
+            waiter.start()
+
+        time.sleep(0.05)
+        self.release.set()
+
+        for thread in [leader] + waiters:
+            thread.join(timeout=5)
+
+        self.assertEqual(1, self.n_fills)
+        self.assertEqual(["fresh"] * 6, results)
+
+    def test_stale_value_served_while_filling(self):
+        results = list()
+        leader = self.start_leader(results)
+
+        self.assertEqual("stale", self.single_flight.do("key", self.slow_fill, stale="stale"))
+
+        self.release.set()
+        leader.join(timeout=5)
+
+        self.assertEqual(1, self.n_fills)
+        self.assertEqual(["fresh"], results)
+
+    def test_waiters_get_the_fill_error(self):
+        def failing_fill():
+            self.started.set()
+            self.release.wait(timeout=5)
+            raise ValueError("no such group")
+
+        errors = list()
+
+        def call():
+            try:
+                self.single_flight.do("key", failing_fill)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+
+        self.started.wait(timeout=5)
+        time.sleep(0.05)
+        self.release.set()
+
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(3, len(errors))
+        self.assertEqual(dict(), self.single_flight.flights)
+
+    def test_waits_for_fill_in_other_process(self):
+        self.single_flight.lock_enabled = True
+        self.fake_env.cache.redis.set(RedisKeys.fill_lock("key"), "other-process")
+
+        checks = iter([None, "filled-elsewhere"])
+        value = self.single_flight.do("key", self.slow_fill, check=lambda: next(checks))
+
+        self.assertEqual("filled-elsewhere", value)
+        self.assertEqual(0, self.n_fills)
+
+    def test_lock_released_after_fill(self):
+        self.single_flight.lock_enabled = True
+
+        self.assertEqual(1, self.single_flight.do("key", lambda: 1))
+        self.assertIsNone(self.fake_env.cache.redis.get(RedisKeys.fill_lock("key")))
+
+
+class TestMemoryCacheStale(BaseTest):
+    def test_expired_entry_readable_as_stale(self):
+        cache = MemoryCache(stale_ttl=10)
+        cache.set("a", 1, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(1, cache.get_stale("a"))
+
+    def test_deleted_entry_is_not_stale(self):
+        cache = MemoryCache(stale_ttl=10)
+        cache.set("a", 1, ttl=0.01)
+        cache.delete("a")
+
+        self.assertIsNone(cache.get_stale("a"))
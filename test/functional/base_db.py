@@ -10,6 +10,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
 from dinofw.db.rdbms.database import init_db
+from dinofw.db.rdbms.migrations import upgrade
 from test.mocks import FakeEnv
 from dinofw.restful import app
 from dinofw.utils.api import get_db
@@ -37,8 +38,10 @@ class BaseDatabaseTest(BaseTest):
 
         environ.env = self.env
 
-        # init with our test db
+        # init with our test db, the schema is checked on init so migrate it first
+        upgrade(engine)
         init_db(self.env, engine)
+        self.engine = engine
 
         TestingSessionLocal = sessionmaker(
             autocommit=False, autoflush=False, bind=engine
@@ -54,10 +57,12 @@ class BaseDatabaseTest(BaseTest):
         # need to use our testing session instead of the real session
         app.dependency_overrides[get_db] = override_get_db
 
+        from dinofw.db.rdbms.aio import AsyncRelationalHandler
         from dinofw.db.rdbms.handler import RelationalHandler
         from dinofw.db.rdbms import models
 
         self.env.db = RelationalHandler(self.env)
+        self.env.async_db = AsyncRelationalHandler(self.env, self.env.db)
         self.env.session_maker = TestingSessionLocal
 
         def clear_test_db():
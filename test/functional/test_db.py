@@ -1,7 +1,10 @@
 import arrow
 import time
+from uuid import uuid4 as uuid
 
 from dinofw.rest.models import CreateGroupQuery
+from dinofw.rest.models import GroupCursor
+from dinofw.rest.models import GroupQuery
 from dinofw.utils import utcnow_dt
 from dinofw.utils.config import GroupTypes
 from test.base import BaseTest
@@ -9,6 +12,15 @@ from test.functional.base_db import BaseDatabaseTest
 
 
 class TestDatabaseQueries(BaseDatabaseTest):
+    def test_upgrade_schema_twice(self):
+        from dinofw.db.rdbms.migrations import LATEST_VERSION
+        from dinofw.db.rdbms.migrations import check_schema
+        from dinofw.db.rdbms.migrations import upgrade
+
+        # already upgraded in setUp()
+        self.assertEqual(LATEST_VERSION, upgrade(self.engine))
+        check_schema(self.engine)
+
     def test_get_last_sent_for_user_no_ugs(self):
         session = self.env.session_maker()
         group_id, last_sent = self.env.db.get_last_sent_for_user(
@@ -18,11 +30,13 @@ class TestDatabaseQueries(BaseDatabaseTest):
         self.assertIsNone(last_sent)
 
     def test_get_last_sent_for_user_with_ugs(self):
+        from dinofw.db.rdbms import models
+
         session = self.env.session_maker()
         now = arrow.utcnow().datetime
 
-        ugs = self.env.db._create_user_stats(BaseTest.GROUP_ID, BaseTest.USER_ID, now)
-        session.add(ugs)
+        ugs = self.env.db._user_stats_values(BaseTest.GROUP_ID, BaseTest.USER_ID, now)
+        session.add(models.UserGroupStatsEntity(**ugs))
         session.commit()
 
         group_id, last_sent = self.env.db.get_last_sent_for_user(
@@ -67,3 +81,214 @@ class TestDatabaseQueries(BaseDatabaseTest):
             now = utcnow_dt()
             group_base = self.env.db.create_group(users[0], query, now, session)
             groups.append(group_base)
+
+    def test_join_group_without_users(self):
+        from dinofw.db.rdbms import models
+
+        session = self.env.session_maker()
+        query = CreateGroupQuery(
+            users=[50, 51],
+            group_name="test group",
+            group_type=GroupTypes.GROUP,
+        )
+
+        now = utcnow_dt()
+        group = self.env.db.create_group(50, query, now, session)
+
+        self.env.db.update_user_stats_on_join_or_create_group(group.group_id, dict(), now, session)
+
+        self.assertEqual(2, session.query(models.UserGroupStatsEntity).count())
+
+    def _create_groups_with_a_message(self, session, n_groups: int) -> list:
+        """
+        every other group has more members than fanout_max_users, so has a watermark
+        """
+        from dinofw.db.storage.schemas import MessageBase
+
+        self.env.db.fanout_max_users = 2
+        group_ids = list()
+
+        for i in range(n_groups):
+            users = [50, 51] if i % 2 else [50, 51, 52, 53]
+            query = CreateGroupQuery(
+                users=users,
+                group_name=f"test group {i}",
+                group_type=GroupTypes.GROUP,
+            )
+
+            now = utcnow_dt()
+            group = self.env.db.create_group(50, query, now, session)
+            time.sleep(0.01)
+
+            message = MessageBase(
+                group_id=group.group_id,
+                created_at=utcnow_dt(),
+                user_id=51,
+                message_id=str(uuid()),
+                message_type=0,
+            )
+            self.env.db.update_group_new_message(message, message.created_at, session)
+            group_ids.append(group.group_id)
+
+        return group_ids
+
+    def test_get_groups_for_user_cursor_across_watermarked_groups(self):
+        session = self.env.session_maker()
+        group_ids = self._create_groups_with_a_message(session, n_groups=7)
+
+        seen = list()
+        cursor = None
+
+        while True:
+            query = GroupQuery(per_page=2, cursor=cursor, only_unread=False, count_unread=False)
+            groups = self.env.db.get_groups_for_user(50, query, session)
+
+            if not len(groups):
+                break
+
+            seen.extend([group.group.group_id for group in groups])
+            last = groups[-1]
+
+            cursor = GroupCursor(
+                pin=last.user_stats.pin,
+                sort_time=GroupQuery.to_ts(last.user_stats.sort_time),
+                group_id=last.group.group_id,
+            )
+
+        # newest first, no duplicates and no gaps
+        self.assertEqual(list(reversed(group_ids)), seen)
+
+    def test_get_groups_for_user_without_sort_time(self):
+        from dinofw.db.rdbms import models
+
+        session = self.env.session_maker()
+        group_ids = self._create_groups_with_a_message(session, n_groups=4)
+
+        # the groups with index 1 and 3 aren't watermarked
+        session.query(models.UserGroupStatsEntity).filter(
+            models.UserGroupStatsEntity.group_id == group_ids[1]
+        ).update({models.UserGroupStatsEntity.sort_time: None}, synchronize_session=False)
+        session.commit()
+
+        query = GroupQuery(per_page=10, only_unread=False, count_unread=False)
+        groups = self.env.db.get_groups_for_user(50, query, session)
+
+        self.assertEqual(4, len(groups))
+        self.assertTrue(all(group.user_stats.sort_time is not None for group in groups))
+
+    def test_get_groups_for_user_cursor_without_sort_time(self):
+        from dinofw.db.rdbms import models
+
+        session = self.env.session_maker()
+        group_ids = self._create_groups_with_a_message(session, n_groups=5)
+
+        session.query(models.UserGroupStatsEntity).filter(
+            models.UserGroupStatsEntity.group_id.in_([group_ids[1], group_ids[3]])
+        ).update({models.UserGroupStatsEntity.sort_time: None}, synchronize_session=False)
+        session.commit()
+
+        seen = list()
+        cursor = None
+
+        while True:
+            query = GroupQuery(per_page=2, cursor=cursor, only_unread=False, count_unread=False)
+            groups = self.env.db.get_groups_for_user(50, query, session)
+
+            if not len(groups):
+                break
+
+            seen.extend([group.group.group_id for group in groups])
+            last = groups[-1]
+
+            cursor = GroupCursor(
+                pin=last.user_stats.pin,
+                sort_time=GroupQuery.to_ts(last.user_stats.sort_time),
+                group_id=last.group.group_id,
+            )
+
+        # sorted by the last message instead of first, and not skipped by the cursor
+        self.assertEqual(list(reversed(group_ids)), seen)
+
+    def _stats_of_other_users(self, session, user_id: int) -> list:
+        from dinofw.db.rdbms import models
+
+        session.expire_all()
+
+        return sorted(
+            session.query(
+                models.UserGroupStatsEntity.group_id,
+                models.UserGroupStatsEntity.user_id,
+                models.UserGroupStatsEntity.last_read,
+                models.UserGroupStatsEntity.last_updated_time,
+                models.UserGroupStatsEntity.bookmark,
+            )
+            .filter(models.UserGroupStatsEntity.user_id != user_id)
+            .all()
+        )
+
+    def test_mark_all_groups_as_read_only_for_the_user(self):
+        from dinofw.db.rdbms import models
+
+        session = self.env.session_maker()
+        group_ids = self._create_groups_with_a_message(session, n_groups=3)
+
+        for group_id in group_ids:
+            self.env.cache.set_unread_in_group(group_id, 50, 1)
+            self.env.cache.set_unread_in_group(group_id, 52, 1)
+
+        others_before = self._stats_of_other_users(session, 50)
+        self.env.db.mark_all_groups_as_read(50, session)
+
+        self.assertEqual(others_before, self._stats_of_other_users(session, 50))
+
+        rows = (
+            session.query(models.UserGroupStatsEntity, models.GroupEntity)
+            .filter(
+                models.UserGroupStatsEntity.group_id == models.GroupEntity.group_id,
+                models.UserGroupStatsEntity.user_id == 50,
+            )
+            .all()
+        )
+
+        self.assertEqual(len(group_ids), len(rows))
+
+        for user_stats, group in rows:
+            self.assertGreaterEqual(user_stats.last_read, group.last_message_time)
+            self.assertEqual(group.message_seq, user_stats.last_read_seq)
+            self.assertEqual(0, self.env.cache.get_unread_in_group(group.group_id, 50))
+
+        # the unread counts of the other members are kept too
+        self.assertEqual(1, self.env.cache.get_unread_in_group(group_ids[0], 52))
+
+    def test_set_last_updated_at_for_all_members(self):
+        from dinofw.db.rdbms import models
+
+        session = self.env.session_maker()
+        group_ids = self._create_groups_with_a_message(session, n_groups=3)
+
+        # a group the user is not in
+        query = CreateGroupQuery(users=[51, 52], group_name="other group", group_type=GroupTypes.GROUP)
+        other_group = self.env.db.create_group(51, query, utcnow_dt(), session)
+        time.sleep(0.01)
+
+        before = utcnow_dt()
+        self.env.db.set_last_updated_at_on_all_stats_related_to_user(50, session)
+        session.expire_all()
+
+        stats = (
+            session.query(
+                models.UserGroupStatsEntity.group_id,
+                models.UserGroupStatsEntity.last_updated_time,
+            )
+            .all()
+        )
+
+        for group_id, last_updated_time in stats:
+            if group_id in group_ids:
+                self.assertGreaterEqual(last_updated_time, before)
+            else:
+                self.assertEqual(other_group.group_id, group_id)
+                self.assertLess(last_updated_time, before)
+
+        # every member of every group the user is in, not only the user
+        self.assertEqual(4 + 2 + 4, len([1 for group_id, _ in stats if group_id in group_ids]))
@@ -100,6 +100,28 @@ class TestServerRestApi(BaseServerRestApi):
         self.assert_groups_for_user(1, user_id=BaseTest.USER_ID)
         self.assert_groups_for_user(1, user_id=BaseTest.OTHER_USER_ID)
 
+    def test_group_with_watermark_unhidden_on_new_message(self):
+        # only the group row is updated when sending messages to groups this large
+        self.env.db.fanout_max_users = 1
+
+        group_id = self.create_and_join_group(BaseTest.USER_ID)
+        self.user_joins_group(group_id, BaseTest.OTHER_USER_ID)
+        self.send_message_to_group_from(group_id, BaseTest.USER_ID)
+
+        self.update_hide_group_for(group_id, True, BaseTest.OTHER_USER_ID)
+        self.assert_hidden_for_user(True, group_id, BaseTest.OTHER_USER_ID)
+        self.assert_groups_for_user(0, user_id=BaseTest.OTHER_USER_ID)
+
+        # derived from the group's wakeup time, the user's stats are not updated
+        self.send_message_to_group_from(group_id, BaseTest.USER_ID)
+        self.assert_hidden_for_user(False, group_id, BaseTest.OTHER_USER_ID)
+        self.assert_groups_for_user(1, user_id=BaseTest.OTHER_USER_ID)
+
+        # hiding again has to materialize the wakeup first, and then hide it
+        self.update_hide_group_for(group_id, True, BaseTest.OTHER_USER_ID)
+        self.assert_hidden_for_user(True, group_id, BaseTest.OTHER_USER_ID)
+        self.assert_groups_for_user(0, user_id=BaseTest.OTHER_USER_ID)
+
     def test_one_user_deletes_some_history(self):
         # both users join a new group
         group_id = self.create_and_join_group(BaseTest.USER_ID)
@@ -672,6 +694,20 @@ class TestServerRestApi(BaseServerRestApi):
         self.assertEqual(2, stats["group_amount"])
         self.assertEqual(2, stats["one_to_one_amount"])
 
+    def test_joined_group_counted_after_next_message(self):
+        group_id = self.create_and_join_group(user_id=BaseTest.OTHER_USER_ID)
+        self.send_message_to_group_from(group_id, user_id=BaseTest.OTHER_USER_ID)
+
+        # no messages since joining
+        self.user_joins_group(group_id)
+        stats = self.get_global_user_stats(hidden=False)
+        self.assertEqual(0, stats["group_amount"])
+
+        # only counted once, the flag is removed on the first message
+        self.send_message_to_group_from(group_id, user_id=BaseTest.OTHER_USER_ID, amount=2)
+        stats = self.get_global_user_stats(hidden=False)
+        self.assertEqual(1, stats["group_amount"])
+
     def test_user_stats_group_read_and_send_times(self):
         stats = self.get_global_user_stats(hidden=False)
         self.assertEqual(0, stats["group_amount"])
@@ -1193,6 +1229,15 @@ class TestServerRestApi(BaseServerRestApi):
         info = self.get_group_info(message["group_id"], count_messages=True)
         self.assertEqual(2, info["message_amount"])
 
+    def test_new_message_removes_cached_group(self):
+        group_id = self.send_1v1_message()["group_id"]
+
+        self.get_group_info(group_id, count_messages=False)
+        self.assertIsNotNone(self.env.cache.get_group(group_id))
+
+        self.send_1v1_message()
+        self.assertIsNone(self.env.cache.get_group(group_id))
+
     def test_unread_groups_amount_in_user_stats(self):
         # default is to count
         stats = self.get_global_user_stats()
@@ -1,12 +1,15 @@
 from datetime import datetime as dt, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from uuid import uuid4 as uuid
 
 import arrow
 
+from dinofw.cache.aio import AsyncCache
 from dinofw.cache.redis import CacheRedis
+from dinofw.db.rdbms.aio import AsyncRelationalHandler
 from dinofw.db.rdbms.schemas import GroupBase, UserGroupBase
 from dinofw.db.rdbms.schemas import UserGroupStatsBase
+from dinofw.db.storage.aio import AsyncStorage
 from dinofw.db.storage.schemas import MessageBase
 from dinofw.endpoint import IClientPublishHandler, IClientPublisher
 from dinofw.rest.models import AbstractQuery, AttachmentQuery
@@ -19,8 +22,10 @@ from dinofw.rest.models import MessageQuery
 from dinofw.rest.models import SendMessageQuery
 from dinofw.utils import trim_micros
 from dinofw.utils import utcnow_dt
+from dinofw.utils.config import MessageTypes
 from dinofw.utils.exceptions import NoSuchGroupException
 from dinofw.utils.exceptions import NoSuchAttachmentException
+from dinofw.utils.exceptions import NoSuchMessageException
 
 
 class FakeStorage:
@@ -132,6 +137,24 @@ class FakeStorage:
 
         return logs
 
+    def create_action_log(
+        self, user_id: int, group_id: str, query: CreateActionLogQuery
+    ) -> MessageBase:
+        if group_id not in self.action_log:
+            self.action_log[group_id] = list()
+
+        log = MessageBase(
+            group_id=group_id,
+            created_at=utcnow_dt(),
+            user_id=user_id,
+            message_id=str(uuid()),
+            message_payload=query.payload,
+            message_type=MessageTypes.ACTION,
+        )
+
+        self.action_log[group_id].append(log)
+        return log
+
     def store_attachment(
         self, group_id: str, user_id: int, message_id: str, query: CreateAttachmentQuery
     ) -> MessageBase:
@@ -143,7 +166,7 @@ class FakeStorage:
                 break
 
         if message_type is None:
-            raise NoSuchAttachmentException(message_id)
+            raise NoSuchMessageException(message_id)
 
         attachment = MessageBase(
             group_id=str(group_id),
@@ -371,10 +394,37 @@ class FakeDatabase:
 
         return self.groups[group_id].last_message_time
 
-    def update_group_new_message(self, message: MessageBase, sent_time: dt, _, wakeup_users: bool = True) -> None:
+    def get_group_from_id(self, group_id: str, _) -> GroupBase:
+        if group_id not in self.groups:
+            raise NoSuchGroupException(group_id)
+
+        return self.groups[group_id]
+
+    def init_message_seq_in_group(self, group_id: str, n_messages: int, _) -> None:
+        if group_id in self.groups and self.groups[group_id].message_seq is None:
+            self.groups[group_id].message_seq = n_messages
+
+    def _message_seq(self, group_id: str) -> Optional[int]:
+        if group_id not in self.groups:
+            return None
+
+        return self.groups[group_id].message_seq
+
+    def update_group_new_message(
+        self,
+        message: MessageBase,
+        sent_time: dt,
+        _,
+        wakeup_users: bool = True,
+        update_cache: bool = True,
+        new_message: bool = True,
+    ) -> None:
         if message.group_id not in self.groups:
             return
 
+        if new_message and self.groups[message.group_id].message_seq is not None:
+            self.groups[message.group_id].message_seq += 1
+
         self.groups[message.group_id].last_message_time = sent_time
         self.groups[message.group_id].last_message_overview = message.message_payload
         self.groups[message.group_id].last_message_type = message.message_type
@@ -401,6 +451,7 @@ class FakeDatabase:
                 continue
 
             stat.last_read = the_time
+            stat.last_read_seq = self._message_seq(group_id)
             stat.highlight_time = the_time
 
     def create_group(self, owner_id: int, query: CreateGroupQuery, now, _) -> GroupBase:
@@ -418,6 +469,7 @@ class FakeDatabase:
             meta=query.meta,
             context=query.context,
             description=query.description,
+            message_seq=0,
         )
 
         self.groups[group.group_id] = group
@@ -436,7 +488,7 @@ class FakeDatabase:
         self.last_sent[user_id] = group_id, the_time
 
     def count_group_types_for_user(
-        self, user_id: int, query: GroupQuery, _
+        self, user_id: int, query: GroupQuery, _, primary: bool = False
     ) -> List[Tuple[int, int]]:
         group_ids_for_user = set()
         group_types = dict()
@@ -463,7 +515,13 @@ class FakeDatabase:
         return list(group_types.items())
 
     def get_groups_for_user(
-        self, user_id: int, query: GroupQuery, _, count_receiver_unread: bool = True, receiver_stats: bool = False,
+        self,
+        user_id: int,
+        query: GroupQuery,
+        _,
+        count_receiver_unread: bool = True,
+        receiver_stats: bool = False,
+        primary: bool = False,
     ) -> List[UserGroupBase]:
         groups = list()
 
@@ -540,12 +598,13 @@ class FakeDatabase:
         self.groups[group_id].updated_at = now
 
     def update_last_read_and_sent_in_group_for_user(
-        self, group_id: str, user_id: int, created_at: dt, _
+        self, group_id: str, user_id: int, created_at: dt, _, update_cache: bool = True
     ) -> None:
         to_add = UserGroupStatsBase(
             group_id=group_id,
             user_id=user_id,
             last_read=created_at,
+            last_read_seq=self._message_seq(group_id),
             last_sent=created_at,
             delete_before=created_at,
             highlight_time=self.long_ago,
@@ -562,6 +621,7 @@ class FakeDatabase:
             for group_stats in self.stats[user_id]:
                 if group_stats.group_id == group_id:
                     group_stats.last_read = created_at
+                    group_stats.last_read_seq = self._message_seq(group_id)
                     group_stats.last_sent = created_at
                     found_group = True
 
@@ -613,6 +673,9 @@ class FakeDatabase:
 
         return response  # noqa
 
+    def get_all_group_ids_for_user(self, user_id: int, _) -> List[str]:
+        return [stat.group_id for stat in self.stats.get(user_id, list())]
+
     def get_user_stats_in_group(
         self, group_id: str, user_id: int, _
     ) -> Optional[UserGroupStatsBase]:
@@ -688,6 +751,112 @@ class FakePublisherHandler(IClientPublishHandler):
         pass
 
 
+class FakeResultSet(list):
+    def __init__(self, rows, has_more_pages: bool = False):
+        super().__init__(rows)
+        self.has_more_pages = has_more_pages
+
+    def one(self):
+        return self[0] if len(self) else None
+
+
+class FakeResponseFuture:
+    """
+    completes as soon as the callbacks are added; a result with more pages is
+    returned one row per page, the next one when start_fetching_next_page() is called
+    """
+    def __init__(self, result: FakeResultSet = None, error: Exception = None):
+        self.result = result
+        self.error = error
+        self.has_more_pages = result is not None and result.has_more_pages
+
+        self.pages = [[row] for row in result] if self.has_more_pages else [result]
+        self.callback = None
+
+        # read by the driver's ResultSet, used by execute_concurrent()
+        self._col_names = None
+        self._col_types = None
+
+    def add_callbacks(self, callback, errback, callback_args=(), errback_args=()):
+        if self.error is not None:
+            errback(self.error, *errback_args)
+        else:
+            self.callback = (callback, callback_args)
+            self._call_back()
+
+    def start_fetching_next_page(self):
+        if not self.has_more_pages:
+            raise ValueError("no more pages")
+
+        self.pages.pop(0)
+        self._call_back()
+
+    def _call_back(self):
+        self.has_more_pages = len(self.pages) > 1
+
+        callback, callback_args = self.callback
+        callback(self.pages[0], *callback_args)
+
+    def clear_callbacks(self):
+        pass
+
+
+class FakeBatchStatement:
+    """
+    used instead of the driver's BatchStatement, which can't bind the statements
+    of FakeCassandraSession since they aren't prepared
+    """
+    def __init__(self, batch_type=None):
+        self.batch_type = batch_type
+        self.statements: List[Tuple[str, tuple]] = list()
+
+    def add(self, statement: str, parameters: tuple = None):
+        self.statements.append((statement, tuple(parameters)))
+
+
+class FakeCassandraSession:
+    """
+    the prepared statements are the cql itself, so the rows a statement returns
+    can be set up with `session.rows[statements.message_by_id.statement] = [...]`,
+    or with a function of the parameters if they depend on them
+    """
+    def __init__(self):
+        self.rows: Dict[str, Union[list, Callable]] = dict()
+        self.more_pages: List[str] = list()
+        self.executed: List[Tuple[str, tuple, str]] = list()
+        self.batches: List[FakeBatchStatement] = list()
+
+    def prepare(self, cql: str) -> str:
+        return cql
+
+    def execute(self, statement: str, parameters: tuple = None, execution_profile=None) -> FakeResultSet:
+        if isinstance(statement, FakeBatchStatement):
+            self.batches.append(statement)
+
+            for batched, batched_parameters in statement.statements:
+                self.executed.append((batched, batched_parameters, execution_profile))
+
+            return FakeResultSet(list())
+
+        self.executed.append((statement, tuple(parameters), execution_profile))
+
+        rows = self.rows.get(statement, list())
+        if callable(rows):
+            rows = rows(tuple(parameters))
+
+        return FakeResultSet(rows, statement in self.more_pages)
+
+    def execute_async(self, statement: str, parameters: tuple = None, execution_profile=None) -> FakeResponseFuture:
+        return FakeResponseFuture(self.execute(statement, parameters, execution_profile))
+
+    def statements_executed(self, statement: str) -> List[tuple]:
+        return [
+            parameters
+            for executed, parameters, _ in self.executed
+            if executed == statement
+        ]
+
+
 class FakeEnv:
     class Config:
         def __init__(self):
@@ -716,11 +885,14 @@ class FakeEnv:
     def __init__(self):
         self.config = FakeEnv.Config()
         self.storage = FakeStorage(self)
+        self.async_storage = AsyncStorage(self, self.storage)
         self.db = FakeDatabase()
+        self.async_db = AsyncRelationalHandler(self, self.db)
         self.stats = None
         self.client_publisher = FakePublisherHandler()
         self.server_publisher = FakePublisherHandler()
         self.cache = CacheRedis(self, host="mock")
+        self.async_cache = AsyncCache(self, self.cache)
 
         from dinofw.rest.groups import GroupResource
         from dinofw.rest.users import UserResource
@@ -0,0 +1,127 @@
+from typing import List
+
+from dinofw.db.rdbms.routing import pins_to_primary
+from dinofw.db.rdbms.routing import read_replica
+from dinofw.db.rdbms.routing import reading_from_replica
+from dinofw.utils.config import RedisKeys
+from test.base import BaseTest
+
+
+class FakeSession:
+    def __init__(self, name: str):
+        self.name = name
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakeHandler:
+    replica_pin_ttl = 5
+
+    def __init__(self, env):
+        self.env = env
+
+    @read_replica()
+    def read_for_user(self, user_id: int, db: FakeSession) -> FakeSession:
+        return db
+
+    @read_replica(user_arg=None)
+    def read_for_all(self, db: FakeSession) -> FakeSession:
+        return db
+
+    @read_replica()
+    def read_if_from_replica(self, user_id: int, db: FakeSession) -> bool:
+        return reading_from_replica()
+
+    @pins_to_primary("user_id")
+    def write_for_user(self, user_id: int, db: FakeSession) -> None:
+        pass
+
+    @pins_to_primary("user_ids")
+    def write_for_users(self, group_id: str, user_ids: List[int], db: FakeSession) -> None:
+        pass
+
+
+class TestReplicaRouting(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.replicas = list()
+
+        def replica_session():
+            session = FakeSession("replica")
+            self.replicas.append(session)
+            return session
+
+        self.fake_env.ReplicaSessionLocal = replica_session
+        self.handler = FakeHandler(self.fake_env)
+        self.primary = FakeSession("primary")
+
+    def test_read_uses_replica(self):
+        db = self.handler.read_for_user(BaseTest.USER_ID, self.primary)
+
+        self.assertEqual("replica", db.name)
+        self.assertTrue(db.closed)
+        self.assertFalse(self.primary.closed)
+
+    def test_read_with_keyword_db(self):
+        db = self.handler.read_for_user(user_id=BaseTest.USER_ID, db=self.primary)
+        self.assertEqual("replica", db.name)
+
+    def test_no_replicas_configured(self):
+        self.fake_env.ReplicaSessionLocal = None
+
+        self.assertIs(self.primary, self.handler.read_for_user(BaseTest.USER_ID, self.primary))
+        self.assertIs(self.primary, self.handler.read_for_all(self.primary))
+
+        # nothing to pin to without replicas
+        self.handler.write_for_user(BaseTest.USER_ID, self.primary)
+        self.assertFalse(self.fake_env.cache.is_user_pinned_to_primary(BaseTest.USER_ID))
+
+    def test_read_after_write_uses_primary(self):
+        self.handler.write_for_user(BaseTest.USER_ID, self.primary)
+
+        self.assertIs(self.primary, self.handler.read_for_user(BaseTest.USER_ID, self.primary))
+        self.assertEqual(0, len(self.replicas))
+
+        # only the user who wrote something is pinned
+        self.assertEqual("replica", self.handler.read_for_user(BaseTest.OTHER_USER_ID, self.primary).name)
+
+    def test_pin_expires(self):
+        self.handler.write_for_user(BaseTest.USER_ID, self.primary)
+
+        ttl = self.fake_env.cache.redis.ttl(RedisKeys.primary_pin(BaseTest.USER_ID))
+        self.assertTrue(0 < ttl <= FakeHandler.replica_pin_ttl)
+
+    def test_pins_a_list_of_users(self):
+        self.handler.write_for_users(BaseTest.GROUP_ID, [BaseTest.USER_ID, BaseTest.OTHER_USER_ID], self.primary)
+
+        for user_id in [BaseTest.USER_ID, BaseTest.OTHER_USER_ID]:
+            self.assertIs(self.primary, self.handler.read_for_user(user_id, self.primary))
+
+    def test_pins_the_keys_of_a_dict(self):
+        users = {BaseTest.USER_ID: 1.0, BaseTest.OTHER_USER_ID: 2.0}
+        self.handler.write_for_users(BaseTest.GROUP_ID, users, self.primary)
+
+        self.assertTrue(self.fake_env.cache.is_user_pinned_to_primary(BaseTest.OTHER_USER_ID))
+
+    def test_read_without_user_ignores_pins(self):
+        self.handler.write_for_user(BaseTest.USER_ID, self.primary)
+
+        self.assertEqual("replica", self.handler.read_for_all(self.primary).name)
+
+    def test_primary_for_callers_that_cache(self):
+        db = self.handler.read_for_user(BaseTest.USER_ID, self.primary, primary=True)
+
+        self.assertIs(self.primary, db)
+        self.assertEqual(0, len(self.replicas))
+
+    def test_cache_not_filled_from_replica(self):
+        self.assertTrue(self.handler.read_if_from_replica(BaseTest.USER_ID, self.primary))
+        self.assertFalse(reading_from_replica())
+
+        # the primary is used for pinned users, its values can be cached
+        self.assertFalse(self.handler.read_if_from_replica(BaseTest.USER_ID, self.primary, primary=True))
+
+        self.handler.write_for_user(BaseTest.USER_ID, self.primary)
+        self.assertFalse(self.handler.read_if_from_replica(BaseTest.USER_ID, self.primary))
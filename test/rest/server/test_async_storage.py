@@ -0,0 +1,177 @@
+import threading
+from unittest.mock import patch
+
+from fastapi import HTTPException
+from fastapi import status
+
+from dinofw.rest.groups import GroupResource
+from dinofw.rest.message import MessageResource
+from dinofw.rest.models import AbstractQuery
+from dinofw.rest.models import AttachmentQuery
+from dinofw.rest.models import CreateActionLogQuery
+from dinofw.rest.models import CreateAttachmentQuery
+from dinofw.rest.models import CreateGroupQuery
+from dinofw.rest.models import GroupInfoQuery
+from dinofw.rest.models import MessageQuery
+from dinofw.rest.models import SendMessageQuery
+from dinofw.utils import environ
+from dinofw.utils import utcnow_ts
+from dinofw.utils.config import ErrorCodes
+from dinofw.utils.config import MessageTypes
+from test.base import BaseTest
+from test.base import async_test
+
+
+class ThreadRecordingStorage:
+    """
+    wraps the fake storage and records the threads its methods are called from
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.threads = dict()
+
+    def __getattr__(self, item):
+        method = getattr(self.storage, item)
+
+        def call(*args, **kwargs):
+            self.threads.setdefault(item, set()).add(threading.current_thread().name)
+            return method(*args, **kwargs)
+
+        return call
+
+
+class TestAsyncStorage(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.group = GroupResource(self.fake_env)
+        self.message = MessageResource(self.fake_env)
+
+        self.storage = ThreadRecordingStorage(self.fake_env.storage)
+        self.fake_env.async_storage.storage = self.storage
+
+        self.send_query = SendMessageQuery(message_payload="some text", message_type=MessageTypes.MESSAGE)
+
+    async def _create_group(self) -> str:
+        query = CreateGroupQuery(group_name="some group name", group_type=0, users=[BaseTest.USER_ID])
+        group = await self.group.create_new_group(BaseTest.USER_ID, query, None)  # noqa
+
+        return group.group_id
+
+    def assert_not_on_event_loop(self, *methods: str):
+        for method in methods:
+            self.assertIn(method, self.storage.threads)
+
+            for thread_name in self.storage.threads[method]:
+                self.assertTrue(thread_name.startswith("storage"), f"{method} called from {thread_name}")
+
+    @async_test
+    async def test_send_message(self):
+        group_id = await self._create_group()
+        await self.message.send_message_to_group(group_id, BaseTest.USER_ID, self.send_query, None)  # noqa
+
+        self.assert_not_on_event_loop("store_message")
+
+    @async_test
+    async def test_messages_in_group(self):
+        group_id = await self._create_group()
+        await self.message.messages_in_group(group_id, MessageQuery(per_page=10))
+
+        self.assert_not_on_event_loop("get_messages_in_group")
+
+    @async_test
+    async def test_messages_for_user(self):
+        await self.message.messages_for_user(BaseTest.GROUP_ID, BaseTest.USER_ID, MessageQuery(per_page=10), None)  # noqa
+
+        self.assert_not_on_event_loop("get_messages_in_group_for_user")
+
+    @async_test
+    async def test_histories(self):
+        group_id = await self._create_group()
+        await self.message.send_message_to_group(group_id, BaseTest.USER_ID, self.send_query, None)  # noqa
+        await self.group.histories(group_id, BaseTest.USER_ID, MessageQuery(per_page=10), None)  # noqa
+
+        self.assert_not_on_event_loop("get_messages_in_group_for_user")
+
+    @async_test
+    async def test_attachments(self):
+        group_id = await self._create_group()
+        message = await self.message.send_message_to_group(group_id, BaseTest.USER_ID, self.send_query, None)  # noqa
+
+        query = CreateAttachmentQuery(
+            group_id=group_id,
+            file_id=BaseTest.FILE_ID,
+            message_payload="some payload",
+            created_at=AbstractQuery.to_ts(message.created_at),
+        )
+        await self.message.create_attachment(BaseTest.USER_ID, message.message_id, query, None)  # noqa
+        await self.message.get_attachment_info(group_id, AttachmentQuery(file_id=BaseTest.FILE_ID), None)  # noqa
+        await self.group.get_attachments_in_group_for_user(
+            group_id, BaseTest.USER_ID, MessageQuery(per_page=10), None  # noqa
+        )
+
+        self.assert_not_on_event_loop(
+            "store_attachment", "get_attachment_from_file_id", "get_attachments_in_group_for_user"
+        )
+
+    @async_test
+    async def test_count_messages(self):
+        group_id = await self._create_group()
+
+        # only counted in storage for groups from before message_seq existed
+        self.fake_env.db.groups[group_id].message_seq = None
+        await self.group.get_group(group_id, GroupInfoQuery(count_messages=True), None)  # noqa
+        await self.group.count_messages_in_group(group_id, None)  # noqa
+
+        self.assert_not_on_event_loop("count_messages_in_group_since")
+
+    @async_test
+    async def test_create_action_log(self):
+        group_id = await self._create_group()
+        query = CreateActionLogQuery(group_id=group_id, payload="some payload")
+        await self.group.create_action_log(BaseTest.USER_ID, query, None)  # noqa
+
+        self.assert_not_on_event_loop("create_action_log")
+
+
+class TestAsyncStorageErrors(BaseTest):
+    """
+    errors raised by the storage handler in the thread pool still surface as the same http errors
+    """
+    def setUp(self) -> None:
+        super().setUp()
+        from dinofw.router import post
+        self.post = post
+
+        self.message = MessageResource(self.fake_env)
+        self.fake_env.rest.message = self.message
+
+    @async_test
+    async def test_no_such_attachment(self):
+        query = CreateGroupQuery(group_name="some group name", group_type=0, users=[BaseTest.USER_ID])
+        group = await GroupResource(self.fake_env).create_new_group(BaseTest.USER_ID, query, None)  # noqa
+
+        with patch.object(environ.env, "rest", self.fake_env.rest, create=True):
+            with self.assertRaises(HTTPException) as e:
+                await self.post.get_attachment_info_from_file_id(
+                    group.group_id, AttachmentQuery(file_id=BaseTest.FILE_ID), None  # noqa
+                )
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, e.exception.status_code)
+        self.assertTrue(e.exception.detail.startswith(f"{ErrorCodes.NO_SUCH_ATTACHMENT}:"))
+
+    @async_test
+    async def test_no_such_message(self):
+        query = CreateAttachmentQuery(
+            group_id=BaseTest.GROUP_ID,
+            file_id=BaseTest.FILE_ID,
+            message_payload="some payload",
+            created_at=utcnow_ts(),
+        )
+        self.fake_env.storage.messages_by_group[BaseTest.GROUP_ID] = list()
+
+        with patch.object(environ.env, "rest", self.fake_env.rest, create=True):
+            with self.assertRaises(HTTPException) as e:
+                await self.post.create_an_attachment(BaseTest.USER_ID, "no-such-message", query, None)  # noqa
+
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, e.exception.status_code)
+        self.assertTrue(e.exception.detail.startswith(f"{ErrorCodes.NO_SUCH_MESSAGE}:"))
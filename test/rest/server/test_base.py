@@ -0,0 +1,101 @@
+import arrow
+
+from dinofw.db.rdbms.schemas import GroupBase
+from dinofw.db.rdbms.schemas import UserGroupStatsBase
+from dinofw.rest.base import BaseResource
+from dinofw.rest.models import AbstractQuery
+from dinofw.rest.models import Group
+from dinofw.rest.models import UserGroup
+from test.base import BaseTest
+
+
+class TestResponseModels(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.now = arrow.utcnow()
+
+        # constructed like RelationalHandler._to_base() does, without validation
+        self.group_base = GroupBase.construct(
+            group_id=BaseTest.GROUP_ID,
+            name="some group name",
+            description=None,
+            created_at=self.now.shift(days=-1).datetime,
+            updated_at=self.now.datetime,
+            first_message_time=self.now.shift(days=-1).datetime,
+            last_message_time=self.now.datetime,
+            last_message_id=None,
+            last_message_overview=None,
+            last_message_type=None,
+            last_message_user_id=None,
+            wakeup_time=self.now.datetime,
+            message_seq=3,
+            status=None,
+            group_type=0,
+            owner_id=BaseTest.USER_ID,
+            meta=None,
+            context=None,
+        )
+        self.stats_base = UserGroupStatsBase.construct(
+            group_id=BaseTest.GROUP_ID,
+            user_id=BaseTest.USER_ID,
+            last_read=self.now.shift(hours=-1).datetime,
+            last_sent=self.now.shift(hours=-2).datetime,
+            delete_before=self.now.shift(days=-1).datetime,
+            join_time=self.now.shift(days=-1).datetime,
+            highlight_time=None,
+            last_updated_time=self.now.datetime,
+            first_sent=None,
+            sort_time=self.now.datetime,
+            last_read_seq=2,
+            hide=False,
+            pin=True,
+            bookmark=False,
+            rating=None,
+        )
+        self.users = {BaseTest.USER_ID: 1.0, BaseTest.OTHER_USER_ID: 2.0}
+
+    def test_group_only_has_response_fields(self):
+        group = BaseResource.group_base_to_group(self.group_base, self.users, len(self.users))
+
+        self.assertNotIn("wakeup_time", group.__dict__)
+        self.assertNotIn("message_seq", group.__dict__)
+        self.assertEqual(AbstractQuery.to_ts(self.now), group.last_message_time)
+
+        # newest join first
+        self.assertEqual([BaseTest.OTHER_USER_ID, BaseTest.USER_ID], [user.user_id for user in group.users])
+
+        # what fastapi does when serializing the response
+        self.assertEqual(group, Group(**group.dict()))
+
+    def test_user_group_stats_converted(self):
+        user_group = BaseResource.group_base_to_user_group(
+            self.group_base, self.stats_base, None, self.users, len(self.users), receiver_unread=-1, unread=4,
+        )
+        stats = user_group.stats
+
+        self.assertNotIn("last_read_seq", stats.__dict__)
+        self.assertEqual(4, stats.unread)
+        self.assertEqual(AbstractQuery.to_ts(self.now.shift(hours=-1)), stats.last_read_time)
+        self.assertEqual(AbstractQuery.to_ts(self.now), stats.sort_time)
+        self.assertIsNone(stats.highlight_time)
+        self.assertIsNone(stats.receiver_hide)
+
+        self.assertEqual(user_group, UserGroup(**user_group.dict()))
+
+    def test_bases_not_changed(self):
+        BaseResource.group_base_to_user_group(
+            self.group_base, self.stats_base, self.stats_base, self.users, len(self.users), receiver_unread=0, unread=0,
+        )
+
+        self.assertEqual(self.now.datetime, self.group_base.last_message_time)
+        self.assertEqual(self.now.shift(hours=-1).datetime, self.stats_base.last_read)
+        self.assertEqual(self.now.datetime, self.stats_base.sort_time)
+
+    def test_receiver_stats(self):
+        user_group = BaseResource.group_base_to_user_group(
+            self.group_base, self.stats_base, self.stats_base, self.users, len(self.users), receiver_unread=1, unread=0,
+        )
+
+        self.assertEqual(1, user_group.stats.receiver_unread)
+        self.assertFalse(user_group.stats.receiver_hide)
+        self.assertEqual(AbstractQuery.to_ts(self.now.shift(days=-1)), user_group.stats.receiver_delete_before)
@@ -132,7 +132,7 @@ class TestGroupResource(BaseTest):
         group = await self.group.create_new_group(
             BaseTest.USER_ID, create_query, None
         )
-        count = await self.group.count_messages_in_group(group.group_id)
+        count = await self.group.count_messages_in_group(group.group_id, None)
         stats = await self.group.get_user_group_stats(
             group.group_id, BaseTest.USER_ID, count, None
         )
@@ -143,7 +143,7 @@ class TestGroupResource(BaseTest):
             group.group_id, BaseTest.USER_ID, send_query, None
         )
         time.sleep(0.01)
-        count = await self.group.count_messages_in_group(group.group_id)
+        count = await self.group.count_messages_in_group(group.group_id, None)
         stats = await self.group.get_user_group_stats(
             group.group_id, BaseTest.USER_ID, count, None
         )
@@ -154,12 +154,38 @@ class TestGroupResource(BaseTest):
             group.group_id, BaseTest.OTHER_USER_ID, send_query, None
         )
         time.sleep(0.01)
-        count = await self.group.count_messages_in_group(group.group_id)
+        count = await self.group.count_messages_in_group(group.group_id, None)
         stats = await self.group.get_user_group_stats(
             group.group_id, BaseTest.USER_ID, count, None
         )
         self.assertEqual(1, stats.unread)
 
+    @async_test
+    async def test_count_messages_in_group_without_message_seq(self):
+        create_query = CreateGroupQuery(
+            group_name="some group name", group_type=0, users=[BaseTest.USER_ID],
+        )
+        send_query = SendMessageQuery(
+            message_payload="some text", message_type=MessageTypes.MESSAGE
+        )
+
+        group = await self.group.create_new_group(
+            BaseTest.USER_ID, create_query, None
+        )
+
+        # groups created before message_seq existed have to be counted once
+        self.group.env.db.groups[group.group_id].message_seq = None
+        self.group.env.storage.store_message(group.group_id, BaseTest.OTHER_USER_ID, send_query)
+        self.group.env.storage.store_message(group.group_id, BaseTest.OTHER_USER_ID, send_query)
+
+        self.assertEqual(2, await self.group.count_messages_in_group(group.group_id, None))
+        self.assertEqual(2, self.group.env.db.groups[group.group_id].message_seq)
+
+        await self.message.send_message_to_group(
+            group.group_id, BaseTest.OTHER_USER_ID, send_query, None
+        )
+        self.assertEqual(3, await self.group.count_messages_in_group(group.group_id, None))
+
     @async_test
     async def test_join_group(self):
         create_query = CreateGroupQuery(
@@ -195,6 +221,29 @@ class TestGroupResource(BaseTest):
             any((g.user_id == BaseTest.OTHER_USER_ID for g in group_users.users))
         )
 
+    @async_test
+    async def test_join_group_outdates_user_stats_of_all_members(self):
+        from dinofw.rest.models import UserStats
+
+        cache = self.group.env.cache
+        stats = UserStats(
+            user_id=BaseTest.USER_ID,
+            unread_amount=0,
+            group_amount=1,
+            one_to_one_amount=0,
+            unread_groups_amount=0,
+        )
+        versions = dict(zip([BaseTest.GROUP_ID], cache.get_group_versions([BaseTest.GROUP_ID])))
+        cache.set_user_stats(BaseTest.USER_ID, "None:True:True", stats, versions)
+        cache.set_user_stats(BaseTest.OTHER_USER_ID, "None:True:True", stats, dict())
+
+        join_query = JoinGroupQuery(users=[BaseTest.OTHER_USER_ID])
+        await self.group.join_group(BaseTest.GROUP_ID, join_query, None)  # noqa
+
+        # not only the user joining
+        self.assertIsNone(cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+        self.assertIsNone(cache.get_user_stats(BaseTest.OTHER_USER_ID, "None:True:True"))
+
     @async_test
     async def test_leave_group(self):
         create_query = CreateGroupQuery(
@@ -202,7 +251,7 @@ class TestGroupResource(BaseTest):
         )
 
         # group doesn't exist yet
-        self.group.leave_group(BaseTest.GROUP_ID, BaseTest.USER_ID, None)  # noqa
+        await self.group.leave_group(BaseTest.GROUP_ID, BaseTest.USER_ID, None)  # noqa
 
         # create a new group
         group = await self.group.create_new_group(
@@ -215,7 +264,7 @@ class TestGroupResource(BaseTest):
         self.assertEqual(1, group_users.user_count)
 
         # leave the group
-        self.group.leave_group(group.group_id, BaseTest.USER_ID, None)  # noqa
+        await self.group.leave_group(group.group_id, BaseTest.USER_ID, None)  # noqa
 
         # check there's no users left in the group after leaving
         group_users = await self.group.get_users_in_group(group.group_id, None)  # noqa
@@ -4,6 +4,8 @@ from dinofw.rest.message import MessageResource
 from dinofw.rest.models import Message
 from dinofw.rest.models import MessageQuery
 from dinofw.rest.models import SendMessageQuery
+from dinofw.rest.models import UserStatsQuery
+from dinofw.rest.users import UserResource
 from dinofw.utils.config import MessageTypes
 from test.base import BaseTest
 from test.base import async_test
@@ -13,6 +15,7 @@ class TestMessageResource(BaseTest):
     def setUp(self) -> None:
         super().setUp()
         self.resource = MessageResource(self.fake_env)
+        self.user = UserResource(self.fake_env)
 
     @async_test
     async def test_send_message_to_group(self):
@@ -109,3 +112,29 @@ class TestMessageResource(BaseTest):
         )
         self.assertEqual(1, len(messages))
         self.assertEqual(type(messages[0]), Message)
+
+    @async_test
+    async def test_user_stats_outdated_without_resetting_each_member(self):
+        cache = self.resource.env.cache
+        calls = list()
+
+        def record(name, method):
+            def call(*args, **kwargs):
+                calls.append(name)
+                return method(*args, **kwargs)
+            return call
+
+        cache.set_message_sent_in_group = record("unread", cache.set_message_sent_in_group)
+        cache.reset_user_stats = record("reset", cache.reset_user_stats)
+
+        send_query = SendMessageQuery(message_payload="a new message", message_type=MessageTypes.MESSAGE)
+        await self.resource.send_message_to_group(BaseTest.GROUP_ID, BaseTest.USER_ID, send_query, None)  # noqa
+
+        # cached after the first message, like when polled by a member
+        stats = await self.user.get_user_stats(BaseTest.USER_ID, UserStatsQuery(), None)  # noqa
+        self.assertEqual(stats, cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+
+        await self.resource.send_message_to_group(BaseTest.GROUP_ID, BaseTest.USER_ID, send_query, None)  # noqa
+
+        self.assertIsNone(cache.get_user_stats(BaseTest.USER_ID, "None:True:True"))
+        self.assertEqual(["unread", "unread"], calls)
@@ -0,0 +1,530 @@
+from unittest.mock import Mock
+from unittest.mock import patch
+from uuid import uuid4 as uuid
+
+import arrow
+from cassandra.query import BatchType
+
+from dinofw.db.rdbms.schemas import UserGroupStatsBase
+from dinofw.db.storage.handler import CassandraHandler
+from dinofw.db.storage.models import AttachmentBucketModel
+from dinofw.db.storage.models import AttachmentModel
+from dinofw.db.storage.models import MessageBucketModel
+from dinofw.db.storage.models import MessageModel
+from dinofw.db.storage.statements import PROFILE_BATCH
+from dinofw.db.storage.statements import Statements
+from dinofw.rest.models import MessageQuery
+from dinofw.rest.models import SendMessageQuery
+from dinofw.utils.config import MessageTypes
+from dinofw.utils.exceptions import NoSuchMessageException
+from test.base import BaseTest
+from test.base import async_test
+from test.mocks import FakeBatchStatement
+from test.mocks import FakeCassandraSession
+
+
+class BaseStorageTest(BaseTest):
+    GROUP_ID = str(uuid())
+    MESSAGE_ID = str(uuid())
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.session = FakeCassandraSession()
+        self.handler = self._handler()
+
+        batch = patch("dinofw.db.storage.statements.BatchStatement", FakeBatchStatement)
+        batch.start()
+        self.addCleanup(batch.stop)
+
+    def _handler(self, buckets: str = "off") -> CassandraHandler:
+        self.fake_env.config.config["storage"]["buckets"] = buckets
+
+        handler = CassandraHandler(self.fake_env)
+        handler.statements = Statements(self.session, "dinofw", buckets=handler.write_buckets)
+
+        return handler
+
+
+class TestLookupById(BaseStorageTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.created_at = arrow.utcnow().datetime
+        self.approx_date = arrow.get(self.created_at).shift(minutes=-1).datetime
+        self.message_by_id = self.handler.statements.message_by_id.statement
+        self.attachment_by_file = self.handler.statements.attachment_by_file.statement
+
+    def _get_message(self):
+        return self.handler._get_message(self.GROUP_ID, BaseTest.USER_ID, self.MESSAGE_ID, self.approx_date)
+
+    def test_message_found_in_lookup(self):
+        self.session.rows[self.message_by_id] = [
+            (Statements.to_uuid(self.GROUP_ID), self.created_at, BaseTest.USER_ID)
+        ]
+
+        with patch.object(MessageModel, "objects") as objects:
+            message = self._get_message()
+
+        # the whole primary key, no filtering
+        self.assertEqual(objects.return_value.first.return_value, message)
+        self.assertEqual(3, len(objects.call_args.args))
+        objects.return_value.allow_filtering.assert_not_called()
+        self.assertEqual(
+            [(Statements.to_uuid(self.MESSAGE_ID),)],
+            self.session.statements_executed(self.message_by_id),
+        )
+
+    def test_message_not_in_lookup_is_filtered_for_and_added(self):
+        old_message = Mock(
+            message_id=Statements.to_uuid(self.MESSAGE_ID),
+            group_id=Statements.to_uuid(self.GROUP_ID),
+            created_at=self.created_at,
+            user_id=BaseTest.USER_ID,
+        )
+
+        with patch.object(MessageModel, "objects") as objects:
+            objects.return_value.allow_filtering.return_value.first.return_value = old_message
+            message = self._get_message()
+
+        self.assertIs(old_message, message)
+        self.assertEqual(
+            [(old_message.message_id, old_message.group_id, self.created_at, BaseTest.USER_ID)],
+            self.session.statements_executed(self.handler.statements.insert_message_id.statement),
+        )
+
+    def test_message_not_found(self):
+        with patch.object(MessageModel, "objects") as objects:
+            objects.return_value.allow_filtering.return_value.first.return_value = None
+            self.assertIsNone(self._get_message())
+
+        self.assertEqual(0, len(self.session.statements_executed(self.handler.statements.insert_message_id.statement)))
+
+    def test_message_in_other_group_or_from_other_user(self):
+        for group_id, user_id in [
+            (str(uuid()), BaseTest.USER_ID),
+            (self.GROUP_ID, BaseTest.OTHER_USER_ID),
+        ]:
+            self.session.rows[self.message_by_id] = [
+                (Statements.to_uuid(group_id), self.created_at, user_id)
+            ]
+
+            with patch.object(MessageModel, "objects") as objects:
+                message = self._get_message()
+
+            self.assertIsNone(message)
+            objects.assert_not_called()
+
+    def test_delete_message_not_found(self):
+        with patch.object(MessageModel, "objects") as objects:
+            objects.return_value.allow_filtering.return_value.first.return_value = None
+
+            with self.assertRaises(NoSuchMessageException):
+                self.handler.delete_message(self.GROUP_ID, BaseTest.USER_ID, self.MESSAGE_ID, self.created_at)
+
+    def test_attachment_found_in_lookup(self):
+        self.session.rows[self.attachment_by_file] = [
+            (Statements.to_uuid(self.GROUP_ID), self.created_at, BaseTest.USER_ID)
+        ]
+
+        with patch.object(AttachmentModel, "objects") as objects:
+            attachment = self.handler._get_attachment(self.GROUP_ID, BaseTest.FILE_ID, self.approx_date)
+
+        self.assertEqual(objects.return_value.first.return_value, attachment)
+        objects.return_value.allow_filtering.assert_not_called()
+        self.assertEqual(
+            [(BaseTest.FILE_ID,)],
+            self.session.statements_executed(self.attachment_by_file),
+        )
+
+    def test_attachment_not_in_lookup_is_filtered_for_and_added(self):
+        old_attachment = Mock(
+            file_id=BaseTest.FILE_ID,
+            group_id=Statements.to_uuid(self.GROUP_ID),
+            created_at=self.created_at,
+            user_id=BaseTest.USER_ID,
+            message_id=Statements.to_uuid(self.MESSAGE_ID),
+        )
+
+        with patch.object(AttachmentModel, "objects") as objects:
+            objects.return_value.allow_filtering.return_value.first.return_value = old_attachment
+            attachment = self.handler._get_attachment(self.GROUP_ID, BaseTest.FILE_ID, self.approx_date)
+
+        self.assertIs(old_attachment, attachment)
+        self.assertEqual(
+            [(BaseTest.FILE_ID, old_attachment.group_id, self.created_at, BaseTest.USER_ID, old_attachment.message_id)],
+            self.session.statements_executed(self.handler.statements.insert_file_id.statement),
+        )
+
+    def test_attachment_in_other_group(self):
+        self.session.rows[self.attachment_by_file] = [
+            (uuid(), self.created_at, BaseTest.USER_ID)
+        ]
+
+        with patch.object(AttachmentModel, "objects") as objects:
+            self.assertIsNone(self.handler._get_attachment(self.GROUP_ID, BaseTest.FILE_ID, self.approx_date))
+
+        objects.assert_not_called()
+
+
+class TestStoreMessage(BaseStorageTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.query = SendMessageQuery(message_payload="some text", message_type=MessageTypes.MESSAGE)
+
+    def assert_one_logged_batch(self, *statements):
+        (batch,) = self.session.batches
+
+        self.assertEqual(BatchType.LOGGED, batch.batch_type)
+        self.assertEqual(
+            [statement.statement for statement in statements],
+            [statement for statement, _ in batch.statements],
+        )
+
+    def test_message_and_lookup_in_one_batch(self):
+        message = self.handler.store_message(self.GROUP_ID, BaseTest.USER_ID, self.query)
+        statements = self.handler.statements
+
+        self.assert_one_logged_batch(statements.insert_message, statements.insert_message_id)
+
+        (_, parameters), = [
+            (statement, parameters) for statement, parameters in self.session.batches[0].statements
+            if statement == statements.insert_message_id.statement
+        ]
+        self.assertEqual(Statements.to_uuid(message.message_id), parameters[0])
+
+    @async_test
+    async def test_async_message_and_lookup_in_one_batch(self):
+        await self.handler.store_message_async(self.GROUP_ID, BaseTest.USER_ID, self.query)
+        statements = self.handler.statements
+
+        self.assert_one_logged_batch(statements.insert_message, statements.insert_message_id)
+
+    def test_bucket_rows_in_the_same_batch(self):
+        handler = self._handler("dual")
+        handler.store_message(self.GROUP_ID, BaseTest.USER_ID, self.query)
+        statements = handler.statements
+
+        self.assert_one_logged_batch(
+            statements.insert_message,
+            statements.insert_message_id,
+            statements.insert_message_in_bucket,
+            statements.insert_bucket,
+        )
+
+
+class TestBucketModes(BaseStorageTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.query = SendMessageQuery(message_payload="some text", message_type=MessageTypes.MESSAGE)
+
+    def test_off_only_writes_the_old_tables(self):
+        self.handler.store_message(self.GROUP_ID, BaseTest.USER_ID, self.query)
+
+        self.assertFalse(self.handler.write_buckets)
+        self.assertFalse(hasattr(self.handler.statements, "insert_message_in_bucket"))
+        self.assertEqual(
+            [self.handler.statements.insert_message.statement, self.handler.statements.insert_message_id.statement],
+            [statement for statement, _, _ in self.session.executed],
+        )
+
+    def test_dual_writes_the_bucketed_tables(self):
+        handler = self._handler("dual")
+        statements = handler.statements
+
+        message = handler.store_message(self.GROUP_ID, BaseTest.USER_ID, self.query)
+        bucket = Statements.bucket_of(message.created_at)
+        group_uuid = Statements.to_uuid(self.GROUP_ID)
+
+        self.assertTrue(handler.write_buckets)
+        self.assertFalse(handler.read_buckets)
+        self.assertEqual(1, len(self.session.statements_executed(statements.insert_message.statement)))
+
+        (in_bucket,) = self.session.statements_executed(statements.insert_message_in_bucket.statement)
+        self.assertEqual((group_uuid, bucket, message.created_at, BaseTest.USER_ID), in_bucket[:4])
+        self.assertEqual(
+            [(group_uuid, bucket)],
+            self.session.statements_executed(statements.insert_bucket.statement),
+        )
+
+    def test_dual_reads_the_old_tables(self):
+        handler = self._handler("dual")
+        handler.get_messages_in_group_for_user(self.GROUP_ID, self._user_stats(), MessageQuery(per_page=10))
+
+        self.assertEqual(
+            [handler.statements.messages_for_user.statement],
+            [statement for statement, _, _ in self.session.executed],
+        )
+
+    def test_dual_copies_attachments_to_their_bucket(self):
+        created_at = arrow.get("2026-09-30T23:59:59").datetime
+        attachment = AttachmentModel(
+            group_id=self.GROUP_ID,
+            created_at=created_at,
+            user_id=BaseTest.USER_ID,
+            message_id=self.MESSAGE_ID,
+            message_type=MessageTypes.IMAGE,
+            file_id=BaseTest.FILE_ID,
+        )
+
+        copy = self._handler("dual")._to_bucket(attachment)
+
+        self.assertIsInstance(copy, AttachmentBucketModel)
+        self.assertEqual(202609, copy.bucket)
+        self.assertEqual(BaseTest.FILE_ID, copy.file_id)
+        self.assertEqual(created_at, copy.created_at)
+
+    def test_on_reads_across_a_month_boundary(self):
+        handler = self._handler("on")
+        statements = handler.statements
+
+        until = arrow.get("2026-10-01T00:00:10")
+        user_stats = self._user_stats(delete_before=until.shift(days=-60).datetime)
+        in_october = self._rows(until.shift(seconds=-1), until.shift(seconds=-2))
+        in_september = self._rows(until.shift(seconds=-11), until.shift(seconds=-12))
+
+        self.session.rows[statements.buckets_between.statement] = [(202610,), (202609,), (202608,)]
+        self.session.rows[statements.messages_in_bucket_for_user.statement] = lambda parameters: {
+            202610: in_october,
+            202609: in_september[:parameters[-1]],
+        }[parameters[1]]
+
+        messages = handler.get_messages_in_group_for_user(
+            self.GROUP_ID, user_stats, MessageQuery(per_page=3, until=until.float_timestamp)
+        )
+
+        self.assertEqual(
+            [row[1] for row in in_october + in_september[:1]],
+            [message.created_at for message in messages],
+        )
+
+        # august isn't read, the limit was reached in september
+        self.assertEqual(
+            [(202610, 3), (202609, 1)],
+            [
+                (parameters[1], parameters[-1])
+                for parameters in self.session.statements_executed(statements.messages_in_bucket_for_user.statement)
+            ],
+        )
+        self.assertEqual(
+            [(Statements.to_uuid(self.GROUP_ID), 202610, 202608)],
+            self.session.statements_executed(statements.buckets_between.statement),
+        )
+
+    def test_on_counts_across_buckets(self):
+        handler = self._handler("on")
+        statements = handler.statements
+
+        self.session.rows[statements.buckets_since.statement] = [(202610,), (202609,)]
+        self.session.rows[statements.count_messages_in_bucket_since.statement] = lambda parameters: [
+            ({202610: 2, 202609: 5}[parameters[1]],)
+        ]
+
+        since = arrow.get("2026-09-15").datetime
+        self.assertEqual(7, handler.count_messages_in_group_since(self.GROUP_ID, since))
+
+    def test_soft_deletes_reach_the_bucket_rows(self):
+        handler = self._handler("dual")
+        removed_at = arrow.utcnow().datetime
+        message = MessageModel(
+            group_id=self.GROUP_ID,
+            created_at=arrow.get("2026-10-02").datetime,
+            user_id=BaseTest.USER_ID,
+            message_id=self.MESSAGE_ID,
+            message_type=MessageTypes.MESSAGE,
+        )
+
+        saved = list()
+
+        def callback(entity: MessageModel):
+            entity.removed_at = removed_at
+
+        def batch(entity, _):
+            saved.append(entity)
+            return Mock()
+
+        with patch("dinofw.db.storage.handler.BatchQuery"), \
+                patch.object(MessageModel, "batch", batch), \
+                patch.object(MessageBucketModel, "batch", batch):
+            handler._update_messages([message], callback)
+
+        saved_message, saved_in_bucket = saved
+
+        self.assertIs(message, saved_message)
+        self.assertIsInstance(saved_in_bucket, MessageBucketModel)
+        self.assertEqual(202610, saved_in_bucket.bucket)
+        self.assertEqual(removed_at, saved_in_bucket.removed_at)
+
+    def _user_stats(self, delete_before=None) -> UserGroupStatsBase:
+        stats = self.fake_env.db.stats[BaseTest.USER_ID][0].copy()
+
+        if delete_before is not None:
+            stats.delete_before = delete_before
+
+        return stats
+
+    def _rows(self, *created_ats) -> list:
+        return [
+            (
+                Statements.to_uuid(self.GROUP_ID),
+                created_at.datetime,
+                BaseTest.USER_ID,
+                uuid(),
+                MessageTypes.MESSAGE,
+                None,
+                "some text",
+                None,
+            )
+            for created_at in created_ats
+        ]
+
+
+class TestDeleteBefore(BaseStorageTest):
+    def test_off_range_delete(self):
+        before = arrow.get("2026-09-15").datetime
+        self.handler.delete_messages_in_group_before(self.GROUP_ID, before)
+
+        self.assertEqual(
+            [(Statements.to_uuid(self.GROUP_ID), before)],
+            self.session.statements_executed(self.handler.statements.delete_messages_before.statement),
+        )
+
+    def test_lookups_deleted_before_the_range(self):
+        statements = self.handler.statements
+        before = arrow.get("2026-09-15").datetime
+        message_ids = [uuid(), uuid()]
+
+        self.session.rows[statements.message_ids_before.statement] = [(message_id,) for message_id in message_ids]
+        self.session.rows[statements.file_ids_before.statement] = [(BaseTest.FILE_ID,)]
+
+        self.handler.delete_messages_in_group_before(self.GROUP_ID, before)
+        self.handler.delete_attachments_in_group_before(self.GROUP_ID, before)
+
+        self.assertEqual(
+            [(Statements.to_uuid(self.GROUP_ID), before)],
+            self.session.statements_executed(statements.message_ids_before.statement),
+        )
+        self.assertEqual(
+            [(message_id,) for message_id in message_ids],
+            self.session.statements_executed(statements.delete_message_id.statement),
+        )
+        self.assertEqual(
+            [(BaseTest.FILE_ID,)],
+            self.session.statements_executed(statements.delete_file_id.statement),
+        )
+
+        # the keys can't be read anymore after the range delete
+        executed = [statement for statement, _, _ in self.session.executed]
+        self.assertLess(
+            executed.index(statements.message_ids_before.statement),
+            executed.index(statements.delete_messages_before.statement),
+        )
+
+    def test_buckets_dropped_and_range_delete_in_last_bucket(self):
+        handler = self._handler("dual")
+        statements = handler.statements
+        group_uuid = Statements.to_uuid(self.GROUP_ID)
+        before = arrow.get("2026-09-15").datetime
+
+        self.session.rows[statements.buckets_between.statement] = [(202609,), (202608,), (202607,)]
+        handler.delete_messages_in_group_before(self.GROUP_ID, before)
+
+        self.assertEqual(
+            [(group_uuid, 202609, 0)],
+            self.session.statements_executed(statements.buckets_between.statement),
+        )
+        self.assertEqual(
+            [(group_uuid, 202608), (group_uuid, 202607)],
+            self.session.statements_executed(statements.delete_messages_bucket.statement),
+        )
+        self.assertEqual(
+            [(group_uuid, 202609, before)],
+            self.session.statements_executed(statements.delete_messages_in_bucket_before.statement),
+        )
+
+        # the old table is still cleaned up while both are written
+        self.assertEqual(
+            [(group_uuid, before)],
+            self.session.statements_executed(statements.delete_messages_before.statement),
+        )
+
+    def test_attachments_use_the_attachment_buckets(self):
+        handler = self._handler("on")
+        statements = handler.statements
+        before = arrow.get("2026-09-15").datetime
+
+        self.session.rows[statements.buckets_between.statement] = [(202609,), (202608,)]
+        handler.delete_attachments_in_group_before(self.GROUP_ID, before)
+
+        self.assertEqual(1, len(self.session.statements_executed(statements.delete_attachments_bucket.statement)))
+        self.assertEqual(1, len(self.session.statements_executed(statements.delete_attachments_in_bucket_before.statement)))
+        self.assertEqual(0, len(self.session.statements_executed(statements.delete_messages_bucket.statement)))
+
+
+class TestBackfill(BaseStorageTest):
+    WRITE_TIME = 1_790_000_000_000_000
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.group_uuid = Statements.to_uuid(self.GROUP_ID)
+        self.messages = [
+            (self.group_uuid, arrow.get("2026-10-01").datetime, BaseTest.USER_ID, uuid(), 0, None, "a", None, None),
+            (self.group_uuid, arrow.get("2026-09-30").datetime, BaseTest.USER_ID, uuid(), 0, None, "b", None, None),
+        ]
+        self.attachments = [
+            (self.group_uuid, arrow.get("2026-09-30").datetime, BaseTest.USER_ID, uuid(), 1, BaseTest.FILE_ID, "b", None),
+        ]
+
+    def _backfill(self, handler: CassandraHandler) -> int:
+        self.session.rows[handler.statements.all_messages_in_group.statement] = self.messages
+        self.session.rows[handler.statements.all_attachments_in_group.statement] = self.attachments
+
+        return handler.backfill_group(self.GROUP_ID, self.WRITE_TIME)
+
+    def test_lookups_copied(self):
+        statements = self.handler.statements
+
+        self.assertEqual(2, self._backfill(self.handler))
+        self.assertEqual(
+            [
+                (row[3], self.group_uuid, row[1], row[2], self.WRITE_TIME)
+                for row in self.messages
+            ],
+            self.session.statements_executed(statements.copy_message_id.statement),
+        )
+        self.assertEqual(
+            [(BaseTest.FILE_ID, self.group_uuid, self.attachments[0][1], BaseTest.USER_ID, self.attachments[0][3], self.WRITE_TIME)],
+            self.session.statements_executed(statements.copy_file_id.statement),
+        )
+
+        # not prepared when the bucketed tables aren't used
+        self.assertFalse(hasattr(statements, "copy_message_to_bucket"))
+
+    def test_rows_copied_to_their_buckets(self):
+        handler = self._handler("dual")
+        statements = handler.statements
+
+        self._backfill(handler)
+
+        self.assertEqual(
+            [(202610, *self.messages[0], self.WRITE_TIME), (202609, *self.messages[1], self.WRITE_TIME)],
+            self.session.statements_executed(statements.copy_message_to_bucket.statement),
+        )
+        self.assertEqual(
+            [(202609, *self.attachments[0], self.WRITE_TIME)],
+            self.session.statements_executed(statements.copy_attachment_to_bucket.statement),
+        )
+        self.assertEqual(
+            {(self.group_uuid, 202610), (self.group_uuid, 202609)},
+            set(self.session.statements_executed(statements.copy_bucket.statement)),
+        )
+
+    def test_copies_use_the_batch_profile(self):
+        self._backfill(self._handler("dual"))
+
+        copies = [
+            profile
+            for statement, _, profile in self.session.executed
+            if statement.startswith("INSERT")
+        ]
+
+        self.assertTrue(len(copies))
+        self.assertEqual({PROFILE_BATCH}, set(copies))
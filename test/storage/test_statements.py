@@ -0,0 +1,146 @@
+from unittest.mock import patch
+from uuid import uuid4 as uuid
+
+import arrow
+from cassandra.query import tuple_factory
+
+from dinofw.db.storage.handler import CassandraHandler
+from dinofw.db.storage.schemas import MessageBase
+from dinofw.db.storage.statements import MESSAGE_COLUMNS
+from dinofw.db.storage.statements import PROFILE_BATCH
+from dinofw.db.storage.statements import PROFILE_ROWS
+from dinofw.db.storage.statements import Statements
+from test.base import BaseTest
+from test.base import async_test
+from test.mocks import FakeCassandraSession
+from test.mocks import FakeResponseFuture
+
+
+class TestStatements(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.session = FakeCassandraSession()
+        self.statements = Statements(self.session, "dinofw")
+        self.group_id = uuid()
+
+        self.row = (
+            self.group_id,
+            arrow.utcnow().datetime,
+            BaseTest.USER_ID,
+            uuid(),
+            0,
+            BaseTest.FILE_ID,
+            "some text",
+            None,
+        )
+
+    def test_prepared_once_with_profiles(self):
+        self.assertEqual(PROFILE_ROWS, self.statements.messages_for_user.profile)
+        self.assertEqual(PROFILE_ROWS, self.statements.message_by_id.profile)
+        self.assertEqual(PROFILE_BATCH, self.statements.delete_messages_before.profile)
+        self.assertEqual(PROFILE_BATCH, self.statements.copy_message_id.profile)
+
+        # bucket statements only when the tables are used
+        self.assertFalse(hasattr(self.statements, "messages_in_bucket_for_user"))
+        self.assertTrue(hasattr(Statements(self.session, "dinofw", buckets=True), "messages_in_bucket_for_user"))
+
+    def test_column_order(self):
+        # rows are unpacked by position, e.g. `_, created_at, user_id, message_id, _, file_id = row[:6]`
+        self.assertEqual(
+            ["group_id", "created_at", "user_id", "message_id", "message_type", "file_id"],
+            MESSAGE_COLUMNS[:6],
+        )
+        self.assertEqual(list(MessageBase.__fields__.keys()), MESSAGE_COLUMNS)
+
+        for query in [
+            self.statements.messages_for_user,
+            self.statements.attachments_for_user,
+            self.statements.all_messages_in_group,
+            self.statements.all_attachments_in_group,
+        ]:
+            self.assertTrue(query.statement.startswith(f"SELECT {', '.join(MESSAGE_COLUMNS)}"))
+
+    def test_message_base_from_row(self):
+        message = Statements.message_base_from_row(self.row)
+
+        self.assertEqual(str(self.group_id), message.group_id)
+        self.assertEqual(str(self.row[3]), message.message_id)
+        self.assertEqual(BaseTest.USER_ID, message.user_id)
+        self.assertEqual(BaseTest.FILE_ID, message.file_id)
+        self.assertEqual("some text", message.message_payload)
+
+    def test_execute_with_profile(self):
+        self.session.rows[self.statements.messages_for_user.statement] = [self.row]
+
+        messages = self.statements.messages(self.statements.messages_for_user, self.group_id, 1, 2, 3)
+
+        self.assertEqual(1, len(messages))
+        self.assertEqual(
+            [(self.statements.messages_for_user.statement, (self.group_id, 1, 2, 3), PROFILE_ROWS)],
+            self.session.executed,
+        )
+
+    @async_test
+    async def test_execute_async(self):
+        self.session.rows[self.statements.messages_for_user.statement] = [self.row]
+
+        messages = await self.statements.messages_async(self.statements.messages_for_user, self.group_id, 1, 2, 3)
+
+        self.assertEqual([str(self.row[3])], [message.message_id for message in messages])
+
+    @async_test
+    async def test_execute_async_fetches_all_pages(self):
+        rows = [(*self.row[:3], uuid(), *self.row[4:]) for _ in range(3)]
+        self.session.rows[self.statements.messages_for_user.statement] = rows
+        self.session.more_pages.append(self.statements.messages_for_user.statement)
+
+        messages = await self.statements.messages_async(self.statements.messages_for_user, self.group_id, 1, 2, 3)
+
+        self.assertEqual([str(row[3]) for row in rows], [message.message_id for message in messages])
+
+    @async_test
+    async def test_execute_async_error(self):
+        def execute_async(*_, **__):
+            return FakeResponseFuture(error=ValueError("timeout"))
+
+        self.session.execute_async = execute_async
+
+        with self.assertRaises(ValueError):
+            await self.statements.execute_async(self.statements.messages_for_user, self.group_id, 1, 2, 3)
+
+    def test_execute_concurrent_is_lazy(self):
+        events = list()
+        execute = self.session.execute
+
+        def queries():
+            for i in range(5):
+                events.append(f"yield {i}")
+                yield self.statements.copy_message_id, (i,)
+
+        def execute_and_record(statement, parameters, execution_profile=None):
+            events.append(f"execute {parameters[0]}")
+            return execute(statement, parameters, execution_profile)
+
+        self.session.execute = execute_and_record
+        self.statements.execute_concurrent(queries(), concurrency=2)
+
+        self.assertEqual(5, len(self.session.executed))
+        self.assertEqual({PROFILE_BATCH}, {profile for _, _, profile in self.session.executed})
+
+        # not all consumed before the first one is sent
+        self.assertLess(events.index("execute 0"), events.index("yield 4"))
+
+
+class TestExecutionProfiles(BaseTest):
+    def test_tuple_row_factory(self):
+        handler = CassandraHandler(self.fake_env)
+
+        with patch("dinofw.db.storage.handler.connection") as connection, \
+                patch("dinofw.db.storage.handler.sync_table"):
+            connection.get_session.return_value = FakeCassandraSession()
+            handler.setup_tables()
+
+        profiles = connection.setup.call_args.kwargs["execution_profiles"]
+
+        self.assertIs(tuple_factory, profiles[PROFILE_ROWS].row_factory)
+        self.assertIs(tuple_factory, profiles[PROFILE_BATCH].row_factory)